@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+
+
+# Pool of the work arrays of the filters (filtered spectra, composite masks), so that filtering many images of the
+# same size (a batch, the frames of a video) reuses the same memory instead of allocating it for every image.
+# An array is taken with acquire and given back with release when its content is not needed anymore, the free
+# arrays are kept by (shape, dtype) up to max_bytes, beyond that the released arrays are simply dropped.
+# The content of an acquired array is undefined, it must be entirely overwritten.
+class BufferPool:
+
+    # Maximum memory (bytes) held by the free arrays
+    max_bytes : int
+
+    # Free arrays keyed by (shape, dtype)
+    _free : dict
+    _free_bytes : int
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._free = {}
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+
+    # Gets an array of the given shape and dtype, a free one when available
+    def acquire(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                array = free.pop()
+                self._free_bytes -= array.nbytes
+                return array
+        return np.empty(shape, dtype)
+
+    # Gives back an array obtained with acquire, None is ignored
+    def release(self, array):
+        if array is None:
+            return
+        with self._lock:
+            if self._free_bytes + array.nbytes <= self.max_bytes:
+                self._free.setdefault((array.shape, array.dtype.str), []).append(array)
+                self._free_bytes += array.nbytes
+
+    # Drops all the free arrays
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self._free_bytes = 0
+
+
+# Pool shared by all the ImageProcessing instances of the process
+default_pool = BufferPool()
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+
+# scipy is optional, when it is installed its FFT can spread a stack of channels over several threads
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+
+# Transform backends used by ImageProcessing.
+# The images are real, so only half of the spectrum is needed (the other half is its complex conjugate):
+# every backend uses real FFTs, taking a stack of channels of shape (..., height, width) as float32 and
+# returning the half spectrum of shape (..., height, width//2 + 1) as complex64 (and the other way around),
+# all the channels of the stack are transformed in a single batched call on the last two axes.
+#
+#   full spectrum (height, width)         half spectrum (height, width//2 + 1)
+#   ------------------------------        ---------------
+#   |              |             |        |              |
+#   |   columns    |   columns   |  -->   |   columns    |
+#   |  0..width/2  |  negatives  |        |  0..width/2  |
+#   |              |             |        |              |
+#   ------------------------------        ---------------
+#
+class NumpyFFTBackend:
+
+    name = 'numpy'
+
+    # Forward transform of a stack of channels
+    #  - stack -> real array of shape (..., height, width)
+    def forward(self, stack):
+        return np.fft.rfft2(np.asarray(stack, np.float32)).astype(np.complex64, copy=False)
+
+    # Inverse transform of a stack of half spectra
+    #  - spectrum -> complex array of shape (..., height, width//2 + 1)
+    #  - shape -> (height, width) of the spatial result, needed since the width can't be recovered from the half spectrum
+    def inverse(self, spectrum, shape):
+        return np.fft.irfft2(spectrum, s=shape).astype(np.float32, copy=False)
+
+
+class ScipyFFTBackend:
+
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        # number of threads used for a stack of channels, by default one per cpu
+        self.workers = workers or os.cpu_count()
+
+    def forward(self, stack):
+        return scipy_fft.rfft2(np.asarray(stack, np.float32), workers=self.workers)
+
+    def inverse(self, spectrum, shape):
+        return scipy_fft.irfft2(spectrum, s=shape, workers=self.workers)
+
+
+BACKENDS = {
+    'numpy': NumpyFFTBackend,
+    'scipy': ScipyFFTBackend,
+}
+
+# Returns a backend instance, accepts 1 argument:
+#  - backend -> name of the backend ('numpy', 'scipy'), an already created backend instance,
+#               or None to pick the fastest available one
+def get_backend(backend=None):
+    if backend is None:
+        backend = 'scipy' if scipy_fft is not None else 'numpy'
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown FFT backend '{backend}', available backends: {', '.join(BACKENDS)}")
+    if backend == 'scipy' and scipy_fft is None:
+        raise ImportError("The 'scipy' FFT backend requires scipy to be installed")
+    return BACKENDS[backend]()
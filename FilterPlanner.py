@@ -0,0 +1,255 @@
+import math
+import threading
+import warnings
+from collections import OrderedDict
+import cv2
+import numpy as np
+from MaskLibrary import PROFILES, spatial_kernel
+
+
+# Ways of executing a filter:
+#  - 'auto' -> the cheaper of the two below according to the cost model, the spatial one only when its estimated
+#              error is within the tolerance
+#  - 'frequency' -> forward DFT, mask multiplication and inverse DFT (the original path)
+#  - 'spatial' -> convolution with the spatial kernel equivalent to the mask, forced even beyond the tolerance
+#                 (for benchmarking and comparisons), with a RuntimeWarning in that case since the result can be far
+#                 from the frequency one (tens of gray levels for the circle masks)
+METHODS = ('auto', 'frequency', 'spatial')
+
+# Seconds per element per log2(elements) of a single channel real transform, by backend (see FFTBackend),
+# measured on a single core: the numpy backend works in double precision and converts the result
+FFT_COSTS = {'numpy': 1.6e-9, 'scipy': 5e-10}
+
+
+# Plan of a filter, as chosen by FilterPlanner.plan
+class Plan:
+
+    # 'frequency' or 'spatial'
+    method : str
+
+    # Spatial path: the result is identity * image + the image filtered with the kernels, either the separable
+    # kernel_y (rows) and kernel_x (columns) or the 2D kernel, None when the mask is constant
+    identity : float
+    kernel_y : np.ndarray
+    kernel_x : np.ndarray
+    kernel : np.ndarray
+
+    # Estimated maximum difference (gray levels) between the spatial and the frequency results, inf when no spatial
+    # kernel is available
+    error : float
+
+    # Estimated seconds of the two paths (the spatial one is None when no kernel is available) and why the method
+    # was chosen
+    costs : dict
+    reason : str
+
+    def __init__(self, method, costs, reason, kernels=None):
+        self.method = method
+        self.costs = costs
+        self.reason = reason
+        kernels = kernels or {}
+        self.identity = kernels.get('identity', 1.0)
+        self.kernel_y = kernels.get('kernel_y')
+        self.kernel_x = kernels.get('kernel_x')
+        self.kernel = kernels.get('kernel')
+        self.error = kernels.get('error', math.inf)
+
+    def __repr__(self):
+        costs = ', '.join(f"{name} {'-' if cost is None else f'{cost * 1000:.1f} ms'}" for name, cost in self.costs.items())
+        return f"Plan({self.method}, {self.reason}, {costs}, error {self.error:.3g})"
+
+
+# Execution planner of the filters of ImageProcessing (custom_filter, blurring, noise_filtering).
+# Multiplying the spectrum with a mask is the same as convolving the image with the inverse DFT of the mask,
+# a kernel as large as the image. When the kernel decays quickly most of it is negligible, the image can be convolved
+# with its center only, with borders wrapping around as the DFT does, and for small kernels (or small images)
+# that is much cheaper than a DFT round trip per channel:
+#  - gaussian masks are separable, the kernel is the product of two 1D kernels (cv2.sepFilter2D), each one the exact
+#    periodic inverse DFT of the 1D profile of the mask, truncated where what is left is below the tolerance
+#  - butterworth and circle masks are not, their 2D kernel (cv2.filter2D) is only considered up to max_kernel_2d
+#    (beyond it OpenCV goes through a DFT anyway), the circle one decays so slowly that it rarely qualifies
+# The error of the spatial result is estimated as 255 times the absolute sum of the discarded part of the kernel,
+# an upper bound of the difference from the frequency result on any 8 bit image. With the default tolerance of
+# 0.5 the two results round to the same gray levels except where the rounding is already ambiguous.
+# The cost model counts, per channel, n log2(n) per transform on the image padded to cv2.getOptimalDFTSize (the
+# forward one only when the spectrum is not cached) plus the multiplication against the taps of the kernel per
+# pixel plus a fixed cost per pixel for padding and conversion. The constants come from single core measures and
+# only their ratios matter.
+class FilterPlanner:
+
+    # Maximum estimated error (gray levels) tolerated by the 'auto' method
+    tolerance : float
+
+    # Largest side of the 2D kernels considered
+    max_kernel_2d : int
+
+    # Cost model, seconds: per element per log2(elements) of a transform (by backend name), per element of the
+    # mask multiplication, per pixel per tap of a separable kernel and of a 2D kernel, per pixel of the spatial path
+    fft_costs : dict
+    multiply_cost : float
+    tap_cost : float
+    tap_cost_2d : float
+    pixel_cost : float
+
+    # Cache of the spatial kernels keyed by (shape, radius, intensity, direction, profile), least recently used first
+    _kernels : OrderedDict
+
+    def __init__(self, tolerance=0.5, max_kernel_2d=7, fft_costs=None, multiply_cost=2e-9, tap_cost=1.1e-10,
+                 tap_cost_2d=4e-10, pixel_cost=1.2e-9, max_cached=32):
+        self.tolerance = tolerance
+        self.max_kernel_2d = max_kernel_2d
+        self.fft_costs = dict(FFT_COSTS, **(fft_costs or {}))
+        self.multiply_cost = multiply_cost
+        self.tap_cost = tap_cost
+        self.tap_cost_2d = tap_cost_2d
+        self.pixel_cost = pixel_cost
+        self.max_cached = max_cached
+        self._kernels = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Plans a filter, accepts 10 arguments:
+    #  - shape -> (height, width) of the image
+    #  - channels -> number of channels filtered
+    #  - radius, intensity, direction, profile -> the mask, as for MaskLibrary.get_mask
+    #  - method -> one of METHODS
+    #  - backend -> name of the transform backend, for the cost of the frequency path
+    #  - forward_cached -> True when the spectrum of the image is already available
+    #  - spectrum -> True when the filtered spectrum is needed too, the spatial path then also pays for the forward
+    #                transform and the multiplication
+    # returns a Plan
+    def plan(self, shape, channels, radius, intensity, direction, profile='circle', method='auto', backend=None, forward_cached=False, spectrum=False):
+        if method not in METHODS:
+            raise ValueError(f"Unknown filter method '{method}', available methods: {', '.join(METHODS)}")
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown mask profile '{profile}', available profiles: {', '.join(PROFILES)}")
+        costs = {'frequency': self.frequency_cost(shape, channels, backend, forward_cached), 'spatial': None}
+        if method == 'frequency':
+            return Plan('frequency', costs, 'forced')
+        kernels = self.kernels(tuple(shape), float(radius), float(intensity), int(bool(direction)), profile)
+        costs['spatial'] = self.spatial_cost(shape, channels, kernels)
+        if spectrum:
+            costs['spatial'] += self.frequency_cost(shape, channels, backend, forward_cached, inverse=False)
+        if method == 'spatial':
+            if kernels['error'] > self.tolerance:
+                warnings.warn(f"Spatial filtering forced with an estimated error of {kernels['error']:.3g} gray levels, beyond the "
+                              f"tolerance of {self.tolerance:.3g} ({profile} mask, radius {radius:.3g})", RuntimeWarning, stacklevel=2)
+                return Plan('spatial', costs, 'forced beyond tolerance', kernels)
+            return Plan('spatial', costs, 'forced', kernels)
+        if kernels['error'] > self.tolerance:
+            return Plan('frequency', costs, 'kernel beyond tolerance', kernels)
+        if costs['spatial'] < costs['frequency']:
+            return Plan('spatial', costs, 'cheaper', kernels)
+        return Plan('frequency', costs, 'cheaper', kernels)
+
+    # Gets the estimated seconds of the frequency path, without the inverse transform when inverse is False
+    def frequency_cost(self, shape, channels, backend=None, forward_cached=False, inverse=True):
+        elements = cv2.getOptimalDFTSize(shape[0]) * cv2.getOptimalDFTSize(shape[1])
+        transforms = (0 if forward_cached else 1) + (1 if inverse else 0)
+        fft_cost = self.fft_costs.get(backend, self.fft_costs['scipy'])
+        return channels * (transforms * fft_cost * elements * math.log2(max(elements, 2)) + self.multiply_cost * elements / 2)
+
+    # Gets the estimated seconds of the spatial path with the given kernels (see kernels)
+    def spatial_cost(self, shape, channels, kernels):
+        if kernels['kernel'] is not None:
+            per_pixel = self.tap_cost_2d * kernels['kernel'].size
+        elif kernels['kernel_y'] is not None:
+            per_pixel = self.tap_cost * (len(kernels['kernel_y']) + len(kernels['kernel_x']))
+        else:
+            per_pixel = 0
+        return channels * shape[0] * shape[1] * (self.pixel_cost + per_pixel)
+
+    # Gets the spatial kernels of a mask, the smallest within the tolerance (the largest available when none is)
+    # returns {'identity', 'kernel_y', 'kernel_x', 'kernel', 'error'}, see Plan
+    def kernels(self, shape, radius, intensity, direction, profile):
+        key = (shape, radius, intensity, direction, profile)
+        with self._lock:
+            if key in self._kernels:
+                self._kernels.move_to_end(key)
+                return self._kernels[key]
+        if intensity == 1:
+            # the mask is 1 everywhere
+            kernels = {'identity': 1.0, 'kernel_y': None, 'kernel_x': None, 'kernel': None, 'error': 0.0}
+        elif profile == 'gaussian':
+            kernels = self.separable_kernels(shape, radius, intensity, direction)
+        else:
+            kernels = self.kernel_2d(shape, radius, intensity, direction, profile)
+        with self._lock:
+            self._kernels[key] = kernels
+            while len(self._kernels) > self.max_cached:
+                self._kernels.popitem(last=False)
+        return kernels
+
+    # Gets the separable kernels of a gaussian mask:
+    #   LPF: intensity + (1 - intensity) * low_pass  ->  intensity * image + (1 - intensity) * image * (k_y k_x)
+    #   HPF: 1 - (1 - intensity) * low_pass          ->  image - (1 - intensity) * image * (k_y k_x)
+    # the discarded parts of the two kernels are balanced so that the error stays within the tolerance
+    def separable_kernels(self, shape, radius, intensity, direction):
+        weight = 1 - intensity
+        # (1 + tail_y)(1 + tail_x) - 1 is the discarded part of the product
+        tail = math.sqrt(1 + self.tolerance / (255 * weight)) - 1
+        kernel_y, tail_y = truncate(periodic_gaussian(shape[0], radius), tail)
+        kernel_x, tail_x = truncate(periodic_gaussian(shape[1], radius), tail)
+        return {
+            'identity': float(intensity) if direction else 1.0,
+            'kernel_y': (kernel_y * (weight if direction else -weight)).astype(np.float32),
+            'kernel_x': kernel_x.astype(np.float32),
+            'kernel': None,
+            'error': 255 * weight * (tail_y + tail_x + tail_y * tail_x),
+        }
+
+    # Gets the 2D kernel of a mask (MaskLibrary.spatial_kernel), cropped from a reference kernel of up to 8 times
+    # max_kernel_2d to the smallest size within the tolerance
+    def kernel_2d(self, shape, radius, intensity, direction, profile):
+        reference_size = odd(min(8 * self.max_kernel_2d + 1, *shape))
+        reference = spatial_kernel(shape, radius, intensity, direction, profile, size=reference_size).astype(np.float64)
+        for size in range(1, odd(min(self.max_kernel_2d, reference_size)) + 1, 2):
+            error = truncation_error(reference, size)
+            if error <= self.tolerance:
+                break
+        return {'identity': 0.0, 'kernel_y': None, 'kernel_x': None, 'kernel': crop(reference, size).astype(np.float32), 'error': error}
+
+
+# Planner shared by all the ImageProcessing instances of the process
+default_planner = FilterPlanner()
+
+
+# Gets the largest odd number not greater than size
+def odd(size):
+    return size if size % 2 else size - 1
+
+
+# Gets the center (size, size) of a centered 2D kernel
+def crop(kernel, size):
+    top, left = kernel.shape[0] // 2 - size // 2, kernel.shape[1] // 2 - size // 2
+    return kernel[top:top + size, left:left + size]
+
+
+# Gets the estimated error (gray levels) of convolving with the center (size, size) of a centered 2D kernel instead of
+# the whole kernel: 255 times the absolute sum of the discarded part, an upper bound of the difference on any 8 bit image
+def truncation_error(kernel, size):
+    return float(255 * max(np.abs(kernel).sum(dtype=np.float64) - np.abs(crop(kernel, size)).sum(dtype=np.float64), 0.0))
+
+
+# Gets the periodic kernel (origin at index 0) of the 1D gaussian profile of a mask over n samples,
+# the exact inverse DFT of exp(-f^2 / (2 radius^2)) on the frequencies of np.fft.fftfreq
+def periodic_gaussian(n, radius):
+    frequencies = np.fft.fftfreq(n) * n
+    if radius == 0:
+        profile = (frequencies == 0).astype(np.float64)
+    else:
+        profile = np.exp(frequencies ** 2 / (-2 * radius * radius))
+    return np.fft.ifft(profile).real
+
+
+# Gets the center of a periodic kernel (origin at index 0) as a centered odd kernel, the smallest one leaving out
+# at most tail of the absolute sum (the whole period when none does), returns the kernel and what it leaves out
+def truncate(kernel, tail):
+    magnitude = np.abs(kernel)
+    half_max = (len(kernel) - 1) // 2
+    # absolute sum of the kernel within -half..half, for half from 0 to half_max
+    pairs = magnitude[1:half_max + 1] + magnitude[::-1][:half_max]
+    inside = magnitude[0] + np.concatenate(([0], np.cumsum(pairs)))
+    left_out = magnitude.sum() - inside
+    within = np.flatnonzero(left_out <= tail)
+    half = int(within[0]) if len(within) else half_max
+    return np.roll(kernel, half)[:2 * half + 1], max(float(left_out[half]), 0.0)
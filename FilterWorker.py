@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+# Background thread running the filters of the GUI, so that the Tk main loop never waits for them.
+# Only the most recent request matters: a request submitted while another one is waiting replaces it,
+# and the result of a request that has been superseded while running is dropped (stale).
+# Tk widgets must only be touched from the main thread, so the results are not delivered through callbacks
+# but collected by the main loop with poll.
+class FilterWorker:
+
+    # Number of the most recent request, results of older requests are stale
+    generation : int
+
+    def __init__(self):
+        self.generation = 0
+        self._request = None
+        self._running = False
+        self._condition = threading.Condition()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='FilterWorker', daemon=True)
+        self._thread.start()
+
+    # Schedules a job, replacing the one waiting (if any)
+    # accepts 2 arguments:
+    #  - job -> function without arguments, its return value is the result
+    #  - tag -> any value returned along with the result, to tell apart different kinds of jobs
+    # returns the generation of the request
+    def submit(self, job, tag=None):
+        with self._condition:
+            self.generation += 1
+            self._request = (self.generation, job, tag)
+            self._condition.notify()
+            return self.generation
+
+    # Drops the waiting job and makes the running one stale
+    def cancel(self):
+        with self._condition:
+            self.generation += 1
+            self._request = None
+
+    # Gets the results ready and still current, as a list of (tag, result),
+    # the exceptions raised by the jobs are returned as results
+    def poll(self):
+        results = []
+        while True:
+            try:
+                generation, tag, result = self._results.get_nowait()
+            except queue.Empty:
+                return results
+            if generation == self.generation:
+                results.append((tag, result))
+
+    # Tells whether a job is waiting or running
+    def busy(self):
+        with self._condition:
+            return self._request is not None or self._running
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._request is None:
+                    self._condition.wait()
+                generation, job, tag = self._request
+                self._request = None
+                self._running = True
+            try:
+                result = job()
+            except Exception as error:
+                result = error
+            with self._condition:
+                self._running = False
+                if generation == self.generation:
+                    self._results.put((generation, tag, result))
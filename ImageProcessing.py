@@ -1,6 +1,12 @@
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
+from BufferPool import default_pool
+from FFTBackend import get_backend
+from FilterPlanner import default_planner
+from Instrumentation import null_instrumentation
+from MaskLibrary import default_library
+from OutputSink import FileSink
 
 
 class ImageProcessing:
@@ -8,10 +14,11 @@ class ImageProcessing:
     # Contains the image path, must be passed as argument in the creation of an instance
     image_path : str
     
-    # The actual image loaded in memory and stored as numpy array of shape (height, width, colors(BGR))
+    # The actual image loaded in memory and stored as numpy array of shape (height, width, colors(RGB))
     image : np.ndarray
     
     # The actual image loaded in memory and stored as numpy array in grayscale of shape (height, width)
+    # derived from the decoded color buffer, the file is decoded only once
     image_gray : np.ndarray
     
     # image dimensions
@@ -21,153 +28,610 @@ class ImageProcessing:
     # center row and col of the image (rounded)
     crow : int 
     ccol : int
+
+    # Compact mode, when True the filtered frequency domains are released as soon as the filtered image 
+    # has been recomposed, so that the memory held by an instance scales with what has actually been used
+    compact : bool
+
+    # Transform backend (see FFTBackend), the image is real so only half of the spectrum is computed and stored
+    backend : object
+
+    # Library providing the (cached) masks, shared by all the instances unless a specific one is passed
+    masks : object
+
+    # Where the results of the filters are written (see OutputSink), by default files in output_dir (the current directory),
+    # written synchronously; the prefix of the file names lets several images share a sink without overwriting each other's results
+    sink : object
+    output_prefix : str
+
+    # Instrumentation receiving the timings and allocated bytes of the stages (see Instrumentation), 
+    # disabled by default
+    instrumentation : object
+
+    # Pool of the filtered spectra (see BufferPool), a filter writes into the buffer of the previous one when the shape
+    # matches, in compact mode the buffers go back to the pool as soon as the filtered image has been recomposed, 
+    # so that the next image of the same size reuses them
+    buffers : object
+
+    # How the filters are executed (see FilterPlanner.METHODS): 'auto' lets the planner choose between the frequency 
+    # path and the equivalent spatial convolution, 'frequency' and 'spatial' force one of them. The plan of the last 
+    # planned filter is kept in last_plan
+    method : str
+    planner : object
+    last_plan : object
     
-    # List of matrices (numpy arrays) containing the frequency domain with both natural and immaginary components 
-    # of each color (sorted as RGB), already shifted to center the 0 frequencies, shape of each element of the list is (height, width, 2)
-    image_frequency_RGB : list
-    image_frequency_gray : np.ndarray
-    
-    # Spectra of the magnitude, logaritmic scale applied 
-    magnitude_spectrum_RGB : list           # List divided by color and sorted as RGB
-    magnitude_spectrum_gray : np.ndarray
+    # Cache of the frequency domains, filled on demand the first time a filter or a display needs them. 
+    # The three colors are transformed together in a single batched call and stored as one stack keyed 'RGB', 
+    # the grayscale is keyed None. Each frequency domain is a complex64 half spectrum of shape (height, width//2 + 1), 
+    # never shifted: the 0 frequency is in the corner (row 0, column 0), as are the masks (see MaskLibrary),
+    # only the displayed magnitude spectra are centered.
+    # Exposed through the image_frequency_RGB and image_frequency_gray properties
+    _frequency_cache : dict
+
+    # Cache of the rendered magnitude spectra (see render_spectrum), uint8 images keyed by (channel, filter version, reduction factor),
+    # no full size float spectrum is ever kept
+    _spectrum_cache : dict
+
+    # Number of filters applied on the colors ('RGB') and on the grayscale (None), identifies the filtered spectra in the cache
+    _filter_versions : dict
     
-    # List of matrices (numpy arrays) containing the frequency domain with both natural and immaginary components 
-    # of each color (sorted as RGB), already shifted to center the 0 frequencies, shape of each element of the list is (height, width, 2)
+    # Stack of the filtered half spectra of the selected colors (sorted as the channels passed to the filter), 
+    # shape (channels, height, width//2 + 1), and the filtered half spectrum of the grayscale, both from buffers
     # POST FILTERING
-    filtered_image_frequency_RGB : list
+    filtered_image_frequency_RGB : np.ndarray
     filtered_image_frequency_gray : np.ndarray
 
-    # List of spectra of the magnitude, divided by color and sorted as RGB, logaritmic scale applied 
-    # POST FILTERING
-    filtered_magnitude_spectrum_RGB : list
-    filtered_magnitude_spectrum_gray : np.ndarray
+    # Channels of the last filter applied on the colors, sorted as filtered_image_frequency_RGB
+    filtered_channels : list
+
+    # Masks of the last filters executed in the spatial domain, keyed 'RGB' and None: (channels, mask arguments).
+    # Their filtered spectra are only computed when asked for (see get_filtered_frequency)
+    _deferred_masks : dict
     
     # The actual image filtered as numpy array of shape (height, width, colors(RGB))
-    filtered_image_RGB : np.ndarray
-    filtered_image_gray : np.ndarray
+    # None until a filter has been applied (the properties fall back to the original image)
+    _filtered_image_RGB : np.ndarray
+    _filtered_image_gray : np.ndarray
 
 # 
-#   Initialiazation method -> Defines the class and it's properties and instantiates all the necessary variables for easier access and 
-#   faster computation, avoiding redundancies
+#   Initialiazation method -> Defines the class and it's properties, the image is decoded once and nothing else is 
+#   computed until it is needed: the frequency domain and the magnitude spectrum of each channel are evaluated the first time 
+#   a filter or a display requires them and then cached
 # 
-    def __init__(self, image_path):
+    # An already decoded image (RGB, uint8) can be passed as image, in that case image_path is not read 
+    # (used for downsampled previews and video frames)
+    def __init__(self, image_path, compact=False, backend=None, masks=None, output_dir='', output_prefix='', sink=None, image=None, instrumentation=None, buffers=None, method='auto', planner=None):
         
         self.image_path = image_path
+        self.compact = compact
+        self.backend = get_backend(backend)
+        self.masks = default_library if masks is None else masks
+        self.sink = FileSink(output_dir) if sink is None else sink
+        self.output_prefix = output_prefix
+        self.instrumentation = null_instrumentation if instrumentation is None else instrumentation
+        self.buffers = default_pool if buffers is None else buffers
+        self.method = method
+        self.planner = default_planner if planner is None else planner
+        self.last_plan = None
         
-        # Reading the image 
-        # The image is a matrix in the shape (height, width, colors(BGR)) normally the colors are used as RGB
-        image_pre = cv2.imread(image_path, cv2.IMREAD_COLOR)
-        
-        # Converting the image colors from BGR to RGB
-        self.image = cv2.cvtColor(image_pre, cv2.COLOR_BGR2RGB)
-        self.filtered_image_RGB = cv2.cvtColor(image_pre, cv2.COLOR_BGR2RGB)
-        
-        # Reading the grayscale version
-        self.image_gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        self.filtered_image_gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        with self.instrumentation.span('decode') as span:
+            if image is None:
+                # Reading the image 
+                # The image is a matrix in the shape (height, width, colors(BGR)) normally the colors are used as RGB
+                image_pre = cv2.imread(image_path, cv2.IMREAD_COLOR)
+                
+                # Converting the image colors from BGR to RGB
+                self.image = span.add(cv2.cvtColor(image_pre, cv2.COLOR_BGR2RGB))
+            else:
+                self.image = image
+            
+            # Deriving the grayscale version from the decoded buffer
+            self.image_gray = span.add(cv2.cvtColor(self.image, cv2.COLOR_RGB2GRAY))
         
         self.height, self.width = self.image.shape[0:2]
         self.crow, self.ccol = int(self.height / 2), int(self.width / 2)  # center
         
-        # Declaring the list of frequency domain and magnitude spectrum, it will contain the frequency divided by colors
-        # self.image_frequency_RGB[0] will contain the Red component
-        # self.image_frequency_RGB[1] will contain the Green component
-        # self.image_frequency_RGB[2] will contain the Blue component
-        # self.image_frequency_grascale will contain the grayscale
-        self.image_frequency_RGB = []
-        self.magnitude_spectrum_RGB = []
-        self.filtered_image_frequency_RGB = []
-        self.filtered_magnitude_spectrum_RGB = []
-         
-        # iterating over each color to get it's frequency domain
-        for i in range(self.image.shape[2]):
-            # get the dft of the i-th color with complex output included, this result in a 3D matrix shaped as (height, width, 2)
-            # the matrix [:,:,0] contains the real values whereas [:,:,1] represent the imaginary part
-            pre_shift_image_frequency_RGB = cv2.dft(np.float32(self.image[:,:,i]), flags=cv2.DFT_COMPLEX_OUTPUT)
-            
-            # shift to put 0 frequencies in the center
-            #   
-            #   1  |  2             4  |  3
-            #  ---------    -->    ---------
-            #   3  |  4             2  |  1
-            # 
-            # storing the shifted frequency domain in a class variable
-            self.image_frequency_RGB.append(np.fft.fftshift(pre_shift_image_frequency_RGB))
-            # get the magnitude of the vector defined by real and imaginary part, magnitude is a 2D matrix of shape (height, width)
-            magnitude = cv2.magnitude(self.image_frequency_RGB[i][:, :, 0], self.image_frequency_RGB[i][:, :, 1])
-            # apply log to have a discernible spectrum
-            self.magnitude_spectrum_RGB.append(20 * np.log(magnitude))
-            self.filtered_magnitude_spectrum_RGB.append(20 * np.log(magnitude))
-
-        # get grayscale frequency and generate magnitude spectrum
-        pre_shift_image_frequency_gray = cv2.dft(np.float32(self.image_gray), flags=cv2.DFT_COMPLEX_OUTPUT)
-       
-        # shift to put 0 frequencies in the center
-        #   
-        #   1  |  2             4  |  3
-        #  ---------    -->    ---------
-        #   3  |  4             2  |  1
-        # 
-        # storing the shifted frequency domain in a class variable
-        self.image_frequency_gray = np.fft.fftshift(pre_shift_image_frequency_gray)
-        # get the magnitude of the vector defined by real and imaginary part, magnitude is a 2D matrix of shape (height, width)
-        magnitude = cv2.magnitude(self.image_frequency_gray[:, :, 0], self.image_frequency_gray[:, :, 1])
-        # apply log to have a discernible spectrum
-        self.magnitude_spectrum_gray = 20 * np.log(magnitude)
-        self.filtered_magnitude_spectrum_gray = 20 * np.log(magnitude)
+        # Nothing is transformed yet, caches are filled on demand
+        self._frequency_cache = {}
+        self._spectrum_cache = {}
+        self._filter_versions = {'RGB': 0, None: 0}
+        self.filtered_image_frequency_RGB = None
+        self.filtered_image_frequency_gray = None
+        self.filtered_channels = []
+        self._deferred_masks = {}
+        self._filtered_image_RGB = None
+        self._filtered_image_gray = None
+
+#    
+#   Lazy spectra
+#    
+    # Gets the frequency domain of the three colors as a stack of shape (3, height, width//2 + 1), 
+    # computing all of them in a single batched transform and caching it on first use
+    def get_frequency_RGB(self):
+        if 'RGB' not in self._frequency_cache:
+            # (height, width, colors) -> (colors, height, width) so that each color is a contiguous 2D plane
+            self._frequency_cache['RGB'] = self.transform(np.moveaxis(self.image, -1, 0))
+        return self._frequency_cache['RGB']
+
+    # Gets the frequency domain of a single channel, computing and caching it on first use
+    # accepts 1 argument:
+    #  - channel -> 0 Red, 1 Green, 2 Blue, None grayscale
+    def get_frequency(self, channel):
+        if channel is not None:
+            return self.get_frequency_RGB()[channel]
+        if None not in self._frequency_cache:
+            self._frequency_cache[None] = self.transform(self.image_gray)
+        return self._frequency_cache[None]
+
+    # Gets the filtered frequency domain of a single channel, None if it has been released
+    # accepts 1 argument:
+    #  - channel -> 0 Red, 1 Green, 2 Blue, None grayscale
+    def get_filtered_frequency(self, channel):
+        mode = 'RGB' if channel is not None else None
+        if mode in self._deferred_masks:
+            # the last filter ran in the spatial domain, its spectrum is the one the frequency path would have produced
+            color_channels, arguments = self._deferred_masks[mode]
+            self.apply_mask(color_channels, self.define_circular_mask(*arguments))
+        if channel is None:
+            return self.filtered_image_frequency_gray
+        if self.filtered_image_frequency_RGB is None:
+            return None
+        if channel not in self.filtered_channels:
+            # the colors left out by the last filter are the original ones
+            return self.get_frequency(channel)
+        return self.filtered_image_frequency_RGB[self.filtered_channels.index(channel)]
+
+    # Gets the magnitude spectrum of a channel rendered for display or saving: centered, logaritmic scale applied and normalized 
+    # to uint8. It is computed only at the resolution requested and cached until the next filter
+    # accepts 3 arguments:
+    #  - channel -> 0 Red, 1 Green, 2 Blue, None grayscale
+    #  - size -> (width, height) where the spectrum is going to be shown, the magnitude is reduced with a max pooling 
+    #            (isolated peaks stay visible) to the smallest resolution not below it; None for full resolution
+    #  - filtered -> True for the spectrum of the last filtered image (the original one until a filter is applied)
+    def render_spectrum(self, channel, size=None, filtered=False):
+        factor = 1
+        if size is not None:
+            factor = max(1, min(self.width // max(size[0], 1), self.height // max(size[1], 1)))
+        version = self._filter_versions['RGB' if channel is not None else None] if filtered else 0
+        key = (channel, version, factor)
+        if key not in self._spectrum_cache:
+            if version:
+                frequency = self.get_filtered_frequency(channel)
+                if frequency is None:
+                    raise ValueError('The filtered frequency domain has been released (compact mode), the spectrum is only available along with the filter')
+            else:
+                frequency = self.get_frequency(channel)
+            with self.instrumentation.span('spectrum') as span:
+                magnitude = span.add(self.centered_magnitude(frequency) if factor == 1 else self.pooled_magnitude(frequency, factor))
+                # apply log to have a discernible spectrum (+1 keeps the zeros finite)
+                np.log1p(magnitude, out=magnitude)
+                self._spectrum_cache[key] = span.add(cv2.normalize(magnitude, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U))
+        return self._spectrum_cache[key]
+
+    # Gets the magnitude spectrum of a single channel, see render_spectrum
+    def get_magnitude_spectrum(self, channel, size=None):
+        return self.render_spectrum(channel, size)
+
+    # Gets the filtered magnitude spectrum of a single channel, until a filter is applied it is the original spectrum,
+    # see render_spectrum
+    def get_filtered_magnitude_spectrum(self, channel, size=None):
+        return self.render_spectrum(channel, size, filtered=True)
+
+    # List of the frequency domains sorted as RGB
+    @property
+    def image_frequency_RGB(self):
+        return [self.get_frequency(channel) for channel in range(self.image.shape[2])]
+
+    @property
+    def image_frequency_gray(self):
+        return self.get_frequency(None)
+
+    # List of the magnitude spectra sorted as RGB, full resolution uint8 (see render_spectrum)
+    @property
+    def magnitude_spectrum_RGB(self):
+        return [self.render_spectrum(channel) for channel in range(self.image.shape[2])]
+
+    @property
+    def magnitude_spectrum_gray(self):
+        return self.render_spectrum(None)
+
+    # Filtered results, until a filter is applied they are the original image and spectra
+    @property
+    def filtered_image_RGB(self):
+        return self.image if self._filtered_image_RGB is None else self._filtered_image_RGB
+
+    @filtered_image_RGB.setter
+    def filtered_image_RGB(self, value):
+        self._filtered_image_RGB = value
+
+    @property
+    def filtered_image_gray(self):
+        return self.image_gray if self._filtered_image_gray is None else self._filtered_image_gray
+
+    @filtered_image_gray.setter
+    def filtered_image_gray(self, value):
+        self._filtered_image_gray = value
+
+    # List of the filtered magnitude spectra sorted as the channels of the last filter, full resolution uint8
+    @property
+    def filtered_magnitude_spectrum_RGB(self):
+        if not self._filter_versions['RGB']:
+            return self.magnitude_spectrum_RGB
+        return [self.render_spectrum(channel, filtered=True) for channel in self.filtered_channels]
+
+    @property
+    def filtered_magnitude_spectrum_gray(self):
+        return self.render_spectrum(None, filtered=True)
+
+    # Frees all the intermediates (frequency domains and magnitude spectra of the original and the filtered image), 
+    # the images and the filtered results are kept, anything else will be recomputed on demand if needed again
+    def release(self):
+        self._frequency_cache = {}
+        self._spectrum_cache = {}
+        self._deferred_masks = {}
+        self.buffers.release(self.filtered_image_frequency_RGB)
+        self.buffers.release(self.filtered_image_frequency_gray)
+        self.filtered_image_frequency_RGB = None
+        self.filtered_image_frequency_gray = None
+
 #    
 #   Utility methods
 #    
-    # Generates the (circular) mask to apply, accepts 3 arguments:
+    # Gets the frequency domain of one channel or of a stack of channels (the transform is applied on the last two axes)
+    # accepts 1 argument:
+    #  - matrix -> the spatial domain, real values of shape (..., height, width)
+    def transform(self, matrix):
+        # get the half spectrum of the real input as complex64, shape (..., height, width//2 + 1), 
+        # it is kept as it comes out of the DFT with the 0 frequency in the corner
+        with self.instrumentation.span('forward') as span:
+            return span.add(self.backend.forward(matrix))
+
+    # Gets the rows of a half spectrum in the order they are displayed: the spectrum is never shifted, 
+    # the 0 frequency is moved to the center row by reading the rows in this order
+    #   
+    #   1               3
+    #  ---     -->     ---
+    #   3               1
+    # 
+    def centered_rows(self):
+        return (np.arange(self.height) - self.crow) % self.height
+
+    # Gets the full size magnitude of a half spectrum, centered as the spectrum of the whole image would be, 
+    # the missing half (negative columns) is the mirror of the stored one since the spectrum of a real image 
+    # is symmetric with respect to the origin
+    # accepts 1 argument:
+    #  - matrix -> half spectrum of a single channel, shape (height, width//2 + 1)
+    def centered_magnitude(self, matrix):
+        half_magnitude = np.abs(matrix)
+        magnitude = np.empty((self.height, self.width), np.float32)
+        # right side: columns from the 0 frequency onwards, rows centered
+        magnitude[:, self.ccol:] = half_magnitude[self.centered_rows(), :self.width - self.ccol]
+        # left side: the magnitude at (-row, -col) is the same as the one at (row, col)
+        mirrored_rows = (self.crow - np.arange(self.height)) % self.height
+        mirrored_cols = self.ccol - np.arange(self.ccol)
+        magnitude[:, :self.ccol] = half_magnitude[mirrored_rows][:, mirrored_cols]
+        return magnitude
+
+    # Gets the centered magnitude of a half spectrum reduced by an integer factor, each element is the maximum of a 
+    # factor x factor block, the full size magnitude is never built: the half spectrum is pooled a few rows at a time 
+    # and the missing half is the point reflection of the pooled one
+    # accepts 2 arguments:
+    #  - matrix -> half spectrum of a single channel, shape (height, width//2 + 1)
+    #  - factor -> reduction factor
+    def pooled_magnitude(self, matrix, factor):
+        pooled_rows = -(-matrix.shape[0] // factor)
+        pooled_cols = -(-matrix.shape[1] // factor)
+        pooled = np.empty((pooled_rows, pooled_cols), np.float32)
+        centered_rows = self.centered_rows()
+        step = factor * 64
+        for top in range(0, matrix.shape[0], step):
+            # the rows of the block are read in display order (centered)
+            block = np.abs(matrix.take(centered_rows[top:top + step], axis=0))
+            rows = -(-block.shape[0] // factor)
+            # the magnitude is never negative, padding with 0s does not change the maximum
+            block = np.pad(block, ((0, rows * factor - block.shape[0]), (0, pooled_cols * factor - block.shape[1])))
+            pooled[top // factor:top // factor + rows] = block.reshape(rows, factor, pooled_cols, factor).max(axis=(1, 3))
+        # left side: the magnitude at (-row, -col) is the same as the one at (row, col), the 0 frequency column is not repeated
+        return np.concatenate((pooled[::-1, :0:-1], pooled), axis=1)
+
+    # Generates the (circular) mask to apply on the half spectrum, accepts 4 arguments:
     #  - radius -> radius of the mask shape, 
     #  - intensity -> indicates the scaling factor to apply to the parts selected by the mask
     #  - direction -> 0: all the elements inside the circular area are 0s(hpf), Note: the values are not actual 0s but a close approximation to avoid DivideByZero error
     #             1: all elements inside the circular area are 1s(lpf) 
-    def define_circular_mask(self, radius: float, intensity: float, direction: int):
-        # Circular HPF mask, center circle is 0, remaining all ones
-        mask = np.ones((self.height, self.width, 2), np.float64)
-        center = [self.crow, self.ccol]
-        x, y = np.ogrid[:self.height, :self.width]
-        #  Mask area is a matrix of boolean, defining to which frequencies the filter will be applied to
-        if direction:
-            #               This is the formula of a circle         this one means everything OUTSIDE the circle
-            mask_area = (x - center[0]) ** 2 + (y - center[1]) ** 2 > radius*radius
+    #  - profile -> 'circle' hard edge, 'gaussian' or 'butterworth' smooth transition around the radius (no ringing)
+    # The mask is float32 and shaped (height, width//2 + 1) so that multiplying it with the spectrum keeps single precision,
+    # it comes from the shared MaskLibrary cache and is read only
+    def define_circular_mask(self, radius: float, intensity: float, direction: int, profile: str = 'circle'):
+        with self.instrumentation.span('mask'):
+            # the mask is shared by the library, it is not counted as allocated by the stage
+            return self.masks.get_mask((self.height, self.width), radius, intensity, direction, profile)
+
+    # Gets the buffer of a filtered spectrum: the current one when it has the right shape and dtype,
+    # otherwise the current one goes back to the pool and another one is taken from it
+    # accepts 3 arguments:
+    #  - current -> the buffer of the previous filter, None if there is none
+    #  - shape, dtype -> of the filtered spectrum
+    def spectrum_buffer(self, current, shape, dtype):
+        if current is not None and current.shape == shape and current.dtype == dtype:
+            return current
+        self.buffers.release(current)
+        return self.buffers.acquire(shape, dtype)
+
+    # Multiplies the mask with the frequency domain of the selected channels and stores the filtered frequency domain,
+    # the product is written in place into the buffer of the filtered spectrum (see spectrum_buffer)
+    # accepts 2 arguments:
+    #  - color_channels -> list of the channels to filter, [] for the grayscale image
+    #  - mask -> the mask to apply, as returned by define_circular_mask
+    def apply_mask(self, color_channels, mask):
+        self._deferred_masks.pop('RGB' if len(color_channels) else None, None)
+        if len(color_channels):
+            self.filtered_channels = list(color_channels)
+            frequency = self.get_frequency_RGB()
+            shape = (len(color_channels),) + frequency.shape[1:]
+            self.filtered_image_frequency_RGB = self.spectrum_buffer(self.filtered_image_frequency_RGB, shape, frequency.dtype)
+            with self.instrumentation.span('multiply'):
+                for index, channel in enumerate(color_channels):
+                    np.multiply(frequency[channel], mask, out=self.filtered_image_frequency_RGB[index])
         else:
-            #               This is the formula of a circle         this one means everything INSIDE the circle
-            mask_area = (x - center[0]) ** 2 + (y - center[1]) ** 2 <= radius*radius
-        
-        mask[mask_area] = intensity
-        return mask
+            frequency = self.get_frequency(None)
+            self.filtered_image_frequency_gray = self.spectrum_buffer(self.filtered_image_frequency_gray, frequency.shape, frequency.dtype)
+            with self.instrumentation.span('multiply'):
+                np.multiply(frequency, mask, out=self.filtered_image_frequency_gray)
 
     # Gets back the resulting image from the frequency domain to the spatial domain
     # accepts 1 argument:
-    #  - matrix -> the frequency domain version of a single channel of the image (2D np.array) 
+    #  - matrix -> the frequency domain version of a single channel of the image, or a stack of channels (np.array) 
     def recompose_image(self, matrix):
-        unshifted_frequency = np.fft.ifftshift(matrix)
-        image_back = cv2.idft(unshifted_frequency, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
-
-        return image_back
+        with self.instrumentation.span('inverse') as span:
+            return span.add(self.backend.inverse(matrix, (self.height, self.width)))
     
     # Take the filtered frequency domain and generates magnitude spectrum and resulting image of the filtering
-    # takes 1 argument:
+    # takes 2 arguments:
     #  - color_channels -> list of int where:
     #                            0 coresponds to the Red channel
     #                            1 coresponds to the Green channel
     #                            2 coresponds to the Blue channel
     #                            [] empty list indicates a grayscale image  
-    def get_image_back(self, color_channels):
+    #  - spectrum -> when True the full resolution magnitude spectrum is rendered now, otherwise on first access 
+    #                at the resolution requested (in compact mode it won't be available anymore)
+    def get_image_back(self, color_channels, spectrum=True):
+        self.new_filter_version(color_channels, spectrum)
+
         if(len(color_channels)):
-        # apply mask and inverse DFT on each of the selected colors
-            self.filtered_magnitude_spectrum_RGB = []
-            for channel in color_channels: 
-                magnitude = cv2.magnitude(self.filtered_image_frequency_RGB[channel][:, :, 0], self.filtered_image_frequency_RGB[channel][:, :, 1])
-                self.filtered_magnitude_spectrum_RGB.append(20 * np.log(magnitude))
-                self.filtered_image_RGB[:, :, channel] = self.recompose_image(self.filtered_image_frequency_RGB[channel])
+            # the filtered image is a copy of the original until the first filter writes into it
+            if self._filtered_image_RGB is None:
+                self._filtered_image_RGB = self.image.copy()
+            # inverse DFT of all the selected colors in a single batched call
+            image_back = self.recompose_image(self.filtered_image_frequency_RGB)
+            # saturated to the range of the uint8 image, the values out of it would wrap around
+            np.clip(image_back, 0, 255, out=image_back)
+            self.filtered_image_RGB[:, :, color_channels] = np.moveaxis(image_back, 0, -1)
+            if self.compact:
+                self.buffers.release(self.filtered_image_frequency_RGB)
+                self.filtered_image_frequency_RGB = None
                 
         else:
-            magnitude = cv2.magnitude(self.filtered_image_frequency_gray[:, :, 0], self.filtered_image_frequency_gray[:, :, 1])
-            self.filtered_magnitude_spectrum_gray = 20 * np.log(magnitude)
             self.filtered_image_gray = self.recompose_image(self.filtered_image_frequency_gray)
+            if self.compact:
+                self.buffers.release(self.filtered_image_frequency_gray)
+                self.filtered_image_frequency_gray = None
+
+    # Starts a new filter state, the spectra rendered for the previous one are dropped
+    # accepts 2 arguments, see get_image_back
+    def new_filter_version(self, color_channels, spectrum):
+        mode = 'RGB' if len(color_channels) else None
+        self._filter_versions[mode] += 1
+        self._spectrum_cache = {key: value for key, value in self._spectrum_cache.items() 
+                                if key[1] == 0 or (key[0] is not None) != (mode is not None)}
+        if spectrum:
+            for channel in (color_channels if len(color_channels) else [None]):
+                self.render_spectrum(channel, filtered=True)
+
+    # Convolves an image with the spatial kernels of a plan (see FilterPlanner.Plan), the borders wrap around 
+    # as they do for the DFT, returns the float32 result
+    # accepts 2 arguments:
+    #  - source -> uint8 image of shape (height, width) or (height, width, channels)
+    #  - plan -> a spatial plan
+    def convolve(self, source, plan):
+        if plan.kernel is not None:
+            rows, cols = plan.kernel.shape
+        elif plan.kernel_y is not None:
+            rows, cols = len(plan.kernel_y), len(plan.kernel_x)
+        else:
+            # constant mask
+            return cv2.multiply(source, plan.identity, dtype=cv2.CV_32F)
+        top, left = rows // 2, cols // 2
+        padded = cv2.copyMakeBorder(source, top, top, left, left, cv2.BORDER_WRAP)
+        if plan.kernel is not None:
+            filtered = cv2.filter2D(padded, cv2.CV_32F, plan.kernel)
+        else:
+            filtered = cv2.sepFilter2D(padded, cv2.CV_32F, plan.kernel_x, plan.kernel_y)
+        filtered = filtered[top:top + self.height, left:left + self.width]
+        if plan.identity:
+            return cv2.addWeighted(source, plan.identity, filtered, 1, 0, dtype=cv2.CV_32F)
+        return np.ascontiguousarray(filtered)
+
+    # Executes a filter in the spatial domain and stores the filtered image, the filtered spectrum is computed only 
+    # when asked for, from the mask (see get_filtered_frequency)
+    # accepts 4 arguments:
+    #  - color_channels -> list of the channels to filter, [] for the grayscale image
+    #  - plan -> a spatial plan (see FilterPlanner)
+    #  - arguments -> arguments of define_circular_mask of the filter
+    #  - spectrum -> see get_image_back
+    def spatial_image_back(self, color_channels, plan, arguments, spectrum=True):
+        mode = 'RGB' if len(color_channels) else None
+        if len(color_channels):
+            self.filtered_channels = list(color_channels)
+        self._deferred_masks[mode] = (list(color_channels), arguments)
+        self.new_filter_version(color_channels, spectrum)
+
+        with self.instrumentation.span('spatial') as span:
+            if len(color_channels):
+                if self._filtered_image_RGB is None:
+                    self._filtered_image_RGB = self.image.copy()
+                all_channels = list(color_channels) == list(range(self.image.shape[2]))
+                filtered = span.add(self.convolve(self.image if all_channels else self.image[:, :, color_channels], plan))
+                np.clip(filtered, 0, 255, out=filtered)
+                self.filtered_image_RGB[:, :, color_channels] = filtered.reshape(self.height, self.width, -1)
+            else:
+                self.filtered_image_gray = span.add(self.convolve(self.image_gray, plan))
+
+    # Applies a filter with the method chosen by the planner and hands the results to the sink
+    # accepts 3 arguments:
+    #  - name -> name of the filter in RESULT_FILES
+    #  - color_channels -> list of the channels to filter, [] for the grayscale image
+    #  - arguments -> (radius, intensity, direction, profile) of the mask, see define_circular_mask
+    # returns the filtered image
+    def run_planned(self, name, color_channels, arguments):
+        mode = 'RGB' if len(color_channels) else None
+        spectrum = self.sink.wants('spectrum')
+        self.last_plan = self.planner.plan((self.height, self.width), len(color_channels) or 1, *arguments, method=self.method,
+                                           backend=getattr(self.backend, 'name', None), forward_cached=mode in self._frequency_cache,
+                                           spectrum=spectrum)
+        if self.last_plan.method == 'frequency':
+            return self.run_filter(name, color_channels, self.define_circular_mask(*arguments))
+        self.spatial_image_back(color_channels, self.last_plan, arguments, spectrum)
+        self.save_results(name, color_channels)
+        return self.filtered_image_RGB if len(color_channels) else self.filtered_image_gray
+
+    # Gets the arguments of the mask of the custom filter (see define_circular_mask), the arguments are the same of custom_filter
+    def custom_arguments(self, radius, intensity, direction, profile='circle'):
+        # convert percentage in intensity multiplication factor
+        intensity = (100-intensity)/100
+        #  convert percentage in actual lenght of the radius
+        radius = (self.width/2)*(radius/100)
+        return radius, intensity, direction, profile
+
+    # Gets the mask of the custom filter, the arguments are the same of custom_filter
+    def custom_mask(self, radius, intensity, direction, profile='circle'):
+        return self.define_circular_mask(*self.custom_arguments(radius, intensity, direction, profile))
+
+    # Parameters of the masks of the presets: radius (evaluated on the image), intensity and direction
+    PRESETS = {
+        'sharpening': (lambda image: image.width/20, .5, 0),
+        'blurring': (lambda image: image.ccol/15, .3, 1),
+        'edge_detection': (lambda image: 30, 0.00000001, 0),
+        'noise_filtering': (lambda image: 50, 0.0000001, 1),
+    }
+
+    # Gets the arguments of the mask of a preset (see define_circular_mask), accepts 2 arguments:
+    #  - name -> one of the PRESETS
+    #  - profile -> shape of the mask, 'circle', 'gaussian' or 'butterworth'
+    def preset_arguments(self, name, profile='circle'):
+        if name not in self.PRESETS:
+            raise ValueError(f"Unknown preset '{name}', available presets: {', '.join(self.PRESETS)}")
+        radius, intensity, direction = self.PRESETS[name]
+        return radius(self), intensity, direction, profile
+
+    # Gets the mask of a preset, the arguments are the same of preset_arguments
+    def preset_mask(self, name, profile='circle'):
+        return self.define_circular_mask(*self.preset_arguments(name, profile))
+
+    # Gets the mask of a single step of a pipeline, accepts 1 argument:
+    #  - step -> name of a preset, e.g. 'noise_filtering'
+    #            or a dictionary {'filter': name of a preset, 'profile': profile}
+    #            or a dictionary with the arguments of custom_filter {'radius': .., 'intensity': .., 'direction': .., 'profile': ..}
+    def step_mask(self, step):
+        if isinstance(step, str):
+            return self.preset_mask(step)
+        if 'filter' in step:
+            return self.preset_mask(step['filter'], step.get('profile', 'circle'))
+        return self.custom_mask(step['radius'], step['intensity'], step['direction'], step.get('profile', 'circle'))
+
+    # Applies an ordered list of filters at once: their masks are multiplied into a single one, 
+    # so the whole chain costs one mask multiplication and one inverse DFT per channel.
+    # Each call starts from the original image, the results of previous filters are not filtered again.
+    # accepts 3 arguments:
+    #  - color_channels -> list of the channels to filter, [] for the grayscale image
+    #  - steps -> list of filters, see step_mask, e.g. ['noise_filtering', 'sharpening']
+    #  - spectrum -> when True the full resolution filtered magnitude spectrum is rendered along with the image, 
+    #                otherwise only on first access
+    # returns the filtered image
+    def pipeline(self, color_channels, steps, spectrum=False):
+        if not len(steps):
+            raise ValueError('The pipeline needs at least one filter')
+        mask = self.step_mask(steps[0])
+        composite = None
+        if len(steps) > 1:
+            # the masks from the library are read only, the composite one is written into a buffer of the pool
+            composite = self.buffers.acquire(mask.shape, mask.dtype)
+            np.multiply(mask, self.step_mask(steps[1]), out=composite)
+            for step in steps[2:]:
+                composite *= self.step_mask(step)
+            mask = composite
+        self.apply_mask(color_channels, mask)
+        self.buffers.release(composite)
+        self.get_image_back(color_channels, spectrum)
+        return self.filtered_image_RGB if len(color_channels) else self.filtered_image_gray
+
+    # Files written by the filters through the sink, for the colors and for the grayscale:
+    # (filtered image, filtered spectrum, extra files) where the extras are (file name, kind, attribute of the original)
+    RESULT_FILES = {
+        'custom': {
+            'RGB': ('sharp_RGB.jpeg', 'sharp_freq_RGB.jpeg', ()),
+            'gray': ('sharp_gray.jpeg', 'sharp_freq_gray.jpeg', (('image4_freq_gray.jpeg', 'spectrum', 'magnitude_spectrum_gray'),)),
+        },
+        'sharpening': {
+            'RGB': ('sharp_RGB.jpeg', 'sharp_freq_RGB.jpeg', ()),
+            'gray': ('sharp_gray.jpeg', 'sharp_freq_gray.jpeg', (('image4_freq_gray.jpeg', 'spectrum', 'magnitude_spectrum_gray'),)),
+        },
+        'blurring': {
+            'RGB': ('blur_RGB.jpeg', 'blur_freq_RGB.png', ()),
+            'gray': ('blur_gray.jpeg', 'blur_freq_gray.jpeg', (('image4_freq_gray.jpeg', 'spectrum', 'magnitude_spectrum_gray'),)),
+        },
+        'edge_detection': {
+            'RGB': ('edge_RGB.jpeg', 'edge_freq_RGB.jpeg', (('image4_freq_gray.jpeg', 'spectrum', 'magnitude_spectrum_gray'), ('image4_gray.jpeg', 'image', 'image_gray'))),
+            'gray': ('edge_gray.jpeg', 'edge_freq_gray.jpeg', ()),
+        },
+        'noise_filtering': {
+            'RGB': ('noise_RGB.jpeg', 'noise_freq_RGB.jpeg', ()),
+            'gray': ('noise_gray.jpeg', 'noise_freq_gray.jpeg', ()),
+        },
+    }
+
+    # Hands a result to the sink, prefixing its name with output_prefix
+    # accepts 3 arguments:
+    #  - name -> name of the result file, e.g. 'sharp_RGB.jpeg'
+    #  - array -> the result, it must not be modified afterwards since the sink may write it later
+    #  - artifact -> 'image' or 'spectrum'
+    def save(self, name, array, artifact='image'):
+        # with an AsyncSink the span only measures the hand over, the encoding happens in its thread
+        with self.instrumentation.span('write'):
+            self.sink.write(self.output_prefix + name, array, artifact)
+
+    # Hands the results of a filter to the sink, only the kinds of results the sink wants are computed
+    # accepts 2 arguments:
+    #  - name -> name of the filter in RESULT_FILES
+    #  - color_channels -> list of the filtered channels, [] for the grayscale image
+    def save_results(self, name, color_channels):
+        image_name, spectrum_name, extras = self.RESULT_FILES[name]['RGB' if len(color_channels) else 'gray']
+        if self.sink.wants('image'):
+            if len(color_channels):
+                self.save(image_name, cv2.cvtColor(self.filtered_image_RGB, cv2.COLOR_RGB2BGR))
+            else:
+                self.save(image_name, self.filtered_image_gray)
+        if self.sink.wants('spectrum'):
+            if len(color_channels):
+                self.save(spectrum_name, self.filtered_magnitude_spectrum_RGB[0], 'spectrum')
+            else:
+                self.save(spectrum_name, self.filtered_magnitude_spectrum_gray, 'spectrum')
+        for extra_name, artifact, attribute in extras:
+            if self.sink.wants(artifact):
+                self.save(extra_name, getattr(self, attribute), artifact)
+
+    # Applies a mask, recomposes the filtered image and hands the results to the sink
+    # accepts 3 arguments:
+    #  - name -> name of the filter in RESULT_FILES
+    #  - color_channels -> list of the channels to filter, [] for the grayscale image
+    #  - mask -> the mask to apply
+    # returns the filtered image
+    def run_filter(self, name, color_channels, mask):
+        self.apply_mask(color_channels, mask)
+        # the spectrum is computed only if it is going to be written
+        self.get_image_back(color_channels, self.sink.wants('spectrum'))
+        self.save_results(name, color_channels)
+        return self.filtered_image_RGB if len(color_channels) else self.filtered_image_gray
 
     # Custom filter to manually tune the variables:
     #  - channels -> which channels are involved
@@ -176,91 +640,27 @@ class ImageProcessing:
     #                 0% values are not modified so the mask will multiply by 1,
     #                 100% values are multiplied by 0
     #  - direction -> 0 HPF, 1 LPF 
-    def custom_filter(self, channels, radius, intensity, direction):
-        # convert percentage in intensity multiplication factor
-        intensity = (100-intensity)/100
-        #  convert percentage in actual lenght of the radius
-        radius = (self.width/2)*(radius/100)
-        mask = self.define_circular_mask(radius, intensity, direction)
-        if len(channels):
-            self.filtered_image_frequency_RGB = []
-            for channel in channels: 
-                self.filtered_image_frequency_RGB.append(self.image_frequency_RGB[channel] * mask)
-            self.get_image_back(channels)
-            cv2.imwrite('sharp_RGB.jpeg', cv2.cvtColor(self.filtered_image_RGB, cv2.COLOR_RGB2BGR))
-            cv2.imwrite('sharp_freq_RGB.jpeg', self.filtered_magnitude_spectrum_RGB[0])
-        else:
-            self.filtered_image_frequency_gray = self.image_frequency_gray * mask
-            self.get_image_back(channels)
-            cv2.imwrite('sharp_gray.jpeg', self.filtered_image_gray)
-            cv2.imwrite('sharp_freq_gray.jpeg', self.filtered_magnitude_spectrum_gray)
-            cv2.imwrite('image4_freq_gray.jpeg',self.magnitude_spectrum_gray)
+    #  - profile -> shape of the mask, 'circle', 'gaussian' or 'butterworth'
+    # returns the filtered image
+    def custom_filter(self, channels, radius, intensity, direction, profile='circle'):
+        return self.run_planned('custom', channels, self.custom_arguments(radius, intensity, direction, profile))
 
-    # Sharpening with High Pass Filter
-    def sharpening(self, color_channels):
-        # Circular HPF mask, center circle is 0, remaining all ones
-        mask = self.define_circular_mask(self.width/20, .5, 0)
-        if len(color_channels):
-            for channel in color_channels: 
-                self.filtered_image_frequency_RGB.append(self.image_frequency_RGB[channel] * mask)
-            self.get_image_back(color_channels)
-            cv2.imwrite('sharp_RGB.jpeg', cv2.cvtColor(self.filtered_image_RGB, cv2.COLOR_RGB2BGR))
-            cv2.imwrite('sharp_freq_RGB.jpeg', self.filtered_magnitude_spectrum_RGB[0])
-        else:
-            self.filtered_image_frequency_gray = self.image_frequency_gray * mask
-            self.get_image_back(color_channels)
-            cv2.imwrite('sharp_gray.jpeg', self.filtered_image_gray)
-            cv2.imwrite('sharp_freq_gray.jpeg', self.filtered_magnitude_spectrum_gray)
-            cv2.imwrite('image4_freq_gray.jpeg',self.magnitude_spectrum_gray)
+    # Presets, each one accepts the list of channels ([] for grayscale) and the profile of the mask, 
+    # the smooth profiles ('gaussian', 'butterworth') avoid the ringing of the ideal 'circle' one,
+    # and returns the filtered image. As custom_filter they are executed with the method chosen by the planner
 
+    # Sharpening with High Pass Filter
+    def sharpening(self, color_channels, profile='circle'):
+        return self.run_planned('sharpening', color_channels, self.preset_arguments('sharpening', profile))
 
     # Blurring with Low Pass Filter
-    def blurring(self, color_channels):
-        # Circular HPF mask, center circle is 0, remaining all ones
-        mask = self.define_circular_mask(self.ccol/15, .3, 1)
-        if len(color_channels):
-            for channel in color_channels: 
-                self.filtered_image_frequency_RGB.append(self.image_frequency_RGB[channel] * mask)
-            self.get_image_back(color_channels)
-            cv2.imwrite('blur_RGB.jpeg', cv2.cvtColor(self.filtered_image_RGB,cv2.COLOR_RGB2BGR))
-            cv2.imwrite('blur_freq_RGB.png', self.filtered_magnitude_spectrum_RGB[0])
-        else:
-            self.filtered_image_frequency_gray = self.image_frequency_gray * mask
-            self.get_image_back(color_channels)
-            cv2.imwrite('blur_gray.jpeg', self.filtered_image_gray)
-            cv2.imwrite('blur_freq_gray.jpeg', self.filtered_magnitude_spectrum_gray)
-            cv2.imwrite('image4_freq_gray.jpeg',self.magnitude_spectrum_gray)
+    def blurring(self, color_channels, profile='circle'):
+        return self.run_planned('blurring', color_channels, self.preset_arguments('blurring', profile))
 
     # Edge Detection with High Pass Filter
-    def edge_detection(self, color_channels):
-        # Circular HPF mask, center circle is 0, remaining all ones
-        mask = self.define_circular_mask(30, 0.00000001, 0)
-        if len(color_channels):
-            for channel in color_channels: 
-                self.filtered_image_frequency_RGB.append(self.image_frequency_RGB[channel] * mask)
-            self.get_image_back(color_channels)
-            cv2.imwrite('edge_RGB.jpeg', cv2.cvtColor(self.filtered_image_RGB,cv2.COLOR_RGB2BGR))
-            cv2.imwrite('edge_freq_RGB.jpeg', self.filtered_magnitude_spectrum_RGB[0])
-            cv2.imwrite('image4_freq_gray.jpeg',self.magnitude_spectrum_gray)
-            cv2.imwrite('image4_gray.jpeg', self.image_gray)
-        else:
-            self.filtered_image_frequency_gray = self.image_frequency_gray * mask
-            self.get_image_back(color_channels)
-            cv2.imwrite('edge_gray.jpeg', self.filtered_image_gray)
-            cv2.imwrite('edge_freq_gray.jpeg', self.filtered_magnitude_spectrum_gray)
+    def edge_detection(self, color_channels, profile='circle'):
+        return self.run_planned('edge_detection', color_channels, self.preset_arguments('edge_detection', profile))
 
     # noise filtering with Low Pass Filter
-    def noise_filtering(self, color_channels):
-        # Circular HPF mask, center circle is 0, remaining all ones
-        mask = self.define_circular_mask(50, 0.0000001, 1)
-        if len(color_channels):
-            for channel in color_channels: 
-                self.filtered_image_frequency_RGB.append(self.image_frequency_RGB[channel] * mask)
-            self.get_image_back(color_channels)
-            cv2.imwrite('noise_RGB.jpeg', cv2.cvtColor(self.filtered_image_RGB,cv2.COLOR_RGB2BGR))
-            cv2.imwrite('noise_freq_RGB.jpeg', self.filtered_magnitude_spectrum_RGB[0])
-        else:
-            self.filtered_image_frequency_gray = self.image_frequency_gray * mask
-            self.get_image_back(color_channels)
-            cv2.imwrite('noise_gray.jpeg', self.filtered_image_gray)
-            cv2.imwrite('noise_freq_gray.jpeg', self.filtered_magnitude_spectrum_gray)
\ No newline at end of file
+    def noise_filtering(self, color_channels, profile='circle'):
+        return self.run_planned('noise_filtering', color_channels, self.preset_arguments('noise_filtering', profile))
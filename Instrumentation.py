@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+
+
+# Instrumentation of the stages of ImageProcessing, opt in: an ImageProcessing created without one uses
+# null_instrumentation, whose spans do nothing (a method call and an empty with block per stage).
+# Each stage runs inside a named span measuring its wall time, the arrays it produces are added to the span to count
+# the bytes allocated by the stage:
+#
+#   with self.instrumentation.span('forward') as span:
+#       frequency = span.add(self.backend.forward(matrix))
+#
+# Stages of ImageProcessing:
+#  - 'decode' -> imread and color conversions
+#  - 'forward' -> forward DFT (transform)
+#  - 'mask' -> mask from the library (define_circular_mask, free when cached)
+#  - 'multiply' -> product of the mask and the spectrum (apply_mask), in place into a reused buffer
+#  - 'inverse' -> inverse DFT (recompose_image)
+#  - 'spatial' -> convolution with the spatial kernel of the mask, instead of the three stages above when the
+#                 FilterPlanner chooses it
+#  - 'spectrum' -> log-magnitude rendering (render_spectrum)
+#  - 'write' -> hand over to the sink (save), with an AsyncSink it only measures the enqueue, not the encoding
+# Every finished span is a record {'stage', 'seconds', 'bytes', 'labels'} passed to the exporters, and it is
+# aggregated in the breakdown of the instrumentation.
+
+
+# Span doing nothing, shared by all the stages when the instrumentation is disabled
+class NullSpan:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def add(self, array):
+        return array
+
+
+_null_span = NullSpan()
+
+
+# Instrumentation discarding everything, the default of ImageProcessing
+class NullInstrumentation:
+
+    enabled = False
+
+    def span(self, name):
+        return _null_span
+
+    def record(self, name, seconds, allocated=0):
+        pass
+
+    def breakdown(self):
+        return {}
+
+    def reset(self):
+        pass
+
+
+null_instrumentation = NullInstrumentation()
+
+
+# Timing of a stage, created by Instrumentation.span
+class Span:
+
+    __slots__ = ('instrumentation', 'name', 'bytes', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start, self.bytes)
+        return False
+
+    # Counts the bytes of an array produced by the stage, returns the array
+    def add(self, array):
+        self.bytes += getattr(array, 'nbytes', 0)
+        return array
+
+
+# Collects the spans of one or more ImageProcessing (it can be shared between threads)
+class Instrumentation:
+
+    enabled = True
+
+    # Objects receiving every record through export(record)
+    exporters : list
+
+    # Labels added to every record, e.g. {'image': 'scan_01.jpeg'}
+    labels : dict
+
+    # Totals by stage since the last reset: {stage: {'seconds', 'bytes', 'calls'}}
+    _totals : dict
+
+    def __init__(self, exporters=(), labels=None):
+        self.exporters = list(exporters)
+        self.labels = dict(labels or {})
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    # Gets a span measuring the stage of the given name, to use as context manager
+    def span(self, name):
+        return Span(self, name)
+
+    # Records a finished stage, accepts 3 arguments:
+    #  - name -> name of the stage
+    #  - seconds -> wall time of the stage
+    #  - allocated -> bytes of the arrays produced by the stage
+    def record(self, name, seconds, allocated=0):
+        with self._lock:
+            totals = self._totals.setdefault(name, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['bytes'] += allocated
+            totals['calls'] += 1
+        record = {'stage': name, 'seconds': seconds, 'bytes': allocated, 'labels': self.labels}
+        for exporter in self.exporters:
+            exporter.export(record)
+
+    # Gets a copy of the totals by stage, in the order the stages first ran
+    def breakdown(self):
+        with self._lock:
+            return {name: dict(totals) for name, totals in self._totals.items()}
+
+    # Forgets the totals, e.g. before measuring a new filter
+    def reset(self):
+        with self._lock:
+            self._totals = {}
+
+
+# Exporter calling a function with every record
+class CallbackExporter:
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def export(self, record):
+        self.callback(record)
+
+
+# Exporter appending every record as a line of JSON to a file, with the time it was recorded
+class JSONLinesExporter:
+
+    # File of the records, opened in append mode
+    path : str
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, record):
+        line = json.dumps(dict(record, time=time.time())) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# Exporter accumulating the records as counters in the Prometheus text format:
+#
+#   imageprocessing_stage_seconds_total{stage="forward"} 0.0421
+#   imageprocessing_stage_bytes_total{stage="forward"} 25165824
+#   imageprocessing_stage_calls_total{stage="forward"} 3
+class PrometheusExporter:
+
+    METRICS = (('seconds', 'Wall time spent in the stage'), ('bytes', 'Bytes of the arrays produced by the stage'),
+               ('calls', 'Number of times the stage ran'))
+
+    def __init__(self, prefix='imageprocessing_stage'):
+        self.prefix = prefix
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        # the labels of the records are kept along with the stage, they become labels of the counters
+        key = (record['stage'],) + tuple(sorted((str(name), str(value)) for name, value in record['labels'].items()))
+        with self._lock:
+            totals = self._totals.setdefault(key, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+            totals['seconds'] += record['seconds']
+            totals['bytes'] += record['bytes']
+            totals['calls'] += 1
+
+    # Gets the text dump of the counters
+    def render(self):
+        with self._lock:
+            totals = {key: dict(values) for key, values in self._totals.items()}
+        lines = []
+        for metric, description in self.METRICS:
+            name = f'{self.prefix}_{metric}_total'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            for (stage, *labels), values in totals.items():
+                text = ','.join(f'{label}="{escape(value)}"' for label, value in [('stage', stage)] + labels)
+                lines.append(f'{name}{{{text}}} {values[metric]:.9g}' if metric == 'seconds' else f'{name}{{{text}}} {values[metric]}')
+        return '\n'.join(lines) + '\n'
+
+    # Writes the text dump to a file (e.g. read by the textfile collector of node_exporter)
+    def write(self, path):
+        with open(path, 'w') as file:
+            file.write(self.render())
+
+
+# Escapes a label value of the Prometheus text format
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Gets a one line description of a breakdown, e.g. "forward 12.1 ms 24.0 MB, multiply 3.2 ms 24.0 MB"
+def format_breakdown(breakdown):
+    return ', '.join(f"{name} {totals['seconds'] * 1000:.1f} ms {totals['bytes'] / 2**20:.1f} MB" for name, totals in breakdown.items())
@@ -0,0 +1,165 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# Profiles of the masks:
+#  - 'circle' -> ideal filter, hard edge on the circumference (the original behaviour, rings in the spatial domain)
+#  - 'gaussian' -> smooth transition, the dampening grows as a gaussian of the distance from the center
+#  - 'butterworth' -> flat inside the radius and steep around it, the steepness is set by the order
+PROFILES = ('circle', 'gaussian', 'butterworth')
+
+
+# Library of the masks applied on the half spectra (see ImageProcessing.define_circular_mask).
+# The masks are in the layout of the spectra as they come out of the DFT, with the 0 frequency in the corner
+# (row 0, column 0) and the negative frequencies in the bottom rows, so that neither the spectra nor the masks
+# are ever shifted: only the displayed magnitude spectra are centered.
+# The squared distance of every frequency from the center only depends on the shape of the image, so it is computed once
+# per shape and reused for every mask, the masks themselves are kept in a LRU cache bounded in memory so that applying
+# the same filter on images of the same size (or moving a slider back and forth) does not allocate a new mask.
+# The cached masks are shared, they are returned read only.
+class MaskLibrary:
+
+    # Maximum memory (bytes) used by the cached masks, the least recently used are dropped when exceeded
+    max_bytes : int
+
+    # Maximum number of distance fields kept (one per image shape)
+    max_shapes : int
+
+    # Cache of the squared distance fields keyed by (height, width) and of the masks keyed by
+    # (shape, radius, intensity, direction, profile, order), both sorted from the least to the most recently used
+    _distances : OrderedDict
+    _masks : OrderedDict
+    _masks_bytes : int
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_shapes=4):
+        self.max_bytes = max_bytes
+        self.max_shapes = max_shapes
+        self._distances = OrderedDict()
+        self._masks = OrderedDict()
+        self._masks_bytes = 0
+        self._lock = threading.Lock()
+
+    # Gets the squared distance from the 0 frequency of every element of the half spectrum of an image,
+    # shape (height, width//2 + 1): row r stands for the frequency r up to height/2 and r - height after it
+    # (np.fft.fftfreq), the columns are the non negative frequencies
+    # accepts 1 argument:
+    #  - shape -> (height, width) of the image
+    def distance_field(self, shape):
+        with self._lock:
+            if shape in self._distances:
+                self._distances.move_to_end(shape)
+                return self._distances[shape]
+        height, width = shape
+        rows = (np.fft.fftfreq(height) * height)[:, None]
+        cols = np.arange(width // 2 + 1)[None, :]
+        distance = (rows ** 2 + cols ** 2).astype(np.float32)
+        distance.flags.writeable = False
+        with self._lock:
+            self._distances[shape] = distance
+            while len(self._distances) > self.max_shapes:
+                self._distances.popitem(last=False)
+        return distance
+
+    # Gets the mask to apply on the half spectrum, accepts 6 arguments:
+    #  - shape -> (height, width) of the image
+    #  - radius -> radius of the mask shape (for the smooth profiles the distance where the transition happens)
+    #  - intensity -> scaling factor applied to the frequencies selected by the mask
+    #  - direction -> 0 HPF (the frequencies inside the radius are dampened), 1 LPF (the frequencies outside the radius are dampened)
+    #  - profile -> one of PROFILES
+    #  - order -> order of the butterworth profile, ignored by the other ones
+    def get_mask(self, shape, radius, intensity, direction, profile='circle', order=2):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown mask profile '{profile}', available profiles: {', '.join(PROFILES)}")
+        key = (tuple(shape), float(radius), float(intensity), int(bool(direction)), profile, order if profile == 'butterworth' else None)
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+
+        mask = self.build_mask(self.distance_field(tuple(shape)), radius, intensity, direction, profile, order)
+        mask.flags.writeable = False
+        with self._lock:
+            # a mask bigger than the whole cache is returned without being stored
+            if mask.nbytes <= self.max_bytes and key not in self._masks:
+                self._masks[key] = mask
+                self._masks_bytes += mask.nbytes
+                while self._masks_bytes > self.max_bytes:
+                    _, dropped = self._masks.popitem(last=False)
+                    self._masks_bytes -= dropped.nbytes
+        return mask
+
+    # Builds a mask from the squared distance field, see get_mask for the arguments
+    @staticmethod
+    def build_mask(distance, radius, intensity, direction, profile='circle', order=2):
+        squared_radius = np.float32(radius * radius)
+        if profile == 'circle':
+            mask = np.ones(distance.shape, np.float32)
+            if direction:
+                # everything OUTSIDE the circle
+                mask[distance > squared_radius] = intensity
+            else:
+                # everything INSIDE the circle
+                mask[distance <= squared_radius] = intensity
+            return mask
+
+        # low pass response going from 1 in the center to 0 far from it
+        if squared_radius == 0:
+            low_pass = (distance == 0).astype(np.float32)
+        elif profile == 'gaussian':
+            low_pass = np.exp(distance / (-2 * squared_radius))
+        else:
+            low_pass = distance / squared_radius
+            np.power(low_pass, order, out=low_pass)
+            low_pass += 1
+            np.reciprocal(low_pass, out=low_pass)
+
+        # LPF keeps the center and dampens what is outside, HPF the other way around
+        #   LPF: intensity + (1 - intensity) * low_pass
+        #   HPF: intensity + (1 - intensity) * (1 - low_pass)
+        # written this way the dampened values never go below intensity (no actual 0s, as for the circle)
+        response = low_pass if direction else np.subtract(np.float32(1), low_pass, out=low_pass)
+        response *= np.float32(1 - intensity)
+        response += np.float32(intensity)
+        return response
+
+    # Drops all the cached masks and distance fields
+    def clear(self):
+        with self._lock:
+            self._distances.clear()
+            self._masks.clear()
+            self._masks_bytes = 0
+
+
+# Library shared by all the ImageProcessing instances of the process
+default_library = MaskLibrary()
+
+
+# Gets the size of the spatial kernel equivalent to a mask, large enough to hold most of its response:
+# the narrower the mask in the frequency domain the wider the kernel, it is always odd so that it has a center
+# accepts 3 arguments:
+#  - shape -> (height, width) of the image the mask refers to
+#  - radius -> radius of the mask
+#  - max_size -> upper bound of the kernel size
+def kernel_size(shape, radius, max_size=1025):
+    size = int(8 * max(shape) / max(radius, 1))
+    size = min(max(size, 3), max_size)
+    return size if size % 2 else size + 1
+
+
+# Builds the spatial kernel equivalent to a mask (see MaskLibrary.get_mask for the arguments), convolving the image
+# with it gives the same result as multiplying the spectrum with the mask, as long as the kernel is large enough.
+# The mask is sampled on the frequency grid of the kernel (scaled to the frequencies of the image it refers to)
+# and transformed back, the result is a centered float32 kernel of shape (size, size).
+#  - size -> size of the kernel (odd), by default evaluated with kernel_size
+def spatial_kernel(shape, radius, intensity, direction, profile='circle', order=2, size=None):
+    height, width = shape
+    if size is None:
+        size = kernel_size(shape, radius)
+    # frequencies of the kernel grid expressed in the units of the image spectrum (rows unshifted, half spectrum columns)
+    rows = np.fft.fftfreq(size) * height
+    cols = np.arange(size // 2 + 1) * (width / size)
+    distance = (rows[:, None] ** 2 + cols[None, :] ** 2).astype(np.float32)
+    mask = MaskLibrary.build_mask(distance, radius, intensity, direction, profile, order)
+    kernel = np.fft.irfft2(mask, s=(size, size))
+    return np.fft.fftshift(kernel).astype(np.float32)
@@ -0,0 +1,159 @@
+import os
+import queue
+import sys
+import threading
+import cv2
+import numpy as np
+
+
+# Kinds of results written by ImageProcessing:
+#  - 'image' -> the filtered images (and the copies of the original ones)
+#  - 'spectrum' -> the magnitude spectra
+ARTIFACTS = ('image', 'spectrum')
+
+# Formats of the written files, None keeps the extension chosen by ImageProcessing
+FORMATS = (None, 'jpeg', 'png', 'npy')
+
+
+# Sinks receive the results of the filters through write(name, array, artifact).
+# The arrays handed to a sink are never modified afterwards by ImageProcessing, so a sink can keep them
+# and write them later (see AsyncSink).
+
+
+# Sink writing nothing, for callers only interested in the arrays
+class NullSink:
+
+    artifacts = ()
+
+    # Tells whether the results of a kind are written, so that they are not even computed otherwise
+    def wants(self, artifact):
+        return False
+
+    def write(self, name, array, artifact='image'):
+        pass
+
+    def close(self):
+        pass
+
+
+# Sink writing the results as files in a directory
+class FileSink:
+
+    # Directory of the files, the current one by default
+    output_dir : str
+
+    # Kinds of results written, the others are discarded
+    artifacts : tuple
+
+    # Format of the files (see FORMATS) and encoder settings
+    format : str
+    jpeg_quality : int
+    png_compression : int
+
+    def __init__(self, output_dir='', artifacts=ARTIFACTS, format=None, jpeg_quality=95, png_compression=3):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown output format '{format}', available formats: jpeg, png, npy")
+        self.output_dir = output_dir
+        self.artifacts = tuple(artifacts)
+        self.format = format
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+
+    def wants(self, artifact):
+        return artifact in self.artifacts
+
+    # Writes a result, accepts 3 arguments:
+    #  - name -> file name, its extension is replaced when a format is set
+    #  - array -> the image or spectrum
+    #  - artifact -> kind of the result, see ARTIFACTS
+    def write(self, name, array, artifact='image'):
+        if not self.wants(artifact):
+            return
+        path = os.path.join(self.output_dir, name)
+        if self.format is not None:
+            path = os.path.splitext(path)[0] + '.' + self.format
+        if path.endswith('.npy'):
+            # raw array, no encoding and no loss of precision
+            np.save(path, array)
+            return
+        if array.dtype != np.uint8:
+            # the encoders only accept 8 bit images, values are rounded and saturated
+            array = np.clip(np.rint(array), 0, 255).astype(np.uint8)
+        if path.endswith(('.jpeg', '.jpg')):
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        elif path.endswith('.png'):
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        else:
+            params = []
+        # imwrite reports the failures (missing directory, path taken by a directory, ...) only by returning False
+        if not cv2.imwrite(path, array, params):
+            raise OSError(f"Unable to write {path}")
+
+    def close(self):
+        pass
+
+
+# Sink handing the results to another one from a background thread, so that filtering returns as soon as the
+# arrays are ready and the encoding overlaps with the following work. The queue is bounded: when the writer
+# falls behind, write blocks until there is room, which keeps the memory of the pending results limited.
+class AsyncSink:
+
+    # Sink actually writing the results
+    sink : object
+
+    # Errors raised by the background writes, also reported on stderr as they happen
+    errors : list
+
+    # Tag of the following writes (e.g. the image they come from), passed to on_error along with their failures
+    tag : object
+
+    # Function called from the background thread as on_error(tag, name, error) when a write fails, None to disable
+    on_error : object
+
+    def __init__(self, sink, max_pending=8, on_error=None):
+        self.sink = sink
+        self.errors = []
+        self.tag = None
+        self.on_error = on_error
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='AsyncSink', daemon=True)
+        self._thread.start()
+
+    @property
+    def artifacts(self):
+        return self.sink.artifacts
+
+    def wants(self, artifact):
+        return self.sink.wants(artifact)
+
+    def write(self, name, array, artifact='image'):
+        if self.wants(artifact):
+            self._queue.put((self.tag, name, array, artifact))
+
+    # Waits until all the pending results have been written
+    def flush(self):
+        self._queue.join()
+
+    # Writes the pending results and stops the background thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.sink.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                tag, name, array, artifact = item
+                try:
+                    self.sink.write(name, array, artifact)
+                except Exception as error:
+                    self.errors.append(error)
+                    print(f"Unable to write {name}: {error}", file=sys.stderr)
+                    if self.on_error is not None:
+                        self.on_error(tag, name, error)
+            finally:
+                self._queue.task_done()
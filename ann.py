@@ -0,0 +1,249 @@
+import json
+import os
+import numpy as np
+
+
+# Ways of reducing the dimension of the samples before indexing them:
+#  - 'pca' -> principal components, fitted with a randomized SVD (a few passes over the samples)
+#  - 'random' -> gaussian random projection, nothing to fit and distances preserved on average
+REDUCTIONS = ('pca', 'random')
+
+
+# Approximate KNN classifier, in place of a brute force KNeighborsClassifier on the raw pixels.
+# The samples are projected to a few components, then indexed by a forest of random projection trees: every tree
+# splits the samples in two halves at the median of their projection on a random direction, level after level,
+# until the leaves hold about leaf_size samples. A query only visits one leaf per tree and compares itself with
+# the samples found there, instead of the whole training set.
+# All the trees have the same depth, so the nodes are stored as flat arrays (node i has children 2i+1 and 2i+2)
+# and a batch of queries descends all the trees level by level with a few vectorized operations.
+#
+#   tree level 0          [          0          ]
+#   tree level 1          [     1    ][    2    ]
+#   leaves                [ 0 ][ 1 ][ 2 ][ 3 ]
+#
+# The index is saved as a directory of .npy files plus a meta.json and memory mapped when loaded.
+class ApproximateKNN:
+
+    # Number of neighbors voting the class of a query
+    n_neighbors : int
+
+    # Number of components kept and how they are obtained (see REDUCTIONS)
+    n_components : int
+    reduction : str
+
+    # Number of trees and target number of samples per leaf, more trees (or larger leaves) find more of
+    # the true neighbors at the cost of more distances per query
+    n_trees : int
+    leaf_size : int
+
+    # Queries searched together
+    batch_size : int
+
+    # Fitted state, None until fit or load:
+    #  - mean (features,) and components (n_components, features) of the projection
+    #  - points (samples, n_components) projected training samples and labels (samples,) their class index
+    #  - classes the labels of the classes
+    #  - directions (trees, nodes, n_components), thresholds (trees, nodes), leaves (trees, leaves, leaf capacity)
+    #    the samples of every leaf, padded with -1
+    mean : np.ndarray
+    components : np.ndarray
+    points : np.ndarray
+    labels : np.ndarray
+    classes : np.ndarray
+    directions : np.ndarray
+    thresholds : np.ndarray
+    leaves : np.ndarray
+
+    def __init__(self, n_neighbors=7, n_components=64, reduction='pca', n_trees=8, leaf_size=32, batch_size=256, random_state=None):
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction '{reduction}', available reductions: {', '.join(REDUCTIONS)}")
+        self.n_neighbors = n_neighbors
+        self.n_components = n_components
+        self.reduction = reduction
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.mean = None
+
+    # Fits the projection and builds the index, accepts 2 arguments:
+    #  - x -> training samples (samples, features)
+    #  - y -> their labels, any shape with one value per sample
+    def fit(self, x, y):
+        random = np.random.default_rng(self.random_state)
+        x = np.asarray(x, np.float32)
+        self.classes, labels = np.unique(np.asarray(y).ravel(), return_inverse=True)
+        self.labels = labels.astype(np.int32)
+        self.mean = x.mean(axis=0)
+        components = min(self.n_components, x.shape[0], x.shape[1])
+        if self.reduction == 'pca':
+            self.components = principal_components(x - self.mean, components, random)
+        else:
+            self.components = (random.standard_normal((components, x.shape[1])) / np.sqrt(components)).astype(np.float32)
+        self.points = self.project(x)
+
+        depth = max(0, int(np.ceil(np.log2(len(x) / self.leaf_size)))) if len(x) > self.leaf_size else 0
+        trees = [build_tree(self.points, depth, random) for _ in range(self.n_trees)]
+        self.directions = np.stack([tree[0] for tree in trees])
+        self.thresholds = np.stack([tree[1] for tree in trees])
+        capacity = max(tree[2].shape[1] for tree in trees)
+        self.leaves = np.stack([np.pad(tree[2], ((0, 0), (0, capacity - tree[2].shape[1])), constant_values=-1) for tree in trees])
+        return self
+
+    # Projects samples (samples, features) on the components
+    def project(self, x):
+        return ((np.asarray(x, np.float32) - self.mean) @ self.components.T).astype(np.float32, copy=False)
+
+    # Gets the approximate nearest neighbors of some samples (samples, features), a batch of queries at a time
+    # returns the distances and the indices of the training samples, both (samples, n_neighbors) sorted by distance
+    # (-1 and inf when fewer candidates than neighbors were found)
+    def kneighbors(self, x, n_neighbors=None):
+        n_neighbors = n_neighbors or self.n_neighbors
+        distances = np.empty((len(x), n_neighbors), np.float32)
+        indices = np.empty((len(x), n_neighbors), np.int64)
+        for start in range(0, len(x), self.batch_size):
+            queries = self.project(x[start:start + self.batch_size])
+            end = start + len(queries)
+            distances[start:end], indices[start:end] = self.search(queries, self.candidates(queries), n_neighbors)
+        return distances, indices
+
+    # Gets the training samples in the leaves reached by some projected queries in all the trees,
+    # shape (queries, trees * leaf capacity), -1 for the padding and the repeated ones
+    def candidates(self, queries):
+        depth = int(np.log2(self.directions.shape[1] + 1))
+        found = []
+        for tree in range(self.directions.shape[0]):
+            node = np.zeros(len(queries), np.int64)
+            for _ in range(depth):
+                side = np.einsum('qk,qk->q', queries, self.directions[tree][node]) > self.thresholds[tree][node]
+                node = 2 * node + 1 + side
+            found.append(self.leaves[tree][node - (2 ** depth - 1)])
+        candidates = np.sort(np.concatenate(found, axis=1), axis=1)
+        # the same sample can be found in several trees, it must be counted once
+        candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+        return candidates
+
+    # Gets the nearest n_neighbors among the candidates of each query, see kneighbors
+    def search(self, queries, candidates, n_neighbors):
+        differences = self.points[np.maximum(candidates, 0)] - queries[:, None, :]
+        distances = np.einsum('qck,qck->qc', differences, differences)
+        distances[candidates < 0] = np.inf
+        if distances.shape[1] < n_neighbors:
+            padding = n_neighbors - distances.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, padding)), constant_values=np.inf)
+            candidates = np.pad(candidates, ((0, 0), (0, padding)), constant_values=-1)
+        nearest = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        indices = np.take_along_axis(candidates, nearest, axis=1)
+        indices[~np.isfinite(np.take_along_axis(nearest_distances, order, axis=1))] = -1
+        return np.sqrt(np.take_along_axis(nearest_distances, order, axis=1)), indices
+
+    # Gets the exact nearest neighbors in the projected space (brute force), to measure the recall of the index alone
+    def exact_kneighbors(self, x, n_neighbors=None):
+        n_neighbors = n_neighbors or self.n_neighbors
+        candidates = np.broadcast_to(np.arange(len(self.points)), (1, len(self.points)))
+        distances = np.empty((len(x), n_neighbors), np.float32)
+        indices = np.empty((len(x), n_neighbors), np.int64)
+        # smaller batches, every query is compared with all the training samples
+        batch_size = max(1, self.batch_size // 16)
+        for start in range(0, len(x), batch_size):
+            queries = self.project(x[start:start + batch_size])
+            end = start + len(queries)
+            distances[start:end], indices[start:end] = self.search(queries, np.repeat(candidates, len(queries), axis=0), n_neighbors)
+        return distances, indices
+
+    # Gets the predicted class of some samples (samples, features), the most common one among the neighbors
+    # (ties go to the first class, as for KNeighborsClassifier)
+    def predict(self, x):
+        _, indices = self.kneighbors(x)
+        votes = np.zeros((len(indices), len(self.classes)), np.int32)
+        found = indices >= 0
+        rows = np.repeat(np.arange(len(indices)), indices.shape[1]).reshape(indices.shape)
+        np.add.at(votes, (rows[found], self.labels[indices[found]]), 1)
+        return self.classes[votes.argmax(axis=1)]
+
+    # Gets the fraction of samples correctly classified
+    def score(self, x, y):
+        return float(np.mean(self.predict(x) == np.asarray(y).ravel()))
+
+    # Saves the index in a directory (created if needed)
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ('mean', 'components', 'points', 'labels', 'classes', 'directions', 'thresholds', 'leaves'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'n_neighbors': self.n_neighbors, 'n_components': self.n_components, 'reduction': self.reduction,
+                'n_trees': self.n_trees, 'leaf_size': self.leaf_size, 'batch_size': self.batch_size}
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump(meta, file, indent=1)
+
+    # Loads an index saved with save, the arrays are memory mapped (only the pages touched by the queries are read)
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as file:
+            index = cls(**json.load(file))
+        for name in ('mean', 'components', 'points', 'labels', 'classes', 'directions', 'thresholds', 'leaves'):
+            setattr(index, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        return index
+
+
+# Gets the first principal components (components, features) of centered samples with a randomized SVD:
+# the samples are multiplied by a few random directions, refined by two power iterations, and the SVD is computed
+# on the small matrix obtained projecting the samples on them
+def principal_components(centered, components, random, oversampling=10, iterations=2):
+    size = min(components + oversampling, *centered.shape)
+    basis = centered @ random.standard_normal((centered.shape[1], size)).astype(np.float32)
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(basis)
+        basis, _ = np.linalg.qr(centered @ (centered.T @ basis))
+    basis, _ = np.linalg.qr(basis)
+    _, _, vt = np.linalg.svd(basis.T @ centered, full_matrices=False)
+    return vt[:components].astype(np.float32)
+
+
+# Builds a random projection tree of the given depth over some points (samples, dimensions)
+# returns the directions (nodes, dimensions) and thresholds (nodes,) of the splits and the samples of every leaf
+# (leaves, capacity) padded with -1
+def build_tree(points, depth, random):
+    nodes = 2 ** depth - 1
+    directions = np.zeros((nodes, points.shape[1]), np.float32)
+    thresholds = np.zeros(nodes, np.float32)
+    order = np.arange(len(points))
+    bounds = [(0, len(points))]
+    for level in range(depth):
+        next_bounds = []
+        for position, (start, end) in enumerate(bounds):
+            node = 2 ** level - 1 + position
+            segment = order[start:end]
+            half = (end - start) // 2
+            if half:
+                # direction joining two random samples of the node, it follows the spread of the data
+                first, second = random.choice(segment, 2, replace=False)
+                direction = points[second] - points[first]
+                if not direction.any():
+                    direction = random.standard_normal(points.shape[1]).astype(np.float32)
+                projection = points[segment] @ direction
+                parted = np.argpartition(projection, half)
+                order[start:end] = segment[parted]
+                directions[node] = direction
+                # halfway between the two halves, the queries go right when above it
+                thresholds[node] = (projection[parted[:half]].max() + projection[parted[half:]].min()) / 2
+            else:
+                # at most one sample, everything goes right
+                thresholds[node] = -np.inf
+            next_bounds += [(start, start + half), (start + half, end)]
+        bounds = next_bounds
+    capacity = max(end - start for start, end in bounds)
+    leaves = np.full((len(bounds), capacity), -1, np.int64)
+    for leaf, (start, end) in enumerate(bounds):
+        leaves[leaf, :end - start] = order[start:end]
+    return directions, thresholds, leaves
+
+
+# Gets the fraction of the true neighbors found, accepts 2 arguments:
+#  - found -> indices of the neighbors found (samples, k)
+#  - exact -> indices of the true neighbors (samples, k)
+def recall(found, exact):
+    hits = sum(np.isin(row_found, row_exact).sum() for row_found, row_exact in zip(found, exact))
+    return hits / exact.size
@@ -0,0 +1,239 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import SimpleQueue
+from multiprocessing.util import Finalize
+import cv2
+from FilterPlanner import METHODS
+from ImageProcessing import ImageProcessing
+from Instrumentation import Instrumentation, JSONLinesExporter, format_breakdown
+from OutputSink import ARTIFACTS, AsyncSink, FileSink, NullSink
+
+
+# Filters available from the command line and the corresponding ImageProcessing method
+FILTERS = {
+    'sharpening': 'sharpening',
+    'blurring': 'blurring',
+    'edge': 'edge_detection',
+    'noise': 'noise_filtering',
+    'custom': 'custom_filter',
+}
+
+# Extensions picked up when the input is a directory
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+# Sink of the worker process, the results are encoded by a background thread while the worker filters the next image
+sink = None
+
+# Exporters of the stage records of the worker process (see Instrumentation), None when the stages are not measured
+exporters = None
+
+
+# Initializes a worker process, accepts 4 arguments:
+#  - output_dir -> directory of the results
+#  - output -> dictionary describing the output (see output_spec)
+#  - stages -> None, or {'log': JSON lines file of the stage records or None} to measure the stages of every image
+#  - failures -> multiprocessing queue receiving (image path, description) for every result that could not be written,
+#                None to only report them on stderr
+def init_worker(output_dir, output, stages=None, failures=None):
+    global sink, exporters
+    if stages is not None:
+        exporters = [JSONLinesExporter(stages['log'])] if stages['log'] else []
+        for exporter in exporters:
+            Finalize(exporter, exporter.close, exitpriority=10)
+    if not output['artifacts']:
+        sink = NullSink()
+        return
+    # the writes are tagged with their image (see process_image), so that the image of a failed write is known
+    on_error = None if failures is None else lambda image_path, name, error: failures.put((image_path, f"{name}: {error}"))
+    sink = AsyncSink(FileSink(output_dir, output['artifacts'], output['format'], output['jpeg_quality'], output['png_compression']),
+                     output['max_pending'], on_error)
+    # pending results are written (and their failures reported) before the worker process exits
+    Finalize(sink, sink.close, exitpriority=10)
+
+
+# Gets the sorted list of images to process
+# accepts 1 argument:
+#  - source -> a directory (all the images inside it) or a glob pattern such as 'scans/*.jpeg'
+def find_images(source):
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        paths = glob.glob(source)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+# Gets the prefix of the result files of every image, {path: prefix}: the name of the image without extension,
+# or when several images share it (a.jpeg and a.png, a.jpg in two directories of a glob) their path relative to the
+# common directory with the extension, e.g. a_jpeg_ and a_png_, so that no image overwrites the results of another
+# raises ValueError when the prefixes still clash
+def result_prefixes(paths):
+    stems = {path: os.path.splitext(os.path.basename(path))[0] for path in paths}
+    counts = Counter(stems.values())
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else ''
+    prefixes = {}
+    for path, stem in stems.items():
+        if counts[stem] > 1:
+            stem = os.path.relpath(os.path.abspath(path), common).replace(os.sep, '_').replace('.', '_')
+        prefixes[path] = stem + '_'
+    counts = Counter(prefixes.values())
+    if len(counts) < len(prefixes):
+        duplicates = sorted(path for path, prefix in prefixes.items() if counts[prefix] > 1)
+        raise ValueError(f"The results of these images would overwrite each other: {', '.join(duplicates)}")
+    return prefixes
+
+
+# Filters a single image, executed in the worker processes
+# accepts 3 arguments:
+#  - image_path -> image to filter
+#  - spec -> dictionary describing the filter (see filter_spec)
+#  - prefix -> prefix of the result files (see result_prefixes), by default the name of the image
+# returns the image path, the seconds spent on it (the results may still be being written, their failures are
+# reported through the failures queue of init_worker), the breakdown of the time by stage (None when the stages are
+# not measured) and the description of the plan of the filter when the spatial method is forced (None otherwise)
+def process_image(image_path, spec, prefix=None):
+    start = time.perf_counter()
+    if prefix is None:
+        prefix = os.path.splitext(os.path.basename(image_path))[0] + '_'
+    if isinstance(sink, AsyncSink):
+        sink.tag = image_path
+    instrumentation = None if exporters is None else Instrumentation(exporters, {'image': image_path})
+    # each worker is already one of many processes, so the transforms are kept single threaded
+    image = ImageProcessing(image_path, compact=True, backend='numpy', output_prefix=prefix, sink=sink, instrumentation=instrumentation,
+                            method=spec['method'])
+    channels = [0, 1, 2] if spec['mode'] == 'rgb' else []
+    if spec['chain']:
+        # all the filters of the chain are applied with a single inverse transform
+        filtered = image.pipeline(channels, [chain_step(name, spec) for name in spec['chain']])
+        if len(channels):
+            image.save('pipeline_RGB.jpeg', cv2.cvtColor(filtered, cv2.COLOR_RGB2BGR))
+        else:
+            image.save('pipeline_gray.jpeg', filtered)
+    else:
+        method = getattr(image, FILTERS[spec['filter']])
+        if spec['filter'] == 'custom':
+            method(channels, spec['radius'], spec['intensity'], spec['direction'], spec['profile'])
+        else:
+            method(channels, spec['profile'])
+    image.release()
+    plan = repr(image.last_plan) if spec['method'] == 'spatial' and image.last_plan is not None else None
+    return image_path, time.perf_counter() - start, None if instrumentation is None else instrumentation.breakdown(), plan
+
+
+# Gets the ImageProcessing.pipeline step of one of the filters of a chain
+def chain_step(name, spec):
+    if name == 'custom':
+        return {'radius': spec['radius'], 'intensity': spec['intensity'], 'direction': spec['direction'], 'profile': spec['profile']}
+    return {'filter': FILTERS[name], 'profile': spec['profile']}
+
+
+# Builds the filter description passed to the workers from the parsed arguments
+def filter_spec(args):
+    return {
+        'filter': args.filter,
+        'mode': args.mode,
+        'radius': args.radius,
+        'intensity': args.intensity,
+        'direction': 1 if args.direction == 'lpf' else 0,
+        'profile': args.profile,
+        'method': args.method,
+        'chain': args.chain.split(',') if args.chain else [],
+    }
+
+
+# Builds the output description passed to the workers from the parsed arguments
+def output_spec(args):
+    artifacts = () if args.artifacts == 'none' else tuple(args.artifacts.split(','))
+    return {
+        'artifacts': artifacts,
+        'format': args.format,
+        'jpeg_quality': args.jpeg_quality,
+        'png_compression': args.png_compression,
+        'max_pending': args.max_pending,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Apply one of the frequency domain filters to a batch of images')
+    parser.add_argument('input', help='directory containing the images or glob pattern (quote it)')
+    parser.add_argument('output', help='directory where the results are written')
+    parser.add_argument('--filter', choices=FILTERS, default='sharpening', help='filter to apply (default: sharpening)')
+    parser.add_argument('--mode', choices=('rgb', 'gray'), default='rgb', help='filter the colors or the grayscale image (default: rgb)')
+    parser.add_argument('--radius', type=float, default=10, help='custom filter: radius in %% of the image width (default: 10)')
+    parser.add_argument('--intensity', type=float, default=50, help='custom filter: dampening intensity in %% (default: 50)')
+    parser.add_argument('--direction', choices=('hpf', 'lpf'), default='hpf', help='custom filter: high or low pass (default: hpf)')
+    parser.add_argument('--profile', choices=('circle', 'gaussian', 'butterworth'), default='circle', help='shape of the mask (default: circle)')
+    parser.add_argument('--method', choices=METHODS, default='auto', help='run the filters with the DFT, with the equivalent spatial convolution or with the cheaper of the two within the tolerance of the planner, the chains always use the DFT (default: auto)')
+    parser.add_argument('--chain', default=None, help='comma separated filters applied together in one pass, e.g. noise,sharpening (overrides --filter)')
+    parser.add_argument('--artifacts', default='image,spectrum', help='results to write: image, spectrum, image,spectrum or none (default: image,spectrum)')
+    parser.add_argument('--format', choices=('jpeg', 'png', 'npy'), default=None, help='format of the results (default: the one of each result file)')
+    parser.add_argument('--jpeg-quality', type=int, default=95, help='JPEG quality, 0-100 (default: 95)')
+    parser.add_argument('--png-compression', type=int, default=3, help='PNG compression level, 0-9 (default: 3)')
+    parser.add_argument('--max-pending', type=int, default=8, help='results waiting to be written per worker (default: 8)')
+    parser.add_argument('--stages', action='store_true', help='measure the stages of every image (decode, forward, ...) and print their breakdown')
+    parser.add_argument('--stages-log', default=None, help='append the stage records as JSON lines to this file (implies --stages)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per cpu)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for name in (args.chain.split(',') if args.chain else []):
+        if name not in FILTERS:
+            print(f"Unknown filter '{name}' in --chain, available filters: {', '.join(FILTERS)}", file=sys.stderr)
+            return 2
+    if args.artifacts != 'none' and not set(args.artifacts.split(',')) <= set(ARTIFACTS):
+        print(f"Unknown artifacts '{args.artifacts}', available artifacts: image, spectrum, none", file=sys.stderr)
+        return 2
+    paths = find_images(args.input)
+    if not paths:
+        print(f"No images found in {args.input}", file=sys.stderr)
+        return 1
+    try:
+        prefixes = result_prefixes(paths)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
+    os.makedirs(args.output, exist_ok=True)
+    spec = filter_spec(args)
+    workers = args.workers or os.cpu_count()
+    stages = {'log': args.stages_log} if args.stages or args.stages_log else None
+
+    failed = set()
+    write_failures = SimpleQueue()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(args.output, output_spec(args), stages, write_failures)) as executor:
+        futures = {executor.submit(process_image, path, spec, prefixes[path]): path for path in paths}
+        # results are reported as soon as each image is done, not in submission order
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                path, seconds, breakdown, plan = future.result()
+                print(f"[{done}/{len(paths)}] {path} ({seconds:.2f} s)", flush=True)
+                if plan is not None:
+                    # forced, the result may be far from the frequency one
+                    print(f"    plan: {plan}", flush=True)
+                if breakdown is not None:
+                    print(f"    {format_breakdown(breakdown)}", flush=True)
+            except Exception as error:
+                failed.add(futures[future])
+                print(f"[{done}/{len(paths)}] {futures[future]} failed: {error}", file=sys.stderr, flush=True)
+    # the workers have exited, all their pending results are written: the images with a failed write failed too
+    while not write_failures.empty():
+        path, description = write_failures.get()
+        failed.add(path)
+        print(f"{path} failed: unable to write {description}", file=sys.stderr, flush=True)
+    elapsed = time.perf_counter() - start
+
+    processed = len(paths) - len(failed)
+    print(f"{processed} images in {elapsed:.2f} s ({processed / elapsed:.2f} images/s) with {workers} workers, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+
+# Benchmarks of the hot paths of the filters (ImageProcessing) and of the classification (dataset features and
+# trainer), on synthetic data so that they run offline on any machine.
+# Every case (a stage list run on one image size and color mode, or on one dataset size) runs in its own process,
+# so that the peak memory of a case is not inflated by the previous ones. For every stage the case records:
+#  - seconds -> best wall time over the repeats
+#  - allocated_bytes -> peak of the memory allocated during the stage (tracemalloc, numpy arrays included),
+#                       measured on a separate run since tracing slows everything down
+#  - rss_peak_bytes -> peak resident memory of the process at the end of the stage
+# The results are written as JSON, compare flags the stages slower (or using more memory) than a baseline:
+#
+#   python benchmark.py run --sizes 256,1024,4096 --output current.json
+#   python benchmark.py compare baseline.json current.json --threshold 0.1
+
+
+# Default matrix of the cases
+SIZES = (256, 1024, 2048, 4096, 8192)
+MODES = ('rgb', 'gray')
+DATASET_SIZES = (500, 2000)
+
+
+# Gets the peak resident memory of the process in bytes (ru_maxrss is in kilobytes on Linux, bytes on macOS)
+def rss_peak():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Runs the stages of a case, accepts 2 arguments:
+#  - stages -> list of (name, function), each function receives the state returned by the previous one
+#  - repeat -> number of timed runs, the best one is kept
+# returns {stage: {'seconds', 'allocated_bytes', 'rss_peak_bytes'}}
+def run_stages(stages, repeat):
+    results = {name: {'seconds': float('inf')} for name, _ in stages}
+    for _ in range(repeat):
+        state = None
+        for name, stage in stages:
+            start = time.perf_counter()
+            state = stage(state)
+            results[name]['seconds'] = min(results[name]['seconds'], time.perf_counter() - start)
+            results[name]['rss_peak_bytes'] = rss_peak()
+    # allocations, traced on a run of their own
+    state = None
+    tracemalloc.start()
+    for name, stage in stages:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        state = stage(state)
+        results[name]['allocated_bytes'] = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return results
+
+
+# Stages of the filters on a synthetic image (smooth shapes plus noise, so that the spectrum is not flat)
+def image_stages(size, mode, directory):
+    from ImageProcessing import ImageProcessing
+    from MaskLibrary import default_library
+    from OutputSink import NullSink
+
+    random = np.random.default_rng(0)
+    small = (random.random((16, 16, 3)) * 255).astype(np.uint8)
+    image = cv2.resize(small, (size, size), interpolation=cv2.INTER_CUBIC)
+    image = cv2.add(image, (random.random(image.shape) * 32).astype(np.uint8))
+    path = os.path.join(directory, f'benchmark_{size}.bmp')
+    cv2.imwrite(path, image)
+    channels = [0, 1, 2] if mode == 'rgb' else []
+    channel = 0 if mode == 'rgb' else None
+
+    def decode(state):
+        return ImageProcessing(path, sink=NullSink())
+
+    def forward(processing):
+        if len(channels):
+            processing.get_frequency_RGB()
+        else:
+            processing.get_frequency(None)
+        return processing
+
+    def mask(processing):
+        # cold mask, as for the first filter on an image of a new size
+        default_library.clear()
+        processing.mask = processing.define_circular_mask(size / 20, .5, 0)
+        return processing
+
+    def multiply(processing):
+        processing.apply_mask(channels, processing.mask)
+        return processing
+
+    def inverse(processing):
+        processing.get_image_back(channels, spectrum=False)
+        return processing
+
+    def spectrum(processing):
+        processing.render_spectrum(channel, filtered=True)
+        return processing
+
+    return [('decode', decode), ('forward', forward), ('mask', mask), ('multiply', multiply), ('inverse', inverse), ('spectrum', spectrum)]
+
+
+# Stages of the classification on a synthetic dataset of 128x128 grayscale images
+def dataset_stages(samples):
+    from features import SpectralFeatures
+    from trainer import LogisticTrainer
+
+    random = np.random.default_rng(0)
+    images = (random.random((samples, 128, 128)) * 255).astype(np.uint8)
+    labels = (images[:, :64].mean(axis=(1, 2)) > images[:, 64:].mean(axis=(1, 2))).astype(np.float32)
+
+    def features(state):
+        return SpectralFeatures().transform(images)
+
+    def train(state):
+        # fixed number of epochs, early stopping would make the time depend on the data
+        return LogisticTrainer(max_epochs=5, validation_fraction=0, scale=1 / 255, random_state=0).fit(images, labels)
+
+    def predict(trainer):
+        trainer.predict(images)
+        return trainer
+
+    return [('features', features), ('train', train), ('predict', predict)]
+
+
+# Runs a single case in the current process, see run_case
+def execute_case(spec):
+    with tempfile.TemporaryDirectory() as directory:
+        if spec['kind'] == 'image':
+            stages = image_stages(spec['size'], spec['mode'], directory)
+        else:
+            stages = dataset_stages(spec['samples'])
+        results = run_stages(stages, spec['repeat'])
+    return {'stages': results, 'rss_peak_bytes': rss_peak()}
+
+
+# Runs a case in a new process, accepts 2 arguments:
+#  - spec -> {'name', 'kind': 'image' or 'dataset', 'size', 'mode' or 'samples', 'repeat'}
+#  - timeout -> seconds before the case is abandoned
+def run_case(spec, timeout):
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), 'case', json.dumps(spec)],
+                                   capture_output=True, text=True, timeout=timeout, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return dict(spec, error=f'timed out after {timeout} s')
+    if completed.returncode != 0:
+        # e.g. killed when out of memory
+        return dict(spec, error=(completed.stderr.strip().splitlines() or [f'exit code {completed.returncode}'])[-1])
+    return dict(spec, **json.loads(completed.stdout))
+
+
+# Gets the list of the cases of the matrix
+def build_cases(sizes, modes, dataset_sizes, repeat):
+    cases = [{'name': f'filter-{mode}-{size}', 'kind': 'image', 'size': size, 'mode': mode, 'repeat': repeat} for size in sizes for mode in modes]
+    cases += [{'name': f'classification-{samples}', 'kind': 'dataset', 'samples': samples, 'repeat': repeat} for samples in dataset_sizes]
+    return cases
+
+
+# Gets the description of the machine and of the libraries, stored with the results
+def environment():
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+# Compares the results with a baseline, returns the list of regressions as (case, stage, metric, baseline, current),
+# a case that succeeded in the baseline and failed (e.g. timed out or ran out of memory) or is missing in the current
+# results is a regression too, as (case, '-', 'error', None, error) or (case, '-', 'missing', None, None)
+#  - threshold -> relative increase of the time tolerated
+#  - memory_threshold -> relative increase of the memory tolerated
+#  - min_seconds -> stages faster than this in both runs are not compared (noise)
+def compare(baseline, current, threshold=0.1, memory_threshold=0.1, min_seconds=0.005):
+    previous = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    names = {case['name'] for case in current['cases']}
+    for name, case in previous.items():
+        if name not in names and 'error' not in case:
+            regressions.append((name, '-', 'missing', None, None))
+    for case in current['cases']:
+        if case['name'] not in previous or 'error' in previous[case['name']]:
+            continue
+        if 'error' in case:
+            regressions.append((case['name'], '-', 'error', None, case['error']))
+            continue
+        for stage, result in case['stages'].items():
+            reference = previous[case['name']]['stages'].get(stage)
+            if reference is None:
+                continue
+            if max(result['seconds'], reference['seconds']) >= min_seconds and result['seconds'] > reference['seconds'] * (1 + threshold):
+                regressions.append((case['name'], stage, 'seconds', reference['seconds'], result['seconds']))
+            if result['allocated_bytes'] > reference['allocated_bytes'] * (1 + memory_threshold) + 4096:
+                regressions.append((case['name'], stage, 'allocated_bytes', reference['allocated_bytes'], result['allocated_bytes']))
+        if case['rss_peak_bytes'] > previous[case['name']]['rss_peak_bytes'] * (1 + memory_threshold):
+            regressions.append((case['name'], '-', 'rss_peak_bytes', previous[case['name']]['rss_peak_bytes'], case['rss_peak_bytes']))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the filters and the classification on synthetic data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run.add_argument('--sizes', default=','.join(map(str, SIZES)), help='sides of the images (default: %(default)s)')
+    run.add_argument('--modes', default=','.join(MODES), help='color modes, rgb and/or gray (default: %(default)s)')
+    run.add_argument('--dataset-sizes', default=','.join(map(str, DATASET_SIZES)), help='images of the classification datasets, empty to skip (default: %(default)s)')
+    run.add_argument('--repeat', type=int, default=3, help='timed runs of every case, the best is kept (default: 3)')
+    run.add_argument('--timeout', type=float, default=600, help='seconds before a case is abandoned (default: 600)')
+    run.add_argument('--output', default='benchmark.json', help='results file (default: benchmark.json)')
+    comparison = commands.add_parser('compare', help='flag the regressions of some results against a baseline')
+    comparison.add_argument('baseline', help='results of the reference run')
+    comparison.add_argument('current', help='results to check')
+    comparison.add_argument('--threshold', type=float, default=0.1, help='relative slowdown tolerated (default: 0.1)')
+    comparison.add_argument('--memory-threshold', type=float, default=0.1, help='relative memory increase tolerated (default: 0.1)')
+    comparison.add_argument('--min-seconds', type=float, default=0.005, help='stages faster than this are not compared (default: 0.005)')
+    case = commands.add_parser('case', help=argparse.SUPPRESS)
+    case.add_argument('spec')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'case':
+        print(json.dumps(execute_case(json.loads(args.spec))))
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        with open(args.current) as file:
+            current = json.load(file)
+        regressions = compare(baseline, current, args.threshold, args.memory_threshold, args.min_seconds)
+        for name, stage, metric, before, after in regressions:
+            if metric == 'error':
+                print(f"REGRESSION {name}: failed, {after}")
+            elif metric == 'missing':
+                print(f"REGRESSION {name}: missing from the current results")
+            else:
+                print(f"REGRESSION {name} {stage} {metric}: {before:.4g} -> {after:.4g} ({(after / before - 1) * 100 if before else float('inf'):+.1f}%)")
+        print(f"{len(regressions)} regressions")
+        return 1 if regressions else 0
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    modes = [mode for mode in args.modes.split(',') if mode]
+    dataset_sizes = [int(size) for size in args.dataset_sizes.split(',') if size]
+    results = {'environment': environment(), 'cases': []}
+    for spec in build_cases(sizes, modes, dataset_sizes, args.repeat):
+        result = run_case(spec, args.timeout)
+        results['cases'].append(result)
+        if 'error' in result:
+            print(f"{spec['name']}: failed, {result['error']}", flush=True)
+        else:
+            stages = ', '.join(f"{stage} {values['seconds'] * 1000:.1f} ms" for stage, values in result['stages'].items())
+            print(f"{spec['name']}: {stages}, peak RSS {result['rss_peak_bytes'] / 2**20:.0f} MB", flush=True)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    return 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# Loader of the classification dataset (see Image_Classification.ipynb).
+# The images are decoded as grayscale and resized to size x size by a pool of processes, then stored in a feature store:
+# a .npy file (images, size, size) of uint8, opened memory mapped, and a .json manifest listing for every row of the
+# array the file it comes from with its modification time and length. When the loader runs again only the files
+# that are new or changed since the manifest was written are decoded, an unchanged dataset is just mapped in memory.
+#
+#   store.npy   -> [image 0][image 1][image 2] ...
+#   store.json  -> {"size": 128, "files": [[path 0, mtime, bytes], [path 1, mtime, bytes], ...]}
+
+
+# Extensions picked up in the class directories
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+# Reduced decoding flags, the JPEG decoder scales the image down by 8, 4 or 2 while decoding (much faster
+# than decoding it at full resolution and resizing it afterwards)
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+
+# Gets the imread flag decoding an image at the lowest resolution still not smaller than the target
+# accepts 3 arguments:
+#  - width, height -> size of the image (read from the header, see decode)
+#  - size -> side of the images in the store
+def decode_flag(width, height, size):
+    for factor, flag in REDUCED_FLAGS:
+        if min(width, height) // factor >= size:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+# Decodes a single image as grayscale resized to size x size, executed in the worker processes
+# accepts 2 arguments:
+#  - path -> image file
+#  - size -> side of the images in the store
+def decode(path, size):
+    # only the header is read to get the size, the pixels are decoded by opencv
+    with Image.open(path) as header:
+        width, height = header.size
+    image = cv2.imread(path, decode_flag(width, height, size))
+    if image is None:
+        raise ValueError(f"Unable to read the image {path}")
+    return cv2.resize(image, (size, size))
+
+
+# Gets the sorted list of images of a directory
+def find_images(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+# Gets the [path, modification time, length] entry of the manifest for a file
+def file_entry(path):
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+# Reads the manifest of a store, None if the store does not exist or has a different image size
+def read_manifest(store, size):
+    try:
+        with open(store + '.json') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('size') != size or not os.path.exists(store + '.npy'):
+        return None
+    return manifest
+
+
+# Loads a list of images through the feature store, accepts 4 arguments:
+#  - paths -> image files, the rows of the result follow their order
+#  - store -> path of the store without extension, e.g. 'cache/train' for cache/train.npy and cache/train.json
+#  - size -> side of the images
+#  - workers -> number of decoding processes (default: one per cpu)
+# returns a read only memory mapped array (images, size, size) of uint8
+def load_images(paths, store, size=128, workers=None):
+    entries = [file_entry(os.path.normpath(path)) for path in paths]
+    manifest = read_manifest(store, size)
+    if manifest is not None and manifest['files'] == entries:
+        # nothing changed since the store was written
+        return np.load(store + '.npy', mmap_mode='r')
+
+    # rows of the current store that can be kept, keyed by entry (a changed file has a different entry)
+    previous = None
+    reusable = {}
+    if manifest is not None:
+        previous = np.load(store + '.npy', mmap_mode='r')
+        reusable = {tuple(entry): row for row, entry in enumerate(manifest['files'])}
+
+    directory = os.path.dirname(store)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # the new store is written aside and replaces the current one only once complete
+    images = np.lib.format.open_memmap(store + '.tmp.npy', mode='w+', dtype=np.uint8, shape=(len(entries), size, size))
+    missing = []
+    for row, entry in enumerate(entries):
+        if tuple(entry) in reusable:
+            images[row] = previous[reusable[tuple(entry)]]
+        else:
+            missing.append(row)
+
+    if missing:
+        if len(missing) == 1 or workers == 1:
+            decoded = map(decode, [entries[row][0] for row in missing], repeat(size))
+            for row, image in zip(missing, decoded):
+                images[row] = image
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                decoded = executor.map(decode, [entries[row][0] for row in missing], repeat(size), chunksize=32)
+                for row, image in zip(missing, decoded):
+                    images[row] = image
+    images.flush()
+    del images, previous
+
+    os.replace(store + '.tmp.npy', store + '.npy')
+    with open(store + '.tmp.json', 'w') as file:
+        json.dump({'size': size, 'files': entries}, file)
+    os.replace(store + '.tmp.json', store + '.json')
+    return np.load(store + '.npy', mmap_mode='r')
+
+
+# Loads the images of some class directories through the feature store, see load_images
+#  - directories -> one directory per class, the images of the first one come first and so on
+# returns the images and the index of the class (directory) of each of them
+def load_classes(directories, store, size=128, workers=None):
+    paths = [find_images(directory) for directory in directories]
+    classes = np.concatenate([np.full(len(files), index) for index, files in enumerate(paths)])
+    return load_images([path for files in paths for path in files], store, size, workers), classes
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Decode the images of some class directories into a feature store')
+    parser.add_argument('directories', nargs='+', help='one directory per class')
+    parser.add_argument('--store', required=True, help='path of the store without extension, e.g. cache/train')
+    parser.add_argument('--size', type=int, default=128, help='side of the images (default: 128)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per cpu)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start = time.perf_counter()
+    images, classes = load_classes(args.directories, args.store, args.size, args.workers)
+    print(f"{images.shape[0]} images ({', '.join(str(count) for count in np.bincount(classes, minlength=len(args.directories)))} by class) in {time.perf_counter() - start:.2f} s")
+    return 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())
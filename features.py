@@ -0,0 +1,149 @@
+import numpy as np
+from FFTBackend import get_backend
+from MaskLibrary import default_library
+
+
+# Names of the spatial statistics, in the order they appear in the descriptor
+SPATIAL_STATISTICS = ('mean', 'std', 'skewness', 'kurtosis', 'gradient_x', 'gradient_y', 'p10', 'p50', 'p90')
+
+
+# Compact descriptor of grayscale images for the classifiers of Image_Classification.ipynb, in place of the raw pixels.
+# A stack of images is transformed with a single batched FFT (see FFTBackend) and its power spectrum is summarized in:
+#  - radial bins -> log of the mean power in rings of growing frequency (how much fine detail there is)
+#  - angular bins -> fraction of the energy in each orientation (e.g. the vertical and horizontal edges of buildings)
+#  - bands -> fraction of the energy in each octave band, from the low pass masks of MaskLibrary
+# followed by a few spatial statistics (see SPATIAL_STATISTICS). The 0 frequency (the mean brightness) is left out
+# of the spectral features.
+# All the spectral features are sums of the power spectrum weighted by some function of the frequency, so they are
+# computed together as a single matrix product between the power spectra of the stack (images, frequencies) and a
+# projection matrix (frequencies, features) built once per image shape.
+class SpectralFeatures:
+
+    # Number of radial and angular bins
+    radial_bins : int
+    angular_bins : int
+
+    # Upper bounds of the bands as fractions of the highest frequency (half the shorter side of the image),
+    # the last band takes everything above the previous bound
+    band_edges : tuple
+
+    # Profile of the masks delimiting the bands (see MaskLibrary.PROFILES)
+    profile : str
+
+    # Images transformed at once
+    chunk_size : int
+
+    # Projection matrices and bin sizes keyed by image shape
+    _projections : dict
+
+    def __init__(self, radial_bins=64, angular_bins=24, band_edges=(1/32, 1/16, 1/8, 1/4, 1/2, 1), profile='circle', chunk_size=256, backend=None):
+        self.radial_bins = radial_bins
+        self.angular_bins = angular_bins
+        self.band_edges = tuple(band_edges)
+        self.profile = profile
+        self.chunk_size = chunk_size
+        self.backend = get_backend(backend)
+        self._projections = {}
+
+    # Number of features of the descriptor
+    @property
+    def size(self):
+        return self.radial_bins + self.angular_bins + len(self.band_edges) + len(SPATIAL_STATISTICS)
+
+    # Names of the features, in the order of the descriptor
+    def feature_names(self):
+        return ([f'radial_{index}' for index in range(self.radial_bins)] + [f'angular_{index}' for index in range(self.angular_bins)]
+                + [f'band_{index}' for index in range(len(self.band_edges))] + list(SPATIAL_STATISTICS))
+
+    # Gets the descriptors of a stack of images, accepts 1 argument:
+    #  - images -> grayscale images (images, height, width) of any dtype, memory mapped stacks are read a chunk at a time
+    # returns a float32 matrix (images, features)
+    def transform(self, images):
+        descriptors = np.empty((len(images), self.size), np.float32)
+        for start in range(0, len(images), self.chunk_size):
+            chunk = np.asarray(images[start:start + self.chunk_size], np.float32)
+            descriptors[start:start + len(chunk)] = self.describe(chunk)
+        return descriptors
+
+    # Gets the descriptors of a chunk of float32 images (images, height, width)
+    def describe(self, images):
+        projection, counts = self.projection(images.shape[1:])
+        spectrum = self.backend.forward(images)
+        power = spectrum.real * spectrum.real
+        power += spectrum.imag * spectrum.imag
+        energies = power.reshape(len(images), -1) @ projection
+
+        radial_end = self.radial_bins
+        angular_end = radial_end + self.angular_bins
+        total = np.maximum(energies[:, -1:], np.finfo(np.float32).tiny)
+        radial = np.log1p(energies[:, :radial_end] / counts)
+        ratios = energies[:, radial_end:-1] / total
+        return np.concatenate((radial, ratios, spatial_statistics(images)), axis=1)
+
+    # Gets the projection matrix (frequencies of the half spectrum, features + 1) of an image shape and the number of
+    # frequencies in each radial bin. The last column is the total energy, the columns are weighted by how many
+    # times each frequency of the half spectrum appears in the full one
+    def projection(self, shape):
+        if shape in self._projections:
+            return self._projections[shape]
+        height, width = shape
+        distance = default_library.distance_field(shape)
+        rows = (np.fft.fftfreq(height) * height)[:, None]
+        cols = np.arange(width // 2 + 1)[None, :]
+        highest = min(height, width) / 2
+
+        # the columns between 0 and the Nyquist frequency stand for their negative counterparts too
+        weights = np.full(distance.shape, 2, np.float32)
+        weights[:, 0] = 1
+        if width % 2 == 0:
+            weights[:, -1] = 1
+        weights[0, 0] = 0
+
+        radius = np.sqrt(distance) / highest
+        radial = np.minimum((radius * self.radial_bins).astype(int), self.radial_bins - 1)
+        # orientation between -pi/2 and pi/2, the half spectrum holds one of every pair of opposite frequencies
+        angle = np.arctan2(rows, cols) + np.pi / 2
+        angular = np.minimum((angle / np.pi * self.angular_bins).astype(int), self.angular_bins - 1)
+
+        projection = np.zeros((distance.size, self.size - len(SPATIAL_STATISTICS) + 1), np.float32)
+        frequencies = np.arange(distance.size)
+        projection[frequencies, radial.ravel()] = weights.ravel()
+        projection[frequencies, self.radial_bins + angular.ravel()] = weights.ravel()
+        # energy kept by each low pass mask, a band is the difference between two consecutive ones
+        low_pass = np.zeros(distance.shape, np.float32)
+        for index, edge in enumerate(self.band_edges):
+            if index == len(self.band_edges) - 1:
+                inside = np.ones(distance.shape, np.float32)
+            else:
+                mask = default_library.get_mask(shape, edge * highest, 0, 1, self.profile)
+                inside = mask * mask
+            projection[:, self.radial_bins + self.angular_bins + index] = ((inside - low_pass) * weights).ravel()
+            low_pass = inside
+        projection[:, -1] = weights.ravel()
+
+        counts = np.bincount(radial.ravel(), weights.ravel(), minlength=self.radial_bins).astype(np.float32)
+        counts = np.maximum(counts, 1)
+        self._projections[shape] = (projection, counts)
+        return projection, counts
+
+
+# Gets the spatial statistics (see SPATIAL_STATISTICS) of a stack of float32 images (images, height, width)
+def spatial_statistics(images):
+    pixels = images.reshape(len(images), -1)
+    mean = pixels.mean(axis=1)
+    centered = pixels - mean[:, None]
+    squared = centered * centered
+    variance = squared.mean(axis=1)
+    std = np.sqrt(variance)
+    # central moments standardized at the end, the powers of the whole stack are not computed twice
+    # (0 for the flat images)
+    flat = variance == 0
+    variance[flat] = 1
+    skewness = np.einsum('ij,ij->i', squared, centered) / pixels.shape[1] / (variance * np.sqrt(variance))
+    kurtosis = np.einsum('ij,ij->i', squared, squared) / pixels.shape[1] / (variance * variance) - 3
+    skewness[flat] = 0
+    kurtosis[flat] = 0
+    gradient_x = np.abs(np.diff(images, axis=2)).mean(axis=(1, 2))
+    gradient_y = np.abs(np.diff(images, axis=1)).mean(axis=(1, 2))
+    percentiles = np.percentile(pixels, (10, 50, 90), axis=1)
+    return np.column_stack((mean, std, skewness, kurtosis, gradient_x, gradient_y, *percentiles)).astype(np.float32)
@@ -3,13 +3,22 @@ import tkinter as tk
 from tkinter.filedialog import askopenfilename
 import matplotlib.pyplot as plt
 from ImageProcessing import ImageProcessing 
+from FilterWorker import FilterWorker
+from Instrumentation import Instrumentation, format_breakdown
+from OutputSink import NullSink
+import cv2
 import math
 from PIL import Image, ImageTk
 from os.path import exists
 
 
 drag_id = ''
+preview_id = ''
 placeholder = True
+# results of the filters being displayed, (filtered image, filtered spectrum) by color setting ('RGB', 'Grayscale')
+filtered_results = {}
+# panels currently displayed, see render_panel
+panel_cache = {}
 root_w = 0
 root_h = 0
 
@@ -50,10 +59,8 @@ def dragging(event):
         # schedule stop_drag
         drag_id = root.after(100, stop_drag)
 
-# fix the image size to fit in the label
-def resize_image_to_display(img):    
-    # gain current image dimension
-    img_w, img_h = img.size
+# fix the image size to fit in the label: evaluate the size of an image of the given dimensions once resized
+def display_size(img_w, img_h):
     # calculate current image aspect ratio
     aspect_ratio = img_w/img_h
     # evaluate which dimension to take for max dimension defined above so that the other does 
@@ -69,67 +76,68 @@ def resize_image_to_display(img):
         # as follows: max_w/aspect_ratio
         new_size = (max_w, int(max_w/aspect_ratio))
     
-    res_img = img.resize(new_size)
-    return res_img
+    return new_size
+
+# render an array in a label, unless the label already shows it at the same size and color setting:
+# the panels are cached by label and color setting as (source array, size, tk photo image), so moving the window 
+# or switching back to a color setting does not convert and resize again the panels that did not change
+def render_panel(label, source, mode):
+    size = display_size(source.shape[1], source.shape[0])
+    cached = panel_cache.get((label, mode))
+    if cached is not None and cached[0] is source and cached[1] == size:
+        tk_img = cached[2]
+    else:
+        # resize the array before converting it, area interpolation when shrinking (fast and without aliasing)
+        interpolation = cv2.INTER_AREA if size[0] < source.shape[1] else cv2.INTER_LINEAR
+        resized = cv2.resize(source, size, interpolation=interpolation)
+        # convert image to tk photo image
+        tk_img = ImageTk.PhotoImage(image = Image.fromarray(resized))
+        panel_cache[(label, mode)] = (source, size, tk_img)
+    # the label may show the panel of the other color setting
+    if getattr(label, 'image', None) is not tk_img:
+        label.image = tk_img
+        label.configure(image = tk_img, width=max_w, height=max_h)
 
 # show images in the labels
 def display_images(image, channels):
+    # the spectra are only rendered at the resolution of the labels
+    size = (max_w, max_h)
     # if working with color 
     if len(channels):
-        # convert image from np array to image and resize it
-        og_img = resize_image_to_display(Image.fromarray(image.image))
-        # convert image to tk photo image
-        tk_og_img = ImageTk.PhotoImage(image = og_img)
-        # convert image from np array to image and resize it
-        sp_og_img = resize_image_to_display(Image.fromarray(image.magnitude_spectrum_RGB[0]))
-        # convert image to tk photo image
-        tk_sp_og_img = ImageTk.PhotoImage(image = sp_og_img)
-        # convert image from np array to image and resize it
-        filtered_img = resize_image_to_display(Image.fromarray(image.filtered_image_RGB))
-        # convert image to tk photo image
-        tk_filtered_img = ImageTk.PhotoImage(image = filtered_img)
-        # convert image from np array to image and resize it
-        sp_filtered_img = resize_image_to_display(Image.fromarray(image.filtered_magnitude_spectrum_RGB[0]))
-        # convert image to tk photo image
-        tk_sp_filtered_img = ImageTk.PhotoImage(image = sp_filtered_img)
+        mode = 'RGB'
+        original, original_spectrum = image.image, image.get_magnitude_spectrum(0, size)
     else:
-        # convert image from np array to image and resize it
-        og_img = resize_image_to_display(Image.fromarray(image.image_gray))
-        # convert image to tk photo image
-        tk_og_img = ImageTk.PhotoImage(image = og_img)
-        # convert image from np array to image and resize it
-        sp_og_img = resize_image_to_display(Image.fromarray(image.magnitude_spectrum_gray))
-        # convert image to tk photo image
-        tk_sp_og_img = ImageTk.PhotoImage(image = sp_og_img)
-        # convert image from np array to image and resize it
-        filtered_img = resize_image_to_display(Image.fromarray(image.filtered_image_gray))
-        # convert image to tk photo image
-        tk_filtered_img = ImageTk.PhotoImage(image = filtered_img)
-        # convert image from np array to image and resize it
-        sp_filtered_img = resize_image_to_display(Image.fromarray(image.filtered_magnitude_spectrum_gray))
-        # convert image to tk photo image
-        tk_sp_filtered_img = ImageTk.PhotoImage(image = sp_filtered_img)
+        mode = 'Grayscale'
+        original, original_spectrum = image.image_gray, image.get_magnitude_spectrum(None, size)
+    # until a filter is applied the modified panels show the original
+    filtered, filtered_spectrum = filtered_results.get(mode, (original, original_spectrum))
 
     # display images
-    og_img_label.image = tk_og_img
-    og_img_label.configure(image = tk_og_img)
-    og_img_spec_label.image = tk_sp_og_img
-    og_img_spec_label.configure(image = tk_sp_og_img, width=max_w, height=max_h)
-    mod_img_label.image = tk_filtered_img
-    mod_img_label.configure(image = tk_filtered_img, width=max_w, height=max_h)
-    mod_img_spec_label.image = tk_sp_filtered_img
-    mod_img_spec_label.configure(image = tk_sp_filtered_img, width=max_w, height=max_h)
+    render_panel(og_img_label, original, mode)
+    render_panel(og_img_spec_label, original_spectrum, mode)
+    render_panel(mod_img_label, filtered, mode)
+    render_panel(mod_img_spec_label, filtered_spectrum, mode)
 
 #  load the image and create the ImageProcessing object
 def load_image(file_path):
     if file_path != '':
-        global image
+        global image, filter_image, preview_image
+        # results of the previous image are not wanted anymore
+        worker.cancel()
+        filtered_results.clear()
+        panel_cache.clear()
+        # ImageProcessing is not thread safe: the main thread displays the original image and spectra of its own instance,
+        # the worker thread filters a private one sharing the decoded image (never modified), so that the filters never
+        # touch the caches the main thread is reading and the main thread never waits for a filter
         image = ImageProcessing(file_path)
+        # the stages of the full resolution filters are measured and shown in the status
+        filter_image = ImageProcessing(file_path, image=image.image, instrumentation=Instrumentation())
         
         global max_h, max_w, placeholder
         placeholder = False
         max_w = int(root.winfo_width()*.313)
         max_h = int(root.winfo_height()*.373)
+        preview_image = make_preview(image)
 
         display_images(image, channels)
         
@@ -153,24 +161,91 @@ def browseFiles():
     file_path = askopenfilename(title = "Select a File", filetypes = [("Images", "*.jpeg"), ("all files", "*.*")])
     load_image(file_path)
     
-#  apply the filter with the selected variables
-def apply_filter():
-    
-    if selected.get() == 'RGB':
-        channels = [0,1,2]
+# create the low resolution copy of the image used for the live preview, 
+# it is not larger than the labels so filtering it is fast and shows the same as the full resolution at display size,
+# as filter_image it is only used by the worker thread
+def make_preview(image):
+    img_h, img_w = image.image.shape[0:2]
+    new_size = display_size(img_w, img_h)
+    if new_size[0] >= img_w or new_size[1] >= img_h:
+        proxy = image.image
     else:
-        channels = []
+        proxy = cv2.resize(image.image, new_size, interpolation=cv2.INTER_AREA)
+    # the preview results are only displayed, never written
+    return ImageProcessing(image.image_path, sink=NullSink(), image=proxy)
 
+# get the job filtering the given image with the selected variables, run by the worker thread (the image must be one
+# of the instances only used by the worker, filter_image or preview_image):
+# it returns copies of what is displayed so that the main thread never reads arrays the worker is writing,
+# followed by the breakdown of the time by stage of the filter
+def filter_job(target):
+    channels = [0,1,2] if selected.get() == 'RGB' else []
     direction = var_filter.get()
     radius = sli_radius.get()
     intensity = sli_intensity.get()
-    image.custom_filter(channels, radius, intensity, direction)
-    display_images(image, channels)
+    profile = selected_profile.get().lower()
+    size = (max_w, max_h)
+    def job():
+        target.instrumentation.reset()
+        filtered = target.custom_filter(channels, radius, intensity, direction, profile)
+        if len(channels):
+            filtered = filtered.copy()
+        spectrum = target.get_filtered_magnitude_spectrum(channels[0] if len(channels) else None, size)
+        return filtered, spectrum, target.instrumentation.breakdown()
+    return job
+
+#  apply the filter with the selected variables on the full resolution image
+def apply_filter(*args):
+    global preview_id
+    if placeholder:
+        return
+    # a scheduled preview would only replace this request
+    if preview_id != '':
+        root.after_cancel(preview_id)
+        preview_id = ''
+    worker.submit(filter_job(filter_image), (selected.get(), 'full'))
+    label_status.config(text='Filtering...')
+
+# schedule the preview after a slider move, only the last move of a quick sequence is filtered (debounce)
+def schedule_preview(*args):
+    global preview_id
+    if placeholder or not live_preview.get():
+        return
+    if preview_id != '':
+        root.after_cancel(preview_id)
+    preview_id = root.after(80, run_preview)
+
+def run_preview():
+    global preview_id
+    preview_id = ''
+    worker.submit(filter_job(preview_image), (selected.get(), 'preview'))
+    label_status.config(text='Preview...')
+
+# full resolution pass when the slider is released (live preview only, otherwise the Filter button is used)
+def release_slider(event):
+    if live_preview.get():
+        apply_filter()
+
+# collect the results of the worker thread and display them, widgets can only be updated from the main thread
+def poll_results():
+    for (mode, kind), result in worker.poll():
+        if isinstance(result, Exception):
+            label_status.config(text=f"Filter failed: {result}")
+            continue
+        filtered_results[mode] = result[:2]
+        if mode == selected.get():
+            display_images(image, channels)
+        if kind == 'preview':
+            label_status.config(text='Preview')
+        else:
+            label_status.config(text=f"Filtered: {format_breakdown(result[2])}")
+    root.after(30, poll_results)
 
 def main():
     # Create the root window and set it's parameters
-    global root
+    global root, worker
     root = tk.Tk()
+    worker = FilterWorker()
     root.title('Image processing')
     root.state('zoomed')
     root.resizable(width=False, height=False)
@@ -262,25 +337,48 @@ def main():
     global var_filter
     var_filter = tk.IntVar()
     # actual radio button element
-    R1 = tk.Radiobutton(controls_area, text="HPF", variable=var_filter, value=0, fg='#000')
+    R1 = tk.Radiobutton(controls_area, text="HPF", variable=var_filter, value=0, fg='#000', command=schedule_preview)
     R1.pack(side='top', fill='x', padx=15, pady=(20,10))
-    R2 = tk.Radiobutton(controls_area, text="LPF", variable=var_filter, value=1, fg='#000')
+    R2 = tk.Radiobutton(controls_area, text="LPF", variable=var_filter, value=1, fg='#000', command=schedule_preview)
     R2.pack(side='top', fill='x', padx=15, pady=(10,20))
+    # Dropdown of the mask profile
+    global selected_profile
+    selected_profile = tk.StringVar()
+    selected_profile.set('Circle')
+    profile_dropdown = tk.OptionMenu(controls_area, selected_profile, 'Circle', 'Gaussian', 'Butterworth', command=schedule_preview)
+    profile_dropdown.config(width=25, fg='#000')
+    profile_dropdown.pack(side='top', fill='x', padx=15, pady=(0,20))
     # Slider radius
     global sli_radius, sli_intensity
-    sli_radius = tk.Scale(controls_area, from_=0, to=100, orient=tk.HORIZONTAL, label='Radius of filter (% of image width)', tickinterval=10, fg='#000')
+    sli_radius = tk.Scale(controls_area, from_=0, to=100, orient=tk.HORIZONTAL, label='Radius of filter (% of image width)', tickinterval=10, fg='#000', command=schedule_preview)
+    sli_radius.bind('<ButtonRelease-1>', release_slider)
     sli_radius.pack(side='top', fill='x', padx=15, pady=20)
     # Slider intensity
     label_text = f"Dampening intensity (% of image width)"
-    sli_intensity = tk.Scale(controls_area, from_=0, to=99.9, orient=tk.HORIZONTAL, label=label_text, tickinterval=10, fg='#000')
+    sli_intensity = tk.Scale(controls_area, from_=0, to=99.9, orient=tk.HORIZONTAL, label=label_text, tickinterval=10, fg='#000', command=schedule_preview)
+    sli_intensity.bind('<ButtonRelease-1>', release_slider)
     sli_intensity.pack(side='top', fill='x', padx=15, pady=20)
+    # Live preview: the sliders filter a low resolution copy of the image while they move
+    global live_preview
+    live_preview = tk.BooleanVar()
+    live_preview.set(True)
+    check_preview = tk.Checkbutton(controls_area, text='Live preview', variable=live_preview, fg='#000')
+    check_preview.pack(side='top', fill='x', padx=15, pady=(0,20))
     # Button to apply filter
     global button_filter
     button_filter = tk.Button(controls_area, text = "Filter", height=2, width=15, command = apply_filter, fg='#000')  
     button_filter['state'] = 'disabled'
     button_filter.pack(side='bottom', fill='x', padx=15, pady=(30,10))
+    # Status of the filtering
+    global label_status
+    # wrapped since it shows the breakdown of the stages of the last filter
+    label_status = tk.Label(controls_area, text='', bg='gray95', fg='#000', wraplength=250, justify='left')
+    label_status.pack(side='bottom', fill='x', padx=15)
+
 
 
+    # Start collecting the results of the filters
+    root.after(30, poll_results)
 
     # Let the window wait for any events
     root.mainloop()
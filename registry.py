@@ -0,0 +1,257 @@
+import json
+import os
+import numpy as np
+
+
+# Kinds of models saved by the registry and the attributes telling them apart (no estimator class is imported):
+#  - 'linear' -> logistic regressions: trainer.LogisticTrainer (weights, bias) and sklearn (coef_, intercept_)
+#  - 'forest' -> sklearn random forests (estimators_), 'tree' -> sklearn decision trees (tree_)
+#  - 'svc' -> sklearn binary SVC (support_vectors_)
+#  - 'knn' -> sklearn KNeighborsClassifier (_fit_X)
+#  - 'ann' -> ann.ApproximateKNN (leaves)
+KINDS = ('linear', 'forest', 'tree', 'svc', 'knn', 'ann')
+
+# Dtypes of the large arrays (weights, support vectors, training samples), the computations are always in float32
+DTYPES = ('float32', 'float16')
+
+
+# Model registry: the trained classifiers of Image_Classification.ipynb saved with the preprocessing of their inputs
+# so that they can be used outside the notebook without retraining.
+# A model is a directory holding a meta.json (kind, classes, preprocessing, scalar parameters) and one .npy file per
+# array: the weights of the linear models, the nodes of the trees flattened in a few arrays (all the trees of a forest
+# concatenated), the support vectors, the training samples of the KNN. Loading maps the arrays in memory and builds a
+# small numpy predictor, neither sklearn nor the estimator is imported, so a scoring process starts in a fraction of
+# a second and only reads the pages of the arrays it actually uses.
+#
+#   models/random_forest/meta.json      {"kind": "forest", "classes": [0.0, 1.0], "preprocessing": {...}, ...}
+#   models/random_forest/left.npy       children, feature, threshold and value of every node
+#   ...
+#
+# The preprocessing is a dictionary describing how an image becomes the input of the model (see Model.prepare):
+#  - image_size -> side of the grayscale images
+#  - offset, scale -> the pixels are mapped to (pixel - offset) * scale
+#  - features -> 'pixels' (flattened image) or 'spectral' (features.SpectralFeatures descriptor)
+#  - mean, std -> optional standardization of the inputs (lists, one value per input)
+
+
+# Saves a trained model, accepts 4 arguments:
+#  - path -> directory of the model (created, the files of a previous model there are replaced)
+#  - model -> trained classifier (see KINDS), searches (best_estimator_) are saved as their best estimator
+#  - preprocessing -> dictionary describing the inputs of the model
+#  - dtype -> dtype of the large arrays, see DTYPES
+def save_model(path, model, preprocessing=None, dtype='float32'):
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype '{dtype}', available dtypes: {', '.join(DTYPES)}")
+    if hasattr(model, 'best_estimator_'):
+        model = model.best_estimator_
+    kind, classes, params, arrays = export(model, np.dtype(dtype))
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    if kind == 'ann':
+        model.save(os.path.join(path, 'index'))
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+    meta = {'kind': kind, 'classes': np.asarray(classes).tolist(), 'preprocessing': preprocessing or {}, 'params': params, 'arrays': sorted(arrays)}
+    # meta.json is written last, a directory without it is not a complete model
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=1)
+
+
+# Gets the kind, the classes, the scalar parameters and the arrays describing a model
+def export(model, dtype):
+    if hasattr(model, 'leaves'):
+        return 'ann', model.classes, {}, {}
+    if hasattr(model, 'estimators_') or hasattr(model, 'tree_'):
+        trees = [estimator.tree_ for estimator in model.estimators_] if hasattr(model, 'estimators_') else [model.tree_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        # children of the nodes moved by the offset of their tree, the leaves keep -1
+        left = np.concatenate([np.where(tree.children_left < 0, -1, tree.children_left + offset) for tree, offset in zip(trees, offsets)])
+        right = np.concatenate([np.where(tree.children_right < 0, -1, tree.children_right + offset) for tree, offset in zip(trees, offsets)])
+        value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        value = value / np.maximum(value.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny)
+        arrays = {
+            'left': left.astype(np.int32),
+            'right': right.astype(np.int32),
+            'feature': np.concatenate([np.maximum(tree.feature, 0) for tree in trees]).astype(np.int32),
+            # thresholds stay float64: the trees compare the float32 inputs with them exactly as sklearn does
+            'threshold': np.concatenate([tree.threshold for tree in trees]),
+            'value': value.astype(dtype),
+            'roots': offsets[:-1].astype(np.int32),
+        }
+        params = {'max_depth': max(tree.max_depth for tree in trees)}
+        return 'forest' if hasattr(model, 'estimators_') else 'tree', model.classes_, params, arrays
+    if hasattr(model, 'support_vectors_'):
+        if len(model.classes_) != 2:
+            raise ValueError('Only binary SVC models are supported')
+        params = {'kernel': model.kernel, 'gamma': float(model._gamma), 'coef0': float(model.coef0), 'degree': int(model.degree)}
+        arrays = {'support_vectors': model.support_vectors_.astype(dtype), 'dual_coef': model.dual_coef_.ravel().astype(np.float32),
+                  'intercept': model.intercept_.astype(np.float32)}
+        return 'svc', model.classes_, params, arrays
+    if hasattr(model, '_fit_X'):
+        if model.weights != 'uniform' or model.effective_metric_ != 'euclidean':
+            raise ValueError('Only KNN models with uniform weights and euclidean distance are supported')
+        arrays = {'points': model._fit_X.astype(dtype), 'labels': model._y.astype(np.int32)}
+        return 'knn', model.classes_, {'n_neighbors': model.n_neighbors}, arrays
+    if hasattr(model, 'coef_'):
+        if model.coef_.shape[0] != 1:
+            raise ValueError('Only binary linear models are supported')
+        arrays = {'weights': model.coef_.ravel().astype(dtype), 'bias': model.intercept_.astype(np.float32)}
+        return 'linear', model.classes_, {}, arrays
+    if hasattr(model, 'weights'):
+        # trainer.LogisticTrainer, labels 0 and 1
+        arrays = {'weights': np.asarray(model.weights).astype(dtype), 'bias': np.asarray([model.bias], np.float32)}
+        return 'linear', [0.0, 1.0], {}, arrays
+    raise ValueError(f"Unsupported model {type(model).__name__}, supported kinds: {', '.join(KINDS)}")
+
+
+# Loads a model saved with save_model, the arrays are memory mapped
+def load_model(path):
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+    return PREDICTORS[meta['kind']](path, meta, arrays)
+
+
+# Gets the names of the models saved in a directory
+def list_models(root='models'):
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root) if os.path.exists(os.path.join(root, name, 'meta.json')))
+
+
+# Loaded model, the predictors of every kind implement decision (one row of class scores per input)
+class Model:
+
+    # Kind of the model (see KINDS), labels of the classes and preprocessing
+    kind : str
+    classes : np.ndarray
+    preprocessing : dict
+
+    # Inputs scored at once, bounds the memory of the intermediates
+    chunk_size = 256
+
+    def __init__(self, path, meta, arrays):
+        self.path = path
+        self.kind = meta['kind']
+        self.classes = np.asarray(meta['classes'])
+        self.preprocessing = meta['preprocessing']
+        self.params = meta['params']
+        self.arrays = arrays
+        self._features = None
+
+    # Gets the inputs of the model from a stack of grayscale images (images, image_size, image_size) of uint8
+    def prepare(self, images):
+        preprocessing = self.preprocessing
+        # float64 as the notebook, so the inputs rounded to float32 are the same the models were trained on
+        x = (np.asarray(images, np.float64) - preprocessing.get('offset', 0)) * preprocessing.get('scale', 1)
+        x = x.astype(np.float32)
+        if preprocessing.get('features', 'pixels') == 'spectral':
+            if self._features is None:
+                # imported only by the models using it
+                from features import SpectralFeatures
+                self._features = SpectralFeatures(**preprocessing.get('feature_params', {}))
+            x = self._features.transform(x)
+        else:
+            x = x.reshape(len(x), -1)
+        if 'mean' in preprocessing:
+            x = (x - np.asarray(preprocessing['mean'], np.float32)) / np.asarray(preprocessing['std'], np.float32)
+        return x
+
+    # Gets the predicted class of some inputs (inputs, features), a chunk at a time
+    def predict(self, x):
+        predictions = [self.classes[self.decision(np.asarray(x[start:start + self.chunk_size], np.float32)).argmax(axis=1)]
+                       for start in range(0, len(x), self.chunk_size)]
+        return np.concatenate(predictions) if predictions else self.classes[:0]
+
+    # Gets the predicted class of a stack of grayscale images, see prepare
+    def predict_images(self, images):
+        return self.predict(self.prepare(images))
+
+    def score(self, x, y):
+        return float(np.mean(self.predict(x) == np.asarray(y).ravel()))
+
+
+class LinearModel(Model):
+
+    def decision(self, x):
+        decision = x @ np.asarray(self.arrays['weights'], np.float32) + self.arrays['bias'][0]
+        return np.column_stack((-decision, decision))
+
+
+class TreeModel(Model):
+
+    def decision(self, x):
+        left, right, feature, threshold, value, roots = (self.arrays[name] for name in ('left', 'right', 'feature', 'threshold', 'value', 'roots'))
+        rows = np.arange(len(x))[:, None]
+        node = np.repeat(np.asarray(roots)[None, :], len(x), axis=0)
+        # all the samples descend all the trees together, one level at a time
+        for _ in range(self.params['max_depth']):
+            leaf = left[node] < 0
+            if leaf.all():
+                break
+            below = x[rows, feature[node]] <= threshold[node]
+            node = np.where(leaf, node, np.where(below, left[node], right[node]))
+        return np.asarray(value[node], np.float32).mean(axis=1)
+
+
+class SVCModel(Model):
+
+    def decision(self, x):
+        vectors = np.asarray(self.arrays['support_vectors'], np.float32)
+        kernel, gamma = self.params['kernel'], np.float32(self.params['gamma'])
+        products = x @ vectors.T
+        if kernel == 'rbf':
+            # |x - v|^2 = |x|^2 + |v|^2 - 2 x.v
+            squared = np.einsum('ij,ij->i', x, x)[:, None] + np.einsum('ij,ij->i', vectors, vectors)[None, :] - 2 * products
+            products = np.exp(-gamma * np.maximum(squared, 0))
+        elif kernel == 'poly':
+            products = (gamma * products + np.float32(self.params['coef0'])) ** self.params['degree']
+        elif kernel == 'sigmoid':
+            products = np.tanh(gamma * products + np.float32(self.params['coef0']))
+        decision = products @ self.arrays['dual_coef'] + self.arrays['intercept'][0]
+        return np.column_stack((-decision, decision))
+
+
+class KNNModel(Model):
+
+    def decision(self, x):
+        points = self.arrays['points']
+        n_neighbors = self.params['n_neighbors']
+        # the training samples are compared a block at a time, keeping the nearest found so far
+        nearest_distances = np.full((len(x), 0), np.inf, np.float32)
+        nearest_labels = np.empty((len(x), 0), np.int32)
+        squared = np.einsum('ij,ij->i', x, x)[:, None]
+        for start in range(0, len(points), 4096):
+            block = np.asarray(points[start:start + 4096], np.float32)
+            distances = squared + np.einsum('ij,ij->i', block, block)[None, :] - 2 * (x @ block.T)
+            distances = np.concatenate((nearest_distances, distances), axis=1)
+            labels = np.concatenate((nearest_labels, np.broadcast_to(self.arrays['labels'][start:start + 4096], (len(x), len(block)))), axis=1)
+            keep = np.argpartition(distances, min(n_neighbors, distances.shape[1]) - 1, axis=1)[:, :n_neighbors]
+            nearest_distances = np.take_along_axis(distances, keep, axis=1)
+            nearest_labels = np.take_along_axis(labels, keep, axis=1)
+        votes = np.zeros((len(x), len(self.classes)), np.float32)
+        np.add.at(votes, (np.repeat(np.arange(len(x)), nearest_labels.shape[1]), nearest_labels.ravel()), 1)
+        return votes
+
+
+class ANNModel(Model):
+
+    def __init__(self, path, meta, arrays):
+        super().__init__(path, meta, arrays)
+        from ann import ApproximateKNN
+        self.index = ApproximateKNN.load(os.path.join(path, 'index'))
+
+    def decision(self, x):
+        prediction = self.index.predict(x)
+        return (prediction[:, None] == self.classes[None, :]).astype(np.float32)
+
+
+PREDICTORS = {
+    'linear': LinearModel,
+    'forest': TreeModel,
+    'tree': TreeModel,
+    'svc': SVCModel,
+    'knn': KNNModel,
+    'ann': ANNModel,
+}
@@ -0,0 +1,256 @@
+import json
+import math
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+
+# Samples, labels and folds of the worker process, attached to the shared memory by init_worker
+_x = None
+_y = None
+_folds = None
+_memory = None
+
+
+# Initializes a worker process, accepts 3 arguments:
+#  - name -> name of the shared memory block holding the samples followed by the labels (see shared_layout)
+#  - shape -> shape of the samples (rows, features), float32
+#  - folds -> list of (train slice, test slice) of the rows
+def init_worker(name, shape, folds):
+    global _x, _y, _folds, _memory
+    _memory = shared_memory.SharedMemory(name=name)
+    _x = np.ndarray(shape, np.float32, buffer=_memory.buf)
+    _y = np.ndarray(shape[0], np.float32, buffer=_memory.buf, offset=_x.nbytes)
+    _folds = folds
+
+
+# Fits and scores a chain of configurations on one fold, executed in the worker processes
+# accepts 3 arguments:
+#  - estimator -> unfitted estimator, cloned
+#  - chain -> configurations differing only in the path parameter, sorted along it: when the estimator supports
+#             warm_start each fit starts from the solution of the previous one
+#  - fold -> index of the fold
+# returns a list of (params, fold, score, seconds, error)
+def evaluate(estimator, chain, fold):
+    train, test = _folds[fold]
+    # contiguous rows, views of the shared memory and not copies
+    x_train, y_train = _x[train], _y[train]
+    x_test, y_test = _x[test], _y[test]
+    warm = 'warm_start' in estimator.get_params()
+    model = clone(estimator).set_params(warm_start=True) if warm else clone(estimator)
+    results = []
+    for params in chain:
+        start = time.perf_counter()
+        try:
+            model.set_params(**params)
+            model.fit(x_train, y_train)
+            results.append((params, fold, float(model.score(x_test, y_test)), time.perf_counter() - start, None))
+        except Exception as error:
+            results.append((params, fold, math.nan, time.perf_counter() - start, str(error)))
+            # the failed fit may have left a partial solution behind
+            model = clone(estimator).set_params(warm_start=True) if warm else clone(estimator)
+    return results
+
+
+# Hyperparameter search, the replacement of GridSearchCV in Image_Classification.ipynb.
+# The (configuration, fold) pairs run in a pool of processes, the samples are copied once in a shared memory block
+# that all the workers read, laid out so that the train and test rows of every fold are contiguous (see
+# shared_layout): the workers fit on views of the block, nothing is copied per task and nothing is pickled but the
+# bounds of the folds. Estimators needing another dtype or layout (e.g. SVC works in float64) still convert their
+# train rows on every fit, about 2 times the samples per busy worker for SVC. The configurations differing only in
+# path_param (e.g. C of LogisticRegression) are fitted one after the other on the same fold along increasing values,
+# each fit starting from the previous solution (warm start).
+# With successive halving the configurations are first scored on a few folds, only the best 1/factor of them go
+# on to the next round with factor times the folds, until the survivors are scored on all of them.
+# Every finished (configuration, fold) is appended to a JSONL checkpoint, a search started again with the same
+# data and settings skips what is already there:
+#   {"search": "...", "params": {"C": 0.1, "penalty": "l2"}, "fold": 3, "score": 0.84, "seconds": 2.1, "error": null}
+class HyperparameterSearch:
+
+    # Estimator, grid (dictionary or list of dictionaries as ParameterGrid) and number of folds
+    estimator : object
+    grid : object
+    cv : int
+
+    # Parameter whose values are visited with warm starts
+    path_param : str
+
+    # Successive halving: enabled, folds of the first round, kept fraction (1/factor)
+    halving : bool
+    min_folds : int
+    factor : int
+
+    # JSONL file of the finished pairs, None to disable
+    checkpoint : str
+
+    # Results: best configuration, its mean score over all the folds, the estimator with the best configuration
+    # fitted on all the samples and for every configuration {'params', 'score', 'folds', 'errors'}
+    best_params_ : dict
+    best_score_ : float
+    best_estimator_ : object
+    results_ : list
+
+    def __init__(self, estimator, grid, cv=10, path_param='C', halving=True, min_folds=2, factor=3,
+                 checkpoint='cache/search.jsonl', workers=None, random_state=42, refit=True):
+        self.estimator = estimator
+        self.grid = grid
+        self.cv = cv
+        self.path_param = path_param
+        self.halving = halving
+        self.min_folds = min(min_folds, cv)
+        self.factor = factor
+        self.checkpoint = checkpoint
+        self.workers = workers or os.cpu_count()
+        self.random_state = random_state
+        self.refit = refit
+
+    # Runs the search, accepts 2 arguments:
+    #  - x -> samples (samples, features)
+    #  - y -> labels, any shape with one value per sample
+    def fit(self, x, y):
+        y = np.asarray(y, np.float32).ravel()
+        configurations = [{name: plain(value) for name, value in params.items()} for params in ParameterGrid(self.grid)]
+        folds = list(StratifiedKFold(self.cv, shuffle=True, random_state=self.random_state).split(np.zeros(len(y)), y))
+        search = self.fingerprint(x, y)
+        scores = self.resume(search)
+        rows, folds = shared_layout(folds)
+        shape = (len(rows), x.shape[1])
+
+        memory = shared_memory.SharedMemory(create=True, size=shape[0] * (shape[1] + 1) * 4)
+        try:
+            shared = np.ndarray(shape, np.float32, buffer=memory.buf)
+            # copied in chunks, gathering all the rows at once would need another copy of the samples
+            for start in range(0, len(rows), 4096):
+                shared[start:start + 4096] = x[rows[start:start + 4096]]
+            np.ndarray(shape[0], np.float32, buffer=memory.buf, offset=shared.nbytes)[:] = y[rows]
+            del shared
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(memory.name, shape, folds)) as executor:
+                survivors = configurations
+                used_folds = self.min_folds if self.halving else self.cv
+                while True:
+                    self.run_round(executor, survivors, used_folds, scores, search)
+                    if used_folds == self.cv:
+                        break
+                    # the best ones go on with more folds
+                    ranked = sorted(survivors, key=lambda params: -self.mean_score(scores, params, used_folds))
+                    survivors = ranked[:max(1, math.ceil(len(ranked) / self.factor))]
+                    used_folds = min(self.cv, used_folds * self.factor)
+        finally:
+            memory.close()
+            memory.unlink()
+
+        self.results_ = []
+        for params in configurations:
+            evaluated = [scores[(key(params), fold)] for fold in range(self.cv) if (key(params), fold) in scores]
+            self.results_.append({'params': params, 'score': nanmean([score for score, _ in evaluated]), 'folds': len(evaluated),
+                                  'errors': [error for _, error in evaluated if error]})
+        complete = [result for result in self.results_ if result['folds'] == self.cv and not math.isnan(result['score'])]
+        if not complete:
+            raise ValueError('All the fits of the search failed: ' + '; '.join(sorted({error for result in self.results_ for error in result['errors']})))
+        best = max(complete, key=lambda result: result['score'])
+        self.best_params_, self.best_score_ = best['params'], best['score']
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(x, y)
+        return self
+
+    # Submits the missing (configuration, fold) pairs of a round and waits for them
+    def run_round(self, executor, configurations, used_folds, scores, search):
+        chains = {}
+        for params in configurations:
+            for fold in range(used_folds):
+                if (key(params), fold) not in scores:
+                    group = key({name: value for name, value in params.items() if name != self.path_param})
+                    chains.setdefault((group, fold), []).append(params)
+        futures = []
+        for (_, fold), chain in chains.items():
+            chain.sort(key=lambda params: params.get(self.path_param, 0))
+            futures.append(executor.submit(evaluate, self.estimator, chain, fold))
+        for future in as_completed(futures):
+            for params, fold, score, seconds, error in future.result():
+                scores[(key(params), fold)] = (score, error)
+                self.save(search, params, fold, score, seconds, error)
+
+    # Gets the mean score of a configuration over the first folds (failed fits count as the worst score)
+    def mean_score(self, scores, params, used_folds):
+        values = [scores[(key(params), fold)][0] for fold in range(used_folds)]
+        return -math.inf if any(math.isnan(value) for value in values) else float(np.mean(values))
+
+    # Gets the results of the checkpoint belonging to this search, keyed by (configuration, fold)
+    def resume(self, search):
+        scores = {}
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return scores
+        with open(self.checkpoint) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut by an interruption
+                    continue
+                if record.get('search') == search:
+                    score = math.nan if record['score'] is None else record['score']
+                    scores[(key(record['params']), record['fold'])] = (score, record['error'])
+        return scores
+
+    # Appends a finished pair to the checkpoint
+    def save(self, search, params, fold, score, seconds, error):
+        if self.checkpoint is None:
+            return
+        directory = os.path.dirname(self.checkpoint)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        record = {'search': search, 'params': params, 'fold': fold, 'score': None if math.isnan(score) else score, 'seconds': seconds, 'error': error}
+        with open(self.checkpoint, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+    # Gets a string identifying the data, the estimator and the folds, the results of a different search are not reused
+    #  - x -> samples, hashed as float32 a chunk of rows at a time (the same checksum as the whole matrix, without a copy of it)
+    #  - y -> contiguous float32 labels
+    def fingerprint(self, x, y):
+        checksum = 0
+        for start in range(0, len(x), 4096):
+            checksum = zlib.crc32(memoryview(np.ascontiguousarray(x[start:start + 4096], np.float32)).cast('B'), checksum)
+        checksum = zlib.crc32(memoryview(y).cast('B'), checksum)
+        return f"{type(self.estimator).__name__}{sorted(self.estimator.get_params().items())}:{x.shape}:{self.cv}:{self.random_state}:{checksum:08x}"
+
+    def predict(self, x):
+        return self.best_estimator_.predict(x)
+
+    def score(self, x, y):
+        return self.best_estimator_.score(x, np.asarray(y).ravel())
+
+
+# Gets the order of the rows of the shared memory and the bounds of the folds in it, accepts 1 argument:
+#  - folds -> list of (train rows, test rows) of a k-fold split, the test rows of all the folds covering the samples
+# The test rows of the folds are laid out one after the other, followed again by the first k - 1 folds:
+#   f0 f1 f2 ... fk-1 f0 f1 ... fk-2
+# so that the train rows of fold i, all the other folds, are the contiguous fi+1 ... fk-1 f0 ... fi-1.
+# returns the sample of every row (about twice the samples) and the list of (train slice, test slice)
+def shared_layout(folds):
+    tests = [np.asarray(test) for _, test in folds]
+    order = np.concatenate(tests)
+    starts = np.concatenate(([0], np.cumsum([len(test) for test in tests])))
+    rows = np.concatenate((order, order[:len(order) - len(tests[-1])]))
+    bounds = [(slice(int(starts[fold + 1]), int(starts[fold] + len(order))), slice(int(starts[fold]), int(starts[fold + 1])))
+              for fold in range(len(tests))]
+    return rows, bounds
+
+
+# Gets a hashable key of a configuration
+def key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+# Converts numpy scalars to the python ones (JSON serializable)
+def plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+# Gets the mean of some scores, nan when empty or when one of them is nan (a failed fit)
+def nanmean(values):
+    return float(np.mean(values)) if values and not any(math.isnan(value) for value in values) else math.nan
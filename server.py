@@ -0,0 +1,293 @@
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+from PIL import Image
+from dataset import decode_flag
+from registry import load_model
+
+
+# Local inference service classifying images with a model of the registry (see registry.py).
+# Every connection is served by its own thread, the images of a request are decoded, resized and turned into the
+# inputs of the model by a pool of threads (opencv releases the GIL), then handed to the batcher: a single thread
+# collecting the inputs of the concurrent requests in a micro-batch, closed when it is full or when its oldest
+# input has waited max_latency, and scored with one vectorized call of the model.
+#
+#   request threads      decode pool          batcher
+#   ---------------      -----------          -------------------------------------
+#   POST /predict  --->  decode, resize  -->  [ inputs of several requests ]  --> model.predict
+#   POST /predict  --->  decode, resize  -->  |
+#
+# Endpoints:
+#  - POST /predict -> body an encoded image (any content type but application/json) or a JSON {"images": [base64, ...]},
+#                     answers {"classes": [...]}
+#  - GET /metrics -> counters, latency percentiles and throughput (see Metrics)
+#  - GET /health -> {"status": "ok"}
+
+
+# Counters of the service, updated by the request threads and the batcher
+class Metrics:
+
+    # Latencies (seconds) of the most recent requests, the percentiles are evaluated on them
+    latencies : deque
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record_request(self, seconds, images):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.images += images
+
+    def record_batch(self):
+        with self._lock:
+            self.batches += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    # Gets a snapshot of the counters as a dictionary
+    def snapshot(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.perf_counter() - self.started
+            p50, p99 = np.percentile(latencies, (50, 99)) * 1000 if len(latencies) else (0.0, 0.0)
+            return {
+                'requests': self.requests,
+                'images': self.images,
+                'batches': self.batches,
+                'errors': self.errors,
+                'mean_batch_size': self.images / self.batches if self.batches else 0.0,
+                'latency_p50_ms': float(p50),
+                'latency_p99_ms': float(p99),
+                'throughput_images_per_s': self.images / elapsed if elapsed else 0.0,
+                'uptime_s': elapsed,
+            }
+
+
+# Collects the inputs of concurrent requests in micro-batches scored with a single call of the model
+class MicroBatcher:
+
+    # Maximum number of inputs of a batch and maximum time (seconds) the first input of a batch waits for others
+    max_batch : int
+    max_latency : float
+
+    def __init__(self, model, metrics, max_batch=64, max_latency=0.01):
+        self.model = model
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self._thread.start()
+
+    # Schedules the inputs (inputs, features) of a request, returns a future of their predicted classes
+    def submit(self, inputs):
+        future = Future()
+        self._queue.put((inputs, future))
+        return future
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            deadline = time.perf_counter() + self.max_latency
+            # the batch is closed when full or at the deadline of its first request
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[0])
+            try:
+                predictions = self.model.predict(np.concatenate([inputs for inputs, _ in pending]))
+            except Exception as error:
+                for _, future in pending:
+                    future.set_exception(error)
+                continue
+            self.metrics.record_batch()
+            start = 0
+            for inputs, future in pending:
+                future.set_result(predictions[start:start + len(inputs)])
+                start += len(inputs)
+
+
+# Decodes an encoded image as grayscale resized to size x size, at reduced resolution when the size allows it
+# (see dataset.decode_flag)
+def decode_image(data, size):
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            width, height = header.size
+        flag = decode_flag(width, height, size)
+    except Exception:
+        # a format PIL does not know, opencv may still decode it
+        flag = cv2.IMREAD_GRAYSCALE
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        raise ValueError('Unable to decode the image')
+    return cv2.resize(image, (size, size))
+
+
+# State shared by the request handlers
+class Service:
+
+    def __init__(self, model, threads=None, max_batch=64, max_latency=0.01):
+        self.model = model
+        self.image_size = model.preprocessing.get('image_size', 128)
+        self.metrics = Metrics()
+        self.pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count(), thread_name_prefix='decode')
+        self.batcher = MicroBatcher(model, self.metrics, max_batch, max_latency)
+
+    # Gets the inputs of the model of some encoded images, executed in the pool
+    def prepare(self, images):
+        return self.model.prepare(np.stack([decode_image(data, self.image_size) for data in images]))
+
+    # Classifies some encoded images, returns the list of their classes
+    def classify(self, images):
+        inputs = self.pool.submit(self.prepare, images).result()
+        return self.batcher.submit(inputs).result().tolist()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    # set by make_server
+    service = None
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.reply(200, self.service.metrics.snapshot())
+        elif self.path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.reply(404, {'error': f"Unknown path {self.path}"})
+            return
+        start = time.perf_counter()
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                images = [base64.b64decode(image) for image in json.loads(body)['images']]
+            else:
+                images = [body]
+            if not images or not all(images):
+                raise ValueError('No image in the request')
+        except (ValueError, KeyError, TypeError) as error:
+            self.service.metrics.record_error()
+            self.reply(400, {'error': str(error)})
+            return
+        try:
+            classes = self.service.classify(images)
+        except ValueError as error:
+            self.service.metrics.record_error()
+            self.reply(400, {'error': str(error)})
+            return
+        except Exception as error:
+            self.service.metrics.record_error()
+            self.reply(500, {'error': str(error)})
+            return
+        self.service.metrics.record_request(time.perf_counter() - start, len(images))
+        self.reply(200, {'classes': classes})
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+# Creates the server, accepts 4 arguments:
+#  - service -> the Service answering the requests
+#  - address -> (host, port) for HTTP over TCP
+#  - unix_socket -> path of a unix socket, used instead of the address when given
+#  - backlog -> connections waiting to be accepted, the default of socketserver (5) resets the connections of a
+#               burst of concurrent clients, the very load the micro-batches are made for (capped by the system,
+#               net.core.somaxconn on Linux)
+def make_server(service, address=('127.0.0.1', 8000), unix_socket=None, backlog=128):
+    handler = type('ServiceHandler', (Handler,), {'service': service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, handler, bind_and_activate=False)
+    else:
+        server = ThreadingHTTPServer(address, handler, bind_and_activate=False)
+    # listen() is called by server_activate with the queue size of the server
+    server.request_queue_size = backlog
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a model of the registry, classifying the images posted to /predict')
+    parser.add_argument('model', help='directory of the model, e.g. models/svm')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    parser.add_argument('--unix-socket', default=None, help='listen on a unix socket instead of host and port')
+    parser.add_argument('--max-batch', type=int, default=64, help='maximum images per model call (default: 64)')
+    parser.add_argument('--max-latency-ms', type=float, default=10, help='maximum wait of a request for a batch to fill (default: 10)')
+    parser.add_argument('--backlog', type=int, default=None, help='connections waiting to be accepted (default: 128, at least twice --max-batch)')
+    parser.add_argument('--threads', type=int, default=None, help='decoding threads (default: one per cpu)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = Service(load_model(args.model), args.threads, args.max_batch, args.max_latency_ms / 1000)
+    server = make_server(service, (args.host, args.port), args.unix_socket, args.backlog or max(128, 2 * args.max_batch))
+    print(f"Serving {args.model} on {args.unix_socket or f'http://{args.host}:{args.port}'}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())
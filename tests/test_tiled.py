@@ -0,0 +1,51 @@
+import numpy as np
+import cv2
+import pytest
+import tiled
+from ImageProcessing import ImageProcessing
+from OutputSink import NullSink
+
+
+# smooth shapes plus noise, so that the spectrum is not flat
+def make_image(height=120, width=160, seed=0):
+    random = np.random.default_rng(seed)
+    image = cv2.resize((random.random((12, 12, 3)) * 255).astype(np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.add(image, (random.random(image.shape) * 32).astype(np.uint8))
+
+
+# Filters an image with filter_tiled (.npy in and out, so that nothing is rounded) and with the whole image
+# frequency filter, returns both results and the estimated error of the tiled kernel
+def filter_both(tmp_path, mode, radius, intensity, direction, profile):
+    processing = ImageProcessing('', sink=NullSink(), image=make_image(), method='frequency')
+    source = processing.image if mode == 'rgb' else processing.image_gray
+    np.save(tmp_path / 'input.npy', source)
+    whole = processing.custom_filter([0, 1, 2] if mode == 'rgb' else [], radius, intensity, direction, profile)
+    result = tiled.filter_tiled(str(tmp_path / 'input.npy'), str(tmp_path / 'output.npy'), radius, intensity, direction, profile, mode, tile_size=48)
+    _, error = tiled.tolerant_kernel(source.shape[:2], (source.shape[1] / 2) * (radius / 100), (100 - intensity) / 100, direction, profile)
+    return np.asarray(result, np.float64), np.asarray(whole, np.float64), error
+
+
+# the smooth profiles match the whole image filter within the tolerance
+@pytest.mark.parametrize('profile', ['gaussian', 'butterworth'])
+@pytest.mark.parametrize('mode', ['gray', 'rgb'])
+@pytest.mark.parametrize('radius, intensity, direction', [(10, 50, 1), (10, 50, 0), (25, 80, 1)])
+def test_smooth_profiles_match_whole_image(tmp_path, profile, mode, radius, intensity, direction):
+    result, whole, error = filter_both(tmp_path, mode, radius, intensity, direction, profile)
+    assert error <= 0.5
+    if mode == 'rgb':
+        # the whole image filter saturates and truncates the 8 bit colors, it is up to one level below the exact value
+        difference = np.clip(result, 0, 255) - whole
+        assert difference.min() >= -0.5 and difference.max() < 1.5
+    else:
+        np.testing.assert_allclose(result, whole, atol=0.5)
+
+
+# the circle mask can't meet the tolerance: it is filtered with a warning, within the estimated error
+@pytest.mark.parametrize('mode', ['gray', 'rgb'])
+def test_circle_warns_and_stays_within_estimate(tmp_path, mode):
+    with pytest.warns(RuntimeWarning, match='circle'):
+        result, whole, error = filter_both(tmp_path, mode, 10, 50, 1, 'circle')
+    assert error > 0.5
+    if mode == 'rgb':
+        result = np.clip(result, 0, 255)
+    assert np.abs(result - whole).max() <= error + 1
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from trainer import LogisticTrainer, log_loss
+
+
+# uint8 samples with labels depending on their first pixels, as the images of the feature store
+def make_samples(samples=600, features=48, seed=0):
+    random = np.random.default_rng(seed)
+    x = (random.random((samples, features)) * 255).astype(np.uint8)
+    y = (x[:, :4].astype(np.float32).mean(axis=1) > 127).astype(np.float32)
+    return x, y
+
+
+# the validation cost of every epoch is the cost on the held out rows scaled once
+@pytest.mark.parametrize('scale', [1 / 255, 0.5])
+def test_held_out_rows_are_scaled_once(scale):
+    x, y = make_samples()
+    held_out = np.sort(np.random.default_rng(3).choice(len(y), int(len(y) * 0.2), replace=False))
+    expected = []
+
+    def callback(epoch, cost, validation_cost):
+        decision = (x[held_out].astype(np.float32) * np.float32(scale)) @ trainer.weights + np.float32(trainer.bias)
+        expected.append(log_loss(decision, y[held_out]))
+
+    trainer = LogisticTrainer(max_epochs=4, patience=10, validation_fraction=0.2, scale=scale, chunk_size=100,
+                              callback=callback, random_state=3)
+    trainer.fit(x, y)
+    assert [validation_cost for _, _, validation_cost in trainer.history] == pytest.approx(expected, rel=1e-5)
+
+
+# the training with scale matches the training on the samples scaled beforehand, early stopping included
+def test_scale_matches_prescaled_samples():
+    x, y = make_samples()
+    scaled = LogisticTrainer(max_epochs=30, patience=2, scale=1 / 255, random_state=1).fit(x, y)
+    prescaled = LogisticTrainer(max_epochs=30, patience=2, random_state=1).fit(x.astype(np.float32) / np.float32(255), y)
+    assert len(scaled.history) == len(prescaled.history)
+    assert [cost for _, _, cost in scaled.history] == pytest.approx([cost for _, _, cost in prescaled.history], rel=1e-4)
+    np.testing.assert_allclose(scaled.weights, prescaled.weights, rtol=1e-4, atol=1e-6)
+
+
+# a validation set passed to fit is read with the same scale as the samples
+def test_explicit_validation_is_scaled():
+    x, y = make_samples()
+    validation = x[500:].astype(np.float32) / np.float32(255)
+    expected = []
+
+    def callback(epoch, cost, validation_cost):
+        expected.append(log_loss(validation @ trainer.weights + np.float32(trainer.bias), y[500:]))
+
+    trainer = LogisticTrainer(max_epochs=3, patience=10, scale=1 / 255, callback=callback, random_state=0)
+    trainer.fit(x[:500], y[:500], validation=(x[500:], y[500:]))
+    assert [validation_cost for _, _, validation_cost in trainer.history] == pytest.approx(expected, rel=1e-5)
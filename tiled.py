@@ -0,0 +1,179 @@
+import argparse
+import os
+import sys
+import tempfile
+import warnings
+import cv2
+import numpy as np
+from FFTBackend import get_backend
+from FilterPlanner import crop, truncation_error
+from MaskLibrary import kernel_size, spatial_kernel
+
+
+# Tiled filtering for images too large to be transformed in one shot.
+# Instead of multiplying the spectrum of the whole image with the mask, the image is convolved with the equivalent
+# spatial kernel (MaskLibrary.spatial_kernel) using overlap-save: the image is read in strips of tile_size rows,
+# each strip is cut in tiles, every tile is extended by half a kernel on each side (the halo) and filtered in the
+# frequency domain, then the halo, corrupted by the circular convolution, is discarded.
+# The halo wraps around the borders of the image, as the spectrum of the whole image does, so the result matches
+# ImageProcessing.custom_filter within the truncation error of the kernel: the kernel is sized so that its estimated
+# error (FilterPlanner.truncation_error, 255 times the discarded absolute sum) stays within a tolerance, 0.5 gray
+# levels by default. That works for the smooth profiles (gaussian, the default, and butterworth), the response of the
+# circle mask decays so slowly that no kernel meets the tolerance: it is filtered with the largest one, with a warning.
+# Peak memory depends on the tile and kernel sizes, not on the image size, as long as the input is a .npy file:
+# the other formats can only be decoded as a whole, the decoded image is then the only thing as large as the image.
+# The output never is, it is always filled strip by strip in a memory mapped file (see open_output).
+#
+#   strip with halo         tile with halo         filtered tile
+#   -----------------       -----------            -----------
+#   |   |   |   |   |       | ------- |            |         |
+#   |   |   |   |   |  -->  | |     | |    -->     |         |  --> written in the output
+#   |   |   |   |   |       | ------- |            |         |
+#   -----------------       -----------            -----------
+
+
+# Opens the input image, accepts 2 arguments:
+#  - input_path -> image file, .npy files (height, width) or (height, width, colors(RGB)) are memory mapped
+#                  so that only the strip being filtered is read, the other formats are decoded as a whole
+#  - mode -> 'rgb' or 'gray'
+# returns the image with the colors as RGB, a view for the decoded formats (no second copy of the image)
+def open_image(input_path, mode):
+    if input_path.endswith('.npy'):
+        image = np.load(input_path, mmap_mode='r')
+        if mode == 'gray' and image.ndim == 3:
+            raise ValueError('Grayscale tiled filtering of .npy files requires a (height, width) array')
+        return image
+    if mode == 'gray':
+        image = cv2.imread(input_path, cv2.IMREAD_GRAYSCALE)
+    else:
+        image = cv2.imread(input_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Unable to read the image {input_path}")
+    return image if mode == 'gray' else image[:, :, ::-1]
+
+
+# Opens the output, accepts 2 arguments:
+#  - output_path -> .npy files are created memory mapped (float32, unclipped) and filled strip by strip,
+#                   the other formats are collected as uint8 (colors as BGR, ready for the encoder) in a temporary
+#                   memory mapped file next to the output and encoded once all the strips are done
+#  - shape -> shape of the output
+def open_output(output_path, shape):
+    if output_path.endswith('.npy'):
+        return np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=shape)
+    # the file is deleted as soon as the memory map is released
+    return np.memmap(tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(output_path))), dtype=np.uint8, mode='w+', shape=shape)
+
+
+# Filters an image tile by tile, accepts the same filter arguments as ImageProcessing.custom_filter:
+#  - input_path -> image to filter (see open_image)
+#  - output_path -> where the result is written (see open_output)
+#  - radius -> percentage of image width, radius of the mask used to apply the filter
+#  - intensity -> percentage of dampening intensity on the modified values
+#  - direction -> 0 HPF, 1 LPF
+#  - profile -> shape of the mask, 'gaussian', 'butterworth' or 'circle' (see tolerant_kernel)
+#  - mode -> 'rgb' or 'gray'
+#  - tile_size -> side of the tiles (pixels), strips are tile_size rows high
+#  - size -> size of the equivalent kernel, by default the smallest within the tolerance (see tolerant_kernel)
+#  - backend -> FFT backend (see FFTBackend.get_backend)
+#  - tolerance -> maximum estimated difference (gray levels) from the whole image filter, a RuntimeWarning is
+#                 emitted when the kernel can't meet it
+def filter_tiled(input_path, output_path, radius, intensity, direction, profile='gaussian', mode='rgb', tile_size=1024, size=None, backend=None,
+                 tolerance=0.5):
+    backend = get_backend(backend)
+    image = open_image(input_path, mode)
+    height, width = image.shape[0:2]
+
+    # same conversion of the percentages as ImageProcessing.custom_filter
+    intensity = (100-intensity)/100
+    radius = (width/2)*(radius/100)
+    kernel, error = tolerant_kernel((height, width), radius, intensity, direction, profile, tolerance, size)
+    if error > tolerance:
+        warnings.warn(f"The {kernel.shape[0]}x{kernel.shape[1]} kernel of the {profile} mask has an estimated error of {error:.3g} gray levels, "
+                      f"beyond the tolerance of {tolerance:.3g}: the result may differ from the whole image filter", RuntimeWarning, stacklevel=2)
+    size = kernel.shape[0]
+    halo = size // 2
+
+    output = open_output(output_path, image.shape)
+    # spectrum of the kernel for each tile shape (only the tiles on the last row and column differ)
+    kernel_frequencies = {}
+
+    for top in range(0, height, tile_size):
+        bottom = min(top + tile_size, height)
+        # strip of rows with the halo, wrapping around the top and bottom borders
+        strip = np.asarray(image[np.arange(top - halo, bottom + halo) % height], np.float32)
+        for left in range(0, width, tile_size):
+            right = min(left + tile_size, width)
+            tile = strip.take(np.arange(left - halo, right + halo) % width, axis=1, mode='wrap')
+            if tile.ndim == 3:
+                # (height, width, colors) -> (colors, height, width), all the colors are transformed together
+                tile = np.moveaxis(tile, -1, 0)
+            shape = (cv2.getOptimalDFTSize(tile.shape[-2]), cv2.getOptimalDFTSize(tile.shape[-1]))
+            if shape not in kernel_frequencies:
+                kernel_frequencies[shape] = kernel_frequency(kernel, shape, backend)
+            padding = [(0, 0)] * (tile.ndim - 2) + [(0, shape[0] - tile.shape[-2]), (0, shape[1] - tile.shape[-1])]
+            filtered = backend.inverse(backend.forward(np.pad(tile, padding)) * kernel_frequencies[shape], shape)
+            # drop the halo (and the padding), what is left is not affected by the circular convolution
+            filtered = filtered[..., halo:halo + bottom - top, halo:halo + right - left]
+            if filtered.ndim == 3:
+                filtered = np.moveaxis(filtered, 0, -1)
+            if output.dtype == np.uint8:
+                filtered = np.clip(filtered, 0, 255)
+                if filtered.ndim == 3:
+                    filtered = filtered[:, :, ::-1]
+            output[top:bottom, left:right] = filtered
+
+    output.flush()
+    if output.dtype == np.uint8 and not cv2.imwrite(output_path, output):
+        raise OSError(f"Unable to write {output_path}")
+    return output
+
+
+# Gets the spatial kernel of a mask (see MaskLibrary.spatial_kernel for the arguments) and its estimated error,
+# cropped from a reference kernel twice as large:
+#  - tolerance -> the kernel grows from MaskLibrary.kernel_size, doubling up to max_size, until its estimated error
+#                 is within it (ignored when size is given)
+#  - size -> size of the kernel, None to choose it
+# returns the kernel (size, size) as float32 and its estimated error in gray levels
+def tolerant_kernel(shape, radius, intensity, direction, profile='gaussian', tolerance=0.5, size=None, max_size=1025):
+    reference = spatial_kernel(shape, radius, intensity, direction, profile, size=2 * (size or max_size) + 1).astype(np.float64)
+    if size is None:
+        size = kernel_size(shape, radius, max_size)
+        while truncation_error(reference, size) > tolerance and size < max_size:
+            size = min(2 * size + 1, max_size)
+    return crop(reference, size).astype(np.float32), truncation_error(reference, size)
+
+
+# Gets the spectrum of a kernel zero padded to the shape of the tiles, with the center of the kernel
+# moved to the origin so that the filtered tile is not shifted
+def kernel_frequency(kernel, shape, backend):
+    padded = np.zeros(shape, np.float32)
+    padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+    padded = np.roll(padded, (-(kernel.shape[0] // 2), -(kernel.shape[1] // 2)), axis=(0, 1))
+    return backend.forward(padded)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Filter an image too large for memory tile by tile')
+    parser.add_argument('input', help='image to filter, .npy arrays are memory mapped, the other formats (JPEG, PNG, ...) are fully decoded in memory')
+    parser.add_argument('output', help='result, a .npy output is written incrementally as float32, the other formats are collected in a temporary file next to it and encoded at the end')
+    parser.add_argument('--radius', type=float, default=10, help='radius in %% of the image width (default: 10)')
+    parser.add_argument('--intensity', type=float, default=50, help='dampening intensity in %% (default: 50)')
+    parser.add_argument('--direction', choices=('hpf', 'lpf'), default='hpf', help='high or low pass (default: hpf)')
+    parser.add_argument('--profile', choices=('gaussian', 'butterworth', 'circle'), default='gaussian', help='shape of the mask, the circle one can\'t be matched within the tolerance (default: gaussian)')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='maximum estimated difference from the whole image filter in gray levels, the kernel is sized for it (default: 0.5)')
+    parser.add_argument('--mode', choices=('rgb', 'gray'), default='rgb', help='filter the colors or the grayscale image (default: rgb)')
+    parser.add_argument('--tile-size', type=int, default=1024, help='side of the tiles in pixels (default: 1024)')
+    parser.add_argument('--kernel-size', type=int, default=None, help='size of the equivalent spatial kernel (default: the smallest within the tolerance)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    filter_tiled(args.input, args.output, args.radius, args.intensity, 1 if args.direction == 'lpf' else 0,
+                 args.profile, args.mode, args.tile_size, args.kernel_size, tolerance=args.tolerance)
+    return 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())
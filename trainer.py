@@ -0,0 +1,203 @@
+import numpy as np
+
+
+# Optimizers of the trainer:
+#  - 'sgd' -> plain mini-batch gradient descent
+#  - 'adam' -> adaptive steps from running averages of the gradient and of its square (converges in a few epochs)
+OPTIMIZERS = ('sgd', 'adam')
+
+
+# Logistic regression trained with mini-batches, the replacement of the full batch loop of Image_Classification.ipynb.
+# The samples are read a chunk of rows at a time and converted to float32 only then, so the inputs can be memory mapped
+# arrays (e.g. the feature store of dataset.py) larger than the memory, stored with any dtype and shape (samples, ...):
+# every sample is flattened. Each epoch visits the rows in a new random order, a chunk is gathered with its indices
+# sorted (sequential reads) and then split in mini-batches.
+# Part of the samples is held out to stop the training when the validation cost stops improving, the weights
+# of the best epoch are kept.
+class LogisticTrainer:
+
+    # Weights (features,) and bias of the model, None until fit is called
+    weights : np.ndarray
+    bias : float
+
+    # Optimizer (see OPTIMIZERS) and its step size
+    optimizer : str
+    learning_rate : float
+
+    # Samples per mini-batch and rows converted to float32 at once
+    batch_size : int
+    chunk_size : int
+
+    # Maximum number of epochs, the training stops earlier once the validation cost did not improve
+    # by more than tolerance for patience epochs
+    max_epochs : int
+    patience : int
+    tolerance : float
+
+    # Fraction of the samples held out for the early stopping (when no validation set is passed to fit), 0 to disable it
+    validation_fraction : float
+
+    # L2 regularization strength
+    alpha : float
+
+    # Factor applied to the inputs after the conversion to float32 (e.g. 1/255 for uint8 images)
+    scale : float
+
+    # Function called at the end of every epoch as callback(epoch, cost, validation_cost), validation_cost is None
+    # without a validation set
+    callback : object
+
+    # (epoch, cost, validation_cost) of every epoch of the last fit
+    history : list
+
+    def __init__(self, optimizer='adam', learning_rate=0.001, batch_size=256, max_epochs=100, patience=5, tolerance=1e-4,
+                 validation_fraction=0.1, alpha=0.0, scale=1.0, chunk_size=1024, callback=None, random_state=None):
+        if optimizer not in OPTIMIZERS:
+            raise ValueError(f"Unknown optimizer '{optimizer}', available optimizers: {', '.join(OPTIMIZERS)}")
+        self.optimizer = optimizer
+        self.learning_rate = learning_rate
+        self.batch_size = batch_size
+        self.chunk_size = max(chunk_size, batch_size)
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.tolerance = tolerance
+        self.validation_fraction = validation_fraction
+        self.alpha = alpha
+        self.scale = scale
+        self.callback = callback
+        self.weights = None
+        self.bias = 0.0
+        self.history = []
+        self._random = np.random.default_rng(random_state)
+
+    # Trains the model, accepts 3 arguments:
+    #  - x -> samples (samples, ...), any array supporting indexing by a list of rows (numpy arrays, memory maps)
+    #  - y -> labels 0 or 1, any shape with one value per sample
+    #  - validation -> (x, y) used for the early stopping instead of holding out part of the samples
+    def fit(self, x, y, validation=None):
+        y = np.asarray(y, np.float32).ravel()
+        rows = np.arange(len(y))
+        if validation is None and self.validation_fraction > 0:
+            held_out = self._random.choice(len(y), max(1, int(len(y) * self.validation_fraction)), replace=False)
+            held_out.sort()
+            # the held out rows are read (and scaled) by cost along with the validation, not copied here
+            validation = (x, y[held_out], held_out)
+            rows = np.setdiff1d(rows, held_out)
+        elif validation is not None:
+            validation = (validation[0], np.asarray(validation[1], np.float32).ravel(), None)
+
+        features = int(np.prod(x.shape[1:]))
+        # small positive weights as the notebook, the model starts from the same point with every optimizer
+        self.weights = np.full(features, 0.01, np.float32)
+        self.bias = 0.0
+        self.history = []
+        self._moments = [np.zeros(features, np.float32), np.zeros(features, np.float32), 0.0, 0.0]
+        self._steps = 0
+
+        best = (np.inf, self.weights.copy(), self.bias)
+        waiting = 0
+        for epoch in range(self.max_epochs):
+            cost = self.train_epoch(x, y, rows)
+            validation_cost = None if validation is None else self.cost(*validation)
+            self.history.append((epoch, cost, validation_cost))
+            if self.callback is not None:
+                self.callback(epoch, cost, validation_cost)
+            if validation is None:
+                continue
+            if validation_cost < best[0] - self.tolerance:
+                best = (validation_cost, self.weights.copy(), self.bias)
+                waiting = 0
+            else:
+                waiting += 1
+                if waiting >= self.patience:
+                    break
+        if validation is not None:
+            _, self.weights, self.bias = best
+        return self
+
+    # Runs one epoch over the given rows in random order, returns the mean cost of the mini-batches
+    def train_epoch(self, x, y, rows):
+        order = self._random.permutation(rows)
+        total = 0.0
+        for start in range(0, len(order), self.chunk_size):
+            chunk_rows = order[start:start + self.chunk_size]
+            # the chunk is read in row order, then the mini-batches follow the random order
+            sorted_rows = np.sort(chunk_rows)
+            chunk = self.read(x, sorted_rows)
+            positions = np.searchsorted(sorted_rows, chunk_rows)
+            for batch in range(0, len(positions), self.batch_size):
+                selected = positions[batch:batch + self.batch_size]
+                total += self.step(chunk[selected], y[sorted_rows[selected]]) * len(selected)
+        return total / max(len(order), 1)
+
+    # Applies a single optimizer step on a mini-batch, returns its cost before the step
+    def step(self, x, y):
+        decision = x @ self.weights + np.float32(self.bias)
+        error = sigmoid(decision) - y
+        gradient_weights = x.T @ error / len(y)
+        if self.alpha:
+            gradient_weights += np.float32(self.alpha) * self.weights
+        gradient_bias = float(error.mean())
+
+        if self.optimizer == 'sgd':
+            self.weights -= np.float32(self.learning_rate) * gradient_weights
+            self.bias -= self.learning_rate * gradient_bias
+        else:
+            beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+            first, second, first_bias, second_bias = self._moments
+            self._steps += 1
+            first *= np.float32(beta1)
+            first += np.float32(1 - beta1) * gradient_weights
+            second *= np.float32(beta2)
+            second += np.float32(1 - beta2) * gradient_weights * gradient_weights
+            first_bias = beta1 * first_bias + (1 - beta1) * gradient_bias
+            second_bias = beta2 * second_bias + (1 - beta2) * gradient_bias * gradient_bias
+            self._moments[2:] = [first_bias, second_bias]
+            # bias corrections of the running averages folded in the step size
+            step_size = self.learning_rate * np.sqrt(1 - beta2 ** self._steps) / (1 - beta1 ** self._steps)
+            self.weights -= np.float32(step_size) * first / (np.sqrt(second) + np.float32(epsilon))
+            self.bias -= step_size * first_bias / (np.sqrt(second_bias) + epsilon)
+        return log_loss(decision, y)
+
+    # Reads some rows of the samples as a float32 matrix (rows, features)
+    def read(self, x, rows):
+        matrix = np.asarray(x[rows], np.float32).reshape(len(rows), -1)
+        if self.scale != 1:
+            matrix *= np.float32(self.scale)
+        return matrix
+
+    # Gets w.x + b for every sample (or for the given rows only), computed a chunk of rows at a time
+    def decision_function(self, x, rows=None):
+        rows = np.arange(len(x)) if rows is None else np.asarray(rows)
+        decision = np.empty(len(rows), np.float32)
+        for start in range(0, len(rows), self.chunk_size):
+            decision[start:start + self.chunk_size] = self.read(x, rows[start:start + self.chunk_size]) @ self.weights + np.float32(self.bias)
+        return decision
+
+    # Gets the probability of the class 1 of every sample
+    def predict_proba(self, x):
+        return sigmoid(self.decision_function(x))
+
+    # Gets the predicted class of every sample, 1 when its probability is above 0.5
+    def predict(self, x):
+        return (self.decision_function(x) > 0).astype(np.float32)
+
+    # Gets the fraction of samples correctly classified
+    def score(self, x, y):
+        return float(np.mean(self.predict(x) == np.asarray(y).ravel()))
+
+    # Gets the mean cost (cross entropy) on a set of samples, or on the given rows of it (y holds their labels only)
+    def cost(self, x, y, rows=None):
+        return log_loss(self.decision_function(x, rows), np.asarray(y, np.float32).ravel())
+
+
+# Sigmoid written with tanh, it never overflows however large the decision is
+def sigmoid(decision):
+    return np.float32(0.5) * (np.tanh(np.float32(0.5) * decision) + np.float32(1))
+
+
+# Mean cross entropy computed from the decision values instead of the probabilities:
+#   -y*log(sigmoid(z)) - (1-y)*log(1-sigmoid(z)) = log(1 + exp(z)) - y*z
+# with log(1 + exp(z)) = logaddexp(0, z), no log of 0 and no overflow for large |z|
+def log_loss(decision, y):
+    return float(np.mean(np.logaddexp(np.float32(0), decision) - y * decision))
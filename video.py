@@ -0,0 +1,268 @@
+import argparse
+import queue
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+from batch import FILTERS, chain_step, filter_spec
+from BufferPool import BufferPool
+from FFTBackend import get_backend
+from FilterPlanner import METHODS
+from ImageProcessing import ImageProcessing
+from Instrumentation import Instrumentation, format_breakdown
+from OutputSink import NullSink
+
+
+# Streaming mode, the filters of batch.py applied to every frame of a video.
+# Decoding, filtering and encoding run in three threads connected by bounded queues, so that the three stages
+# overlap and the frames in flight (and the memory) are limited by the queue size:
+#
+#   reader                   filter                          writer
+#   ------------------       ----------------------------    ------------------
+#   cv2.VideoCapture   -->   [queue]  ImageProcessing  -->   [queue]  cv2.VideoWriter
+#
+# All the frames have the same size, so everything that depends on it is built once and kept across frames:
+# the masks stay in the MaskLibrary cache, the filtered spectra come from a buffer pool of the stream and the
+# FFT plans of that size are cached by the transform backend (both numpy and scipy keep the plans of the
+# recently used shapes). Each frame only costs its own transforms.
+# By default the reader waits when the filter falls behind, as it should for a file. With drop_frames the file is
+# read at the frame rate of the video, as a live source (e.g. a camera dump being replayed) would deliver it, and
+# the frames arriving while the queue is full are dropped and counted: no drops means the filter sustains the source.
+
+
+# Marks the end of the stream in the queues
+END = None
+
+
+# Counters of a stream, updated by the threads and read by the progress report
+class StreamStats:
+
+    # Frames decoded, written and dropped (see filter_video)
+    read : int
+    written : int
+    dropped : int
+
+    # Plan of the filter of the last frame (see FilterPlanner), None for the chains
+    plan : object
+
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+        self.dropped = 0
+        self.plan = None
+        self.started = time.perf_counter()
+        self.finished = None
+
+    # Seconds since the stream started, until it finished
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    # Sustained frames per second, written frames over the elapsed time
+    @property
+    def fps(self):
+        return self.written / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return f"{self.written} frames written in {self.elapsed:.2f} s ({self.fps:.2f} fps), {self.read} read, {self.dropped} dropped"
+
+
+# Filters a single frame, accepts 5 arguments:
+#  - frame -> the decoded frame (height, width, colors(BGR))
+#  - spec -> dictionary describing the filter (see batch.filter_spec)
+#  - backend -> transform backend shared by all the frames
+#  - buffers -> buffer pool shared by all the frames
+#  - instrumentation -> Instrumentation collecting the stages of all the frames, None to disable
+# returns the filtered frame as uint8, BGR for the colors and single channel for the grayscale, and the plan of the
+# filter (None for the chains, always filtered in the frequency domain)
+def filter_frame(frame, spec, backend, buffers, instrumentation=None):
+    image = ImageProcessing('', compact=True, backend=backend, sink=NullSink(), image=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB),
+                            instrumentation=instrumentation, buffers=buffers, method=spec['method'])
+    channels = [0, 1, 2] if spec['mode'] == 'rgb' else []
+    if spec['chain']:
+        filtered = image.pipeline(channels, [chain_step(name, spec) for name in spec['chain']])
+    else:
+        method = getattr(image, FILTERS[spec['filter']])
+        if spec['filter'] == 'custom':
+            filtered = method(channels, spec['radius'], spec['intensity'], spec['direction'], spec['profile'])
+        else:
+            filtered = method(channels, spec['profile'])
+    image.release()
+    if len(channels):
+        return cv2.cvtColor(filtered, cv2.COLOR_RGB2BGR), image.last_plan
+    # the filtered grayscale is float, rounded and saturated as the encoders of OutputSink do
+    return np.clip(np.rint(filtered), 0, 255).astype(np.uint8), image.last_plan
+
+
+# Puts an item in a bounded queue, giving up when the stream is stopped (so that no thread waits forever on a
+# queue nobody reads anymore), returns False in that case
+def put(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Gets an item from a queue, END when the stream is stopped
+def take(items, stop):
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return END
+
+
+# Filters a video, accepts 10 arguments:
+#  - input_path -> video file (anything cv2.VideoCapture can open)
+#  - output_path -> video written with cv2.VideoWriter, the container follows its extension
+#  - spec -> dictionary describing the filter (see batch.filter_spec)
+#  - backend -> transform backend (see FFTBackend), by default the fastest available one
+#  - queue_size -> frames waiting between two stages
+#  - drop_frames -> when True the frames are read at the frame rate of the video and the ones arriving while the
+#                   filter is busy are dropped instead of waited for
+#  - codec -> four character code of the encoder
+#  - max_frames -> stop after this many frames read, None for the whole video
+#  - instrumentation -> Instrumentation collecting the stages of the filter over all the frames, None to disable
+#  - report -> function called with the StreamStats about every second while the stream runs, None to disable
+# returns the StreamStats of the stream
+def filter_video(input_path, output_path, spec, backend=None, queue_size=8, drop_frames=False, codec='mp4v',
+                 max_frames=None, instrumentation=None, report=None):
+    capture = cv2.VideoCapture(input_path)
+    if not capture.isOpened():
+        raise ValueError(f"Unable to open the video {input_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    backend = get_backend(backend)
+    buffers = BufferPool()
+    stats = StreamStats()
+    stop = threading.Event()
+    errors = []
+    decoded = queue.Queue(maxsize=queue_size)
+    filtered = queue.Queue(maxsize=queue_size)
+
+    def reader():
+        try:
+            while not stop.is_set() and (max_frames is None or stats.read < max_frames):
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                stats.read += 1
+                if drop_frames:
+                    # the frames arrive at the rate of the source
+                    time.sleep(max(0.0, stats.started + stats.read / fps - time.perf_counter()))
+                    try:
+                        decoded.put_nowait(frame)
+                    except queue.Full:
+                        stats.dropped += 1
+                elif not put(decoded, frame, stop):
+                    return
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            capture.release()
+            put(decoded, END, stop)
+
+    def filterer():
+        try:
+            while True:
+                frame = take(decoded, stop)
+                if frame is END:
+                    break
+                frame, stats.plan = filter_frame(frame, spec, backend, buffers, instrumentation)
+                if not put(filtered, frame, stop):
+                    return
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            put(filtered, END, stop)
+
+    def writer():
+        video = None
+        try:
+            while True:
+                frame = take(filtered, stop)
+                if frame is END:
+                    break
+                if video is None:
+                    # the size of the output is the one of the frames, known once the first one is filtered
+                    video = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*codec), fps, (frame.shape[1], frame.shape[0]), frame.ndim == 3)
+                    if not video.isOpened():
+                        raise ValueError(f"Unable to write the video {output_path} with the codec {codec}")
+                video.write(frame)
+                stats.written += 1
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            if video is not None:
+                video.release()
+
+    threads = [threading.Thread(target=target, name=f'Video{target.__name__.capitalize()}', daemon=True) for target in (reader, filterer, writer)]
+    for thread in threads:
+        thread.start()
+    while threads[-1].is_alive():
+        threads[-1].join(timeout=1)
+        if report is not None and threads[-1].is_alive():
+            report(stats)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    stats.finished = time.perf_counter()
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Apply one of the frequency domain filters to every frame of a video')
+    parser.add_argument('input', help='video to filter')
+    parser.add_argument('output', help='filtered video, e.g. filtered.mp4 or filtered.avi')
+    parser.add_argument('--filter', choices=FILTERS, default='sharpening', help='filter to apply (default: sharpening)')
+    parser.add_argument('--mode', choices=('rgb', 'gray'), default='rgb', help='filter the colors or the grayscale frames (default: rgb)')
+    parser.add_argument('--radius', type=float, default=10, help='custom filter: radius in %% of the frame width (default: 10)')
+    parser.add_argument('--intensity', type=float, default=50, help='custom filter: dampening intensity in %% (default: 50)')
+    parser.add_argument('--direction', choices=('hpf', 'lpf'), default='hpf', help='custom filter: high or low pass (default: hpf)')
+    parser.add_argument('--profile', choices=('circle', 'gaussian', 'butterworth'), default='circle', help='shape of the mask (default: circle)')
+    parser.add_argument('--method', choices=METHODS, default='auto', help='run the filters with the DFT, with the equivalent spatial convolution or with the cheaper of the two within the tolerance of the planner, the chains always use the DFT (default: auto)')
+    parser.add_argument('--chain', default=None, help='comma separated filters applied together in one pass, e.g. noise,sharpening (overrides --filter)')
+    parser.add_argument('--backend', choices=('numpy', 'scipy'), default=None, help='transform backend (default: scipy when installed)')
+    parser.add_argument('--codec', default='mp4v', help='four character code of the encoder (default: mp4v)')
+    parser.add_argument('--queue-size', type=int, default=8, help='frames waiting between two stages (default: 8)')
+    parser.add_argument('--drop-frames', action='store_true', help='read at the frame rate of the video and drop the frames arriving while the filter is busy, as for a live source')
+    parser.add_argument('--max-frames', type=int, default=None, help='stop after this many frames')
+    parser.add_argument('--stages', action='store_true', help='print the time spent in every stage of the filter over all the frames')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for name in (args.chain.split(',') if args.chain else []):
+        if name not in FILTERS:
+            print(f"Unknown filter '{name}' in --chain, available filters: {', '.join(FILTERS)}", file=sys.stderr)
+            return 2
+    instrumentation = Instrumentation() if args.stages else None
+    report = lambda stats: print(f"{stats.written} frames, {stats.fps:.2f} fps, {stats.dropped} dropped", flush=True)
+    try:
+        stats = filter_video(args.input, args.output, filter_spec(args), args.backend, args.queue_size, args.drop_frames,
+                             args.codec, args.max_frames, instrumentation, report)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    print(stats.summary())
+    if args.method == 'spatial' and stats.plan is not None:
+        # forced, the result may be far from the frequency one
+        print(f"plan: {stats.plan}")
+    if instrumentation is not None:
+        print(f"stages: {format_breakdown(instrumentation.breakdown())}")
+    return 0
+
+
+# check if the process running is the 'main', in that case start
+if __name__ == '__main__':
+    sys.exit(main())